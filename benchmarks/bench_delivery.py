@@ -0,0 +1,147 @@
+"""بنچمارک صف ارسال خروجی در برابر Bot API جعلی که محدودیت‌های نرخ تلگرام را اعمال می‌کند.
+
+مقایسه ارسال ترتیبی قدیمی (یکی‌یکی، بدون محدودکننده) با OutboundDelivery برای هزاران یادآوری هم‌زمان،
+یک بار با پخش یکنواخت بین چت‌ها و یک بار با تمرکز بیشتر پیام‌ها روی چند چت (موج یادآوری‌های یک نماینده):
+    python benchmarks/bench_delivery.py --reminders 3000 --chats 600 --hot-chats 3 --hot-share 0.8
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from collections import defaultdict, deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram.error import RetryAfter
+
+import crmbotrender
+
+
+class RateLimitedFakeBot:
+    """Bot API جعلی: تأخیر شبکه ثابت و RetryAfter هنگام عبور از ۳۰ پیام/ثانیه کلی یا ۱ پیام/ثانیه هر چت."""
+
+    def __init__(self, latency: float = 0.03, global_limit: int = 30, chat_limit: int = 1):
+        self.latency = latency
+        self.global_limit = global_limit
+        self.chat_limit = chat_limit
+        self._global = deque()
+        self._per_chat = defaultdict(deque)
+        self.delivered = 0
+        self.rejected = 0
+
+    @staticmethod
+    def _over_limit(window: deque, limit: int, now: float) -> bool:
+        while window and now - window[0] >= 1.0:
+            window.popleft()
+        return len(window) >= limit
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(self.latency)
+        now = time.monotonic()
+        if self._over_limit(self._global, self.global_limit, now) or \
+                self._over_limit(self._per_chat[chat_id], self.chat_limit, now):
+            self.rejected += 1
+            raise RetryAfter(1)
+        self._global.append(now)
+        self._per_chat[chat_id].append(now)
+        self.delivered += 1
+        return True
+
+
+def make_reminders(count: int, chats: int, hot_chats: int = 0, hot_share: float = 0.0) -> list:
+    """یادآوری‌ها بین chats چت پخش می‌شوند؛ سهم hot_share از آن‌ها فقط به hot_chats چت اول می‌رسد."""
+    hot_count = int(count * hot_share) if hot_chats else 0
+    reminders = []
+    for r_id in range(count):
+        if r_id < hot_count:
+            chat_id = 1000 + r_id % hot_chats
+        else:
+            chat_id = 1000 + hot_chats + r_id % (chats - hot_chats)
+        reminders.append((r_id, chat_id, f"مشتری {r_id}", "پیگیری دوشنبه"))
+    # ترتیب رسیدن مثل برداشت بر اساس سررسید: پیام‌های چت‌های شلوغ و بقیه درهم
+    reminders.sort(key=lambda reminder: (reminder[0] * 7919) % count)
+    return reminders
+
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def run_sequential(reminders: list, latency: float) -> dict:
+    """رفتار reminder_checker قدیمی: ارسال یکی‌یکی؛ اولین RetryAfter کل دسته را متوقف می‌کند."""
+    bot = RateLimitedFakeBot(latency)
+    started = time.perf_counter()
+    try:
+        for _, chat_id, customer_name, text in reminders:
+            await bot.send_message(chat_id=chat_id, text=crmbotrender.format_reminder_message(customer_name, text))
+    except RetryAfter:
+        pass
+    return {"mode": "sequential", "seconds": time.perf_counter() - started,
+            "delivered": bot.delivered, "rejected": bot.rejected, "failed": len(reminders) - bot.delivered,
+            "cold_p95": None}
+
+
+async def run_delivery(reminders: list, latency: float, workers: int, hot_chats: int = 0) -> dict:
+    bot = RateLimitedFakeBot(latency)
+    delivery = crmbotrender.OutboundDelivery(bot, workers=workers)
+    results = []
+    # زمان تحویل پیام‌های چت‌های غیرشلوغ؛ نشان می‌دهد چند چت شلوغ بقیه را معطل می‌کنند یا نه
+    cold_seconds = []
+    delivery.start()
+    started = time.perf_counter()
+
+    def on_done(message, ok, error):
+        results.append(ok)
+        if message.chat_id >= 1000 + hot_chats:
+            cold_seconds.append(time.perf_counter() - started)
+
+    for r_id, chat_id, customer_name, text in reminders:
+        await delivery.enqueue(crmbotrender.OutboundMessage(
+            chat_id=chat_id,
+            text=crmbotrender.format_reminder_message(customer_name, text),
+            parse_mode="Markdown",
+            on_done=on_done,
+            ref=r_id,
+        ))
+    while len(results) < len(reminders):
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - started
+    for task in list(crmbotrender._background_tasks):
+        task.cancel()
+    return {"mode": f"delivery x{workers}", "seconds": elapsed, "delivered": bot.delivered,
+            "rejected": bot.rejected, "failed": results.count(False), "cold_p95": percentile(cold_seconds, 0.95)}
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--reminders", type=int, default=3000)
+    parser.add_argument("--chats", type=int, default=600)
+    parser.add_argument("--latency", type=float, default=0.03, help="fake Bot API latency per request (s)")
+    parser.add_argument("--workers", type=int, default=crmbotrender.DELIVERY_WORKERS)
+    parser.add_argument("--hot-chats", type=int, default=3, help="chats receiving the skewed share")
+    parser.add_argument("--hot-share", type=float, default=0.8, help="fraction of reminders sent to the hot chats")
+    args = parser.parse_args()
+
+    print(f"{args.reminders} due reminders across {args.chats} chats, fake API latency {args.latency}s")
+    scenarios = (
+        ("uniform", make_reminders(args.reminders, args.chats), 0),
+        (f"skewed: {args.hot_share:.0%} on {args.hot_chats} chats",
+         make_reminders(args.reminders, args.chats, args.hot_chats, args.hot_share), args.hot_chats),
+    )
+    for title, reminders, hot_chats in scenarios:
+        print(f"\n{title}")
+        print(f"{'mode':<14} {'seconds':>8} {'delivered':>9} {'msg/s':>7} {'429s':>6} {'failed':>6} {'cold p95 s':>10}")
+        for result in (await run_sequential(reminders, args.latency),
+                       await run_delivery(reminders, args.latency, args.workers, hot_chats)):
+            rate = result["delivered"] / result["seconds"] if result["seconds"] else 0
+            cold = "-" if result["cold_p95"] is None else f"{result['cold_p95']:.1f}"
+            print(f"{result['mode']:<14} {result['seconds']:>8.1f} {result['delivered']:>9} {rate:>7.1f} "
+                  f"{result['rejected']:>6} {result['failed']:>6} {cold:>10}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,63 @@
+"""بنچمارک توان عملیاتی message_handler با مدل جعلی در تعداد چت‌های هم‌زمان مختلف.
+
+اجرا:  python benchmarks/bench_gemini_concurrency.py --latency 0.2 --turns 3
+"""
+import argparse
+import asyncio
+import time
+
+from fakes import FakeBot, FakeGenaiClient, make_context, make_update
+
+import crmbotrender
+
+
+async def run_level(chats: int, turns: int, latency: float) -> dict:
+    """ارسال هم‌زمان turns پیام از هر چت (مانند concurrent_updates) و اندازه‌گیری زمان کل."""
+    client = FakeGenaiClient(latency)
+    crmbotrender.ai_client = client
+    crmbotrender.load_genai()
+    bot = FakeBot()
+    contexts = {chat_id: make_context(bot) for chat_id in range(1, chats + 1)}
+
+    tasks = []
+    started = time.perf_counter()
+    for turn in range(turns):
+        for chat_id, context in contexts.items():
+            update = make_update(bot, chat_id, f"{chat_id}-{turn}")
+            tasks.append(asyncio.create_task(crmbotrender.message_handler(update, context)))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+
+    # ترتیب پاسخ‌های هر چت باید با ترتیب پیام‌ها یکی باشد
+    for chat_id in contexts:
+        replies = [text for cid, text in bot.sent if cid == chat_id]
+        assert replies == [f"reply:{chat_id}-{turn}" for turn in range(turns)], f"chat {chat_id} out of order"
+
+    total = chats * turns
+    return {
+        "chats": chats,
+        "turns": total,
+        "seconds": elapsed,
+        "turns_per_s": total / elapsed,
+        "max_in_flight": client.aio.models.max_in_flight,
+    }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--latency", type=float, default=0.2, help="fake model latency per call (s)")
+    parser.add_argument("--turns", type=int, default=3, help="messages sent by each chat")
+    parser.add_argument("--levels", default="1,5,10,25,50", help="comma-separated concurrent chat counts")
+    parser.add_argument("--max-concurrency", type=int, default=crmbotrender.GEMINI_MAX_CONCURRENCY)
+    args = parser.parse_args()
+
+    crmbotrender._gemini_semaphore = asyncio.Semaphore(args.max_concurrency)
+    print(f"fake latency={args.latency}s, GEMINI_MAX_CONCURRENCY={args.max_concurrency}")
+    print(f"{'chats':>6} {'turns':>6} {'seconds':>8} {'turns/s':>8} {'in-flight':>9}")
+    for level in (int(x) for x in args.levels.split(",")):
+        r = await run_level(level, args.turns, args.latency)
+        print(f"{r['chats']:>6} {r['turns']:>6} {r['seconds']:>8.2f} {r['turns_per_s']:>8.1f} {r['max_in_flight']:>9}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
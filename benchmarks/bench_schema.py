@@ -0,0 +1,135 @@
+"""مقایسه پلن و زمان کوئری‌های اصلی CRM قبل و بعد از مهاجرت ایندکس‌ها و کلیدهای خارجی.
+
+روی یک دیتابیس آزمایشی اجرا کنید (اسکیمای crm_bench در آن ساخته و در پایان حذف می‌شود):
+    BENCH_DATABASE_URL=postgresql://localhost/crm_bench python benchmarks/bench_schema.py --interactions 1000000
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import psycopg
+
+import crmbotrender
+
+BENCH_SCHEMA = "crm_bench"
+INDUSTRIES = ["صنایع غذایی", "پتروشیمی", "نساجی", "فولاد", "داروسازی", "ساختمان"]
+
+# (عنوان، کوئری قبل از مهاجرت، کوئری بعد از مهاجرت)؛ پارامترها با %(name)s
+QUERIES = [
+    ("find_customer_data",
+     "SELECT id FROM customers WHERE name ILIKE %(name)s",
+     "SELECT id FROM customers WHERE name ILIKE %(name)s ORDER BY id LIMIT 1"),
+    ("industry_search",
+     "SELECT name, phone, company, industry FROM customers WHERE industry ILIKE %(industry)s",
+     "SELECT name, phone, company, industry FROM customers WHERE industry ILIKE %(industry)s"),
+    ("full_customer interactions",
+     "SELECT interaction_date, report, follow_up_date FROM interactions WHERE customer_name ILIKE %(name)s ORDER BY interaction_date DESC",
+     "SELECT interaction_date, report, follow_up_date FROM interactions WHERE customer_id = %(customer_id)s ORDER BY interaction_date DESC"),
+    ("delete_customer interactions",
+     "SELECT COUNT(*) FROM interactions WHERE customer_name = %(name)s",
+     "SELECT COUNT(*) FROM interactions WHERE customer_id = %(customer_id)s"),
+    ("due reminders",
+     "SELECT id, chat_id, customer_name, reminder_text FROM reminders WHERE sent = FALSE AND due_date_time <= now()",
+     "SELECT id, chat_id, customer_name, reminder_text FROM reminders WHERE sent = FALSE AND due_date_time <= now()"),
+]
+
+
+async def seed(conn, customers: int, interactions: int, reminders: int) -> None:
+    """ساخت داده مصنوعی کاملاً سمت سرور با generate_series."""
+    started = time.perf_counter()
+    await conn.execute(
+        """
+        INSERT INTO customers (name, phone, company, industry, services)
+        SELECT 'مشتری ' || g, '09' || lpad(g::text, 9, '0'), 'شرکت ' || (g %% 5000),
+               (%(industries)s::text[])[1 + g %% 6] || ' ' || (g %% 100), 'خدمات'
+        FROM generate_series(1, %(n)s) g
+        """,
+        {"n": customers, "industries": INDUSTRIES},
+    )
+    await conn.execute(
+        """
+        INSERT INTO interactions (customer_name, interaction_date, report, follow_up_date)
+        SELECT 'مشتری ' || (1 + (g * 7919) %% %(customers)s), current_date - (g %% 365),
+               'گزارش تماس شماره ' || g, CASE WHEN g %% 3 = 0 THEN current_date + (g %% 30) END
+        FROM generate_series(1, %(n)s) g
+        """,
+        {"n": interactions, "customers": customers},
+    )
+    await conn.execute(
+        """
+        INSERT INTO reminders (chat_id, customer_name, reminder_text, due_date_time, sent)
+        SELECT 1000 + g %% 50, 'مشتری ' || (1 + g %% %(customers)s), 'یادآوری ' || g,
+               now() + ((g %% 1000) - 500) * interval '1 hour', g %% 10 <> 0
+        FROM generate_series(1, %(n)s) g
+        """,
+        {"n": reminders, "customers": customers},
+    )
+    await conn.execute("ANALYZE")
+    print(f"seeded {customers} customers, {interactions} interactions, {reminders} reminders "
+          f"in {time.perf_counter() - started:.1f}s")
+
+
+async def explain_all(conn, phase: str, params: dict) -> dict:
+    """اجرای EXPLAIN ANALYZE برای همه کوئری‌ها و چاپ پلن هر کدام."""
+    timings = {}
+    for title, before_sql, after_sql in QUERIES:
+        sql = before_sql if phase == "before" else after_sql
+        cursor = await conn.execute("EXPLAIN (ANALYZE, BUFFERS) " + sql, params if "%(" in sql else None)
+        plan = [row[0] for row in await cursor.fetchall()]
+        execution = next((line for line in plan if line.startswith("Execution Time")), "")
+        timings[title] = float(execution.split(":")[1].split()[0]) if execution else float("nan")
+        print(f"\n--- [{phase}] {title} ---")
+        print("\n".join(plan))
+    return timings
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--customers", type=int, default=100_000)
+    parser.add_argument("--interactions", type=int, default=1_000_000)
+    parser.add_argument("--reminders", type=int, default=200_000)
+    parser.add_argument("--keep", action="store_true", help="do not drop the crm_bench schema afterwards")
+    args = parser.parse_args()
+
+    url = os.environ.get("BENCH_DATABASE_URL")
+    if not url:
+        sys.exit("BENCH_DATABASE_URL is not set (use a scratch database).")
+
+    conn = await psycopg.AsyncConnection.connect(url, autocommit=True)
+    try:
+        await conn.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE")
+        await conn.execute(f"CREATE SCHEMA {BENCH_SCHEMA}")
+        await conn.execute(f"SET search_path TO {BENCH_SCHEMA}, public")
+
+        # فقط اسکیمای اولیه (بدون ایندکس و کلید خارجی) مانند دیتابیس‌های قدیمی
+        await crmbotrender.run_migrations(conn, target_version=1)
+        await seed(conn, args.customers, args.interactions, args.reminders)
+
+        params = {"name": f"مشتری {args.customers // 2}", "industry": "%پتروشیمی 4%"}
+        before = await explain_all(conn, "before", params)
+
+        started = time.perf_counter()
+        version = await crmbotrender.run_migrations(conn)
+        await conn.execute("ANALYZE")
+        print(f"\nmigrated to schema version {version} (backfill + indexes) in {time.perf_counter() - started:.1f}s")
+
+        cursor = await conn.execute("SELECT id FROM customers WHERE name = %s", (params["name"],))
+        params["customer_id"] = (await cursor.fetchone())[0]
+        after = await explain_all(conn, "after", params)
+
+        print(f"\n{'query':<30} {'before ms':>10} {'after ms':>10} {'speedup':>8}")
+        for title in before:
+            speedup = before[title] / after[title] if after[title] else float("inf")
+            print(f"{title:<30} {before[title]:>10.2f} {after[title]:>10.2f} {speedup:>7.1f}x")
+    finally:
+        if not args.keep:
+            await conn.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE")
+        await conn.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
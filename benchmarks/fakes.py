@@ -0,0 +1,178 @@
+"""ماک‌های محلی تلگرام و Gemini برای بنچمارک‌ها؛ هیچ درخواست شبکه‌ای ارسال نمی‌شود."""
+import asyncio
+import os
+import sys
+from types import SimpleNamespace
+
+# امکان اجرای مستقیم اسکریپت‌ها از ریشه مخزن: python benchmarks/<name>.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from google.genai import types
+
+
+def make_text_response(text: str):
+    """ساخت پاسخ متنی ساده با همان فیلدهایی که message_handler می‌خواند."""
+    content = types.Content(role="model", parts=[types.Part(text=text)])
+    return SimpleNamespace(function_calls=None, candidates=[SimpleNamespace(content=content)], text=text)
+
+
+def make_function_call_response(name: str, args: dict):
+    """پاسخی که فقط یک function call دارد (مانند درخواست اجرای تابع توسط مدل)."""
+    content = types.Content(role="model", parts=[types.Part(function_call=types.FunctionCall(name=name, args=args))])
+    return SimpleNamespace(function_calls=[content.parts[0].function_call], candidates=[SimpleNamespace(content=content)], text=None)
+
+
+class FakeModels:
+    """جایگزین client.aio.models با تأخیر قابل تنظیم؛ آخرین پیام کاربر را پژواک می‌کند."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def generate_content(self, model, contents, config=None):
+        self.calls += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self.in_flight -= 1
+        last_text = contents[-1].parts[0].text if contents and contents[-1].parts else ""
+        return make_text_response(f"reply:{last_text}")
+
+    async def generate_content_stream(self, model, contents, config=None):
+        """همان پاسخ generate_content در چند تکه؛ تأخیر بین تکه‌ها تقسیم می‌شود."""
+        response = await self.generate_content(model, contents, config)
+        return self._chunks(response.text)
+
+    async def _chunks(self, text: str, pieces: int = 3):
+        size = max(1, -(-len(text) // pieces))
+        for start in range(0, len(text), size):
+            yield make_text_response(text[start:start + size])
+
+
+class ScriptedModels(FakeModels):
+    """مدل جعلی با «برنامه» فراخوانی توابع: plan_for(متن کاربر) لیست (نام تابع، آرگومان‌ها) را برمی‌گرداند.
+
+    هر گام مدل یکی از فراخوانی‌های برنامه را درخواست می‌کند و پس از آخرین گام پاسخ متنی می‌دهد.
+    """
+
+    def __init__(self, latency: float, plan_for):
+        super().__init__(latency)
+        self.plan_for = plan_for
+
+    async def generate_content(self, model, contents, config=None):
+        self.calls += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self.in_flight -= 1
+        # گام جاری = تعداد پاسخ‌های تابع پس از آخرین پیام کاربر
+        user_index = max(i for i, content in enumerate(contents) if content.role == "user")
+        steps_done = sum(1 for content in contents[user_index:] if content.role == "tool")
+        user_text = contents[user_index].parts[0].text
+        plan = self.plan_for(user_text)
+        if steps_done < len(plan):
+            return make_function_call_response(*plan[steps_done])
+        return make_text_response(f"reply:{user_text}")
+
+    async def _chunks(self, text: str, pieces: int = 3):
+        if text is None:
+            return
+        async for chunk in super()._chunks(text, pieces):
+            yield chunk
+
+    async def generate_content_stream(self, model, contents, config=None):
+        response = await self.generate_content(model, contents, config)
+        if response.function_calls:
+            return self._single(response)
+        return self._chunks(response.text)
+
+    async def _single(self, response):
+        yield response
+
+
+class FakeCaches:
+    """جایگزین client.aio.caches؛ فقط تعداد ساخت و تمدید کش را می‌شمارد."""
+
+    def __init__(self):
+        self.created = 0
+        self.updated = 0
+
+    async def create(self, model, config=None):
+        self.created += 1
+        return SimpleNamespace(name=f"cachedContents/fake-{self.created}")
+
+    async def update(self, name, config=None):
+        self.updated += 1
+        return SimpleNamespace(name=name)
+
+    async def delete(self, name, config=None):
+        return None
+
+
+class FakeGenaiClient:
+    """جایگزین genai.Client که فقط رابط‌های aio.models و aio.caches را پیاده می‌کند."""
+
+    def __init__(self, latency: float = 0.2, models: FakeModels = None):
+        self.aio = SimpleNamespace(models=models or FakeModels(latency), caches=FakeCaches())
+
+
+class FakeBot:
+    """جایگزین telegram.Bot که پیام‌های ارسالی را به ترتیب ثبت می‌کند."""
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_chat_action(self, chat_id, action, **kwargs):
+        return True
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+        return FakeSentMessage(self, len(self.sent) - 1, chat_id, text)
+
+
+class FakeSentMessage:
+    """پیام ارسال‌شده؛ edit_text متن ثبت‌شده در bot.sent را جایگزین می‌کند."""
+
+    def __init__(self, bot: FakeBot, index: int, chat_id: int, text: str):
+        self.bot = bot
+        self.index = index
+        self.chat_id = chat_id
+        self.message_id = index + 1
+        self.text = text
+        self.edits = 0
+
+    async def edit_text(self, text, **kwargs):
+        self.text = text
+        self.edits += 1
+        self.bot.sent[self.index] = (self.chat_id, text)
+        return self
+
+
+class FakeMessage:
+    def __init__(self, bot: FakeBot, chat_id: int, text: str):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.text = text
+
+    async def reply_text(self, text, **kwargs):
+        return await self.bot.send_message(self.chat_id, text, **kwargs)
+
+
+def make_update(bot: FakeBot, chat_id: int, text: str):
+    """یک Update متنی مصنوعی برای یک چت خصوصی."""
+    return SimpleNamespace(
+        message=FakeMessage(bot, chat_id, text),
+        effective_chat=SimpleNamespace(id=chat_id),
+        effective_user=SimpleNamespace(id=chat_id),
+    )
+
+
+def make_context(bot: FakeBot):
+    """ContextTypes.DEFAULT_TYPE مصنوعی با user_data و chat_data مستقل برای هر چت."""
+    return SimpleNamespace(bot=bot, user_data={}, chat_data={})
@@ -0,0 +1,271 @@
+"""بنچمارک یک‌جای بار: message_handler، start_command و زمان‌بند یادآوری با تلگرام و Gemini جعلی.
+
+هر چت یک کاربر شبیه‌سازی‌شده است که /start می‌زند و سپس پیام‌هایش را یکی‌یکی (پس از دریافت پاسخ قبلی)
+می‌فرستد. مدل جعلی بر اساس برنامه ثابتی توابع CRM را فراخوانی می‌کند (۵۰٪ پاسخ مستقیم، ۳۰٪ گزارش،
+۱۰٪ ثبت تعامل، ۱۰٪ گزارش مشتری + یادآوری).
+
+بدون BENCH_DATABASE_URL توابع دیتابیس با تأخیر ثابت شبیه‌سازی می‌شوند و تاریخچه در SQLite ذخیره می‌شود؛
+با آن، توابع واقعی روی اسکیمای crm_bench اجرا و تعداد واقعی کوئری‌ها شمرده می‌شود (و مرحله یادآوری هم اجرا می‌شود).
+
+اجرا:
+    python benchmarks/run.py
+    BENCH_DATABASE_URL=postgresql://localhost/crm_bench python benchmarks/run.py --levels 10,100 --json bench.json
+"""
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+# تنظیمات باید پیش از import ماژول ربات اعمال شوند
+_history_dir = tempfile.mkdtemp(prefix="crm_bench_")
+os.environ.setdefault("HISTORY_STORE", "sqlite")
+os.environ.setdefault("HISTORY_SQLITE_PATH", os.path.join(_history_dir, "history.sqlite3"))
+
+from fakes import FakeBot, FakeGenaiClient, ScriptedModels, make_context, make_update
+
+import psycopg
+from psycopg_pool import AsyncConnectionPool
+
+import crmbotrender
+
+BENCH_SCHEMA = "crm_bench"
+BENCH_CUSTOMERS = 1000
+# شمارنده کوئری‌های دیتابیس CRM (واقعی یا شبیه‌سازی‌شده)
+db_queries = 0
+
+
+def customer_name(chat_id: int) -> str:
+    return f"مشتری {chat_id % BENCH_CUSTOMERS + 1}"
+
+
+def plan_for(user_text: str) -> list:
+    """برنامه فراخوانی توابع برای پیام «bench <chat>-<turn>»."""
+    chat_id, turn = (int(x) for x in user_text.split()[1].split("-"))
+    kind = (chat_id + turn) % 10
+    if kind < 5:
+        return []
+    if kind < 8:
+        return [("get_report", {"query_type": "count_by_industry"})]
+    if kind == 8:
+        return [("log_interaction", {"customer_name": customer_name(chat_id), "interaction_report": f"تماس بنچمارک {turn}"})]
+    due = (datetime.now(crmbotrender.IRAN_TZ) + timedelta(days=1)).strftime("%Y-%m-%d %H:%M")
+    return [
+        ("get_report", {"query_type": "full_customer", "search_term": customer_name(chat_id)}),
+        ("set_reminder", {"customer_name": customer_name(chat_id), "reminder_text": "پیگیری بنچمارک", "date_time": due}),
+    ]
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def install_fake_tools(db_latency: float) -> dict:
+    """جایگزینی توابع دیتابیس با نسخه‌ای که فقط تأخیر ثابت دارد؛ رجیستری اصلی برگردانده می‌شود."""
+    original = dict(crmbotrender.TOOL_REGISTRY)
+
+    def make_fake(name):
+        async def fake_tool(**kwargs):
+            global db_queries
+            db_queries += 1
+            await asyncio.sleep(db_latency)
+            return f"{name} ok"
+        return fake_tool
+
+    for name in original:
+        crmbotrender.TOOL_REGISTRY[name] = make_fake(name)
+    return original
+
+
+def count_real_queries() -> None:
+    """شمارش همه کوئری‌های psycopg (cursor.execute و COPY) در حالت دیتابیس واقعی."""
+    execute, copy = psycopg.AsyncCursor.execute, psycopg.AsyncCursor.copy
+
+    async def counted_execute(self, *args, **kwargs):
+        global db_queries
+        db_queries += 1
+        return await execute(self, *args, **kwargs)
+
+    def counted_copy(self, *args, **kwargs):
+        global db_queries
+        db_queries += 1
+        return copy(self, *args, **kwargs)
+
+    psycopg.AsyncCursor.execute = counted_execute
+    psycopg.AsyncCursor.copy = counted_copy
+
+
+async def setup_database(url: str) -> AsyncConnectionPool:
+    pool = AsyncConnectionPool(
+        url, min_size=2, max_size=crmbotrender.DB_POOL_MAX_SIZE, open=False,
+        kwargs={"autocommit": True, "options": f"-c search_path={BENCH_SCHEMA},public"},
+    )
+    await pool.open(wait=True)
+    async with pool.connection() as conn:
+        await conn.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE")
+        await conn.execute(f"CREATE SCHEMA {BENCH_SCHEMA}")
+        await crmbotrender.run_migrations(conn)
+        await conn.execute(
+            """
+            INSERT INTO customers (name, phone, company, industry, services)
+            SELECT 'مشتری ' || g, '09' || lpad(g::text, 9, '0'), 'شرکت ' || (g %% 50), 'حوزه ' || (g %% 12), 'خدمات'
+            FROM generate_series(1, %s) g
+            """,
+            (BENCH_CUSTOMERS,),
+        )
+    crmbotrender.db_pool = pool
+    return pool
+
+
+async def run_level(chats: int, turns: int, latency: float, base_chat_id: int) -> dict:
+    """یک سطح بار: chats کاربر هم‌زمان، هر کدام turns پیام پشت‌سرهم."""
+    crmbotrender.history_manager = crmbotrender.HistoryManager(
+        crmbotrender.HISTORY_MAX_CHATS, crmbotrender.HISTORY_GLOBAL_TOKEN_BUDGET, crmbotrender.create_history_store()
+    )
+    crmbotrender.response_cache.clear()
+    crmbotrender.fast_path_stats.clear()
+    client = FakeGenaiClient(models=ScriptedModels(latency, plan_for))
+    crmbotrender.ai_client = client
+    crmbotrender.load_genai()
+    bot = FakeBot()
+    chat_ids = range(base_chat_id, base_chat_id + chats)
+    contexts = {chat_id: make_context(bot) for chat_id in chat_ids}
+
+    gc.collect()
+    memory_before = tracemalloc.get_traced_memory()[0]
+
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        crmbotrender.start_command(make_update(bot, chat_id, "/start"), contexts[chat_id]) for chat_id in chat_ids
+    ))
+    start_seconds = time.perf_counter() - started
+
+    latencies = []
+    queries_before = db_queries
+
+    async def user(chat_id: int) -> None:
+        for turn in range(turns):
+            turn_started = time.perf_counter()
+            await crmbotrender.message_handler(make_update(bot, chat_id, f"bench {chat_id}-{turn}"), contexts[chat_id])
+            latencies.append(time.perf_counter() - turn_started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user(chat_id) for chat_id in chat_ids))
+    elapsed = time.perf_counter() - started
+
+    gc.collect()
+    memory_after = tracemalloc.get_traced_memory()[0]
+    total = chats * turns
+    return {
+        "chats": chats,
+        "turns": total,
+        "start_p50_ms": start_seconds / chats * 1000,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "msgs_per_s": total / elapsed,
+        "db_queries_per_turn": (db_queries - queries_before) / total,
+        "model_calls_per_turn": client.aio.models.calls / total,
+        "memory_kb_per_chat": (memory_after - memory_before) / chats / 1024,
+        "history_chats_in_memory": len(crmbotrender.history_manager._chats),
+    }
+
+
+async def run_reminders(pool: AsyncConnectionPool, count: int) -> dict:
+    """درج count یادآوری سررسیدشده و تخلیه آن‌ها از مسیر زمان‌بند -> صف ارسال -> ثبت وضعیت."""
+    async with pool.connection() as conn:
+        await conn.execute(
+            """
+            INSERT INTO reminders (chat_id, customer_name, reminder_text, due_date_time)
+            SELECT 500000 + g, 'مشتری ' || (1 + g %% %s), 'یادآوری بنچمارک ' || g, now() - interval '1 second'
+            FROM generate_series(1, %s) g
+            """,
+            (BENCH_CUSTOMERS, count),
+        )
+    bot = FakeBot()
+    crmbotrender.outbound_delivery = crmbotrender.OutboundDelivery(bot, global_rate=1e6, chat_rate=1e6)
+    crmbotrender.outbound_delivery.start()
+    scheduler = crmbotrender.ReminderScheduler(None)
+    started = time.perf_counter()
+    while True:
+        before = len(bot.sent)
+        await scheduler._dispatch_due()
+        await crmbotrender.outbound_delivery.join()
+        await crmbotrender.reminder_status_writer.flush()
+        if len(bot.sent) == before:
+            break
+    elapsed = time.perf_counter() - started
+    for task in list(crmbotrender._background_tasks):
+        task.cancel()
+    async with pool.connection() as conn:
+        cursor = await conn.execute("SELECT COUNT(*) FILTER (WHERE sent), MAX(sent_at - due_date_time) FROM reminders WHERE chat_id > 500000")
+        sent, max_lag = await cursor.fetchone()
+    return {"reminders": count, "sent": sent, "seconds": elapsed, "per_s": sent / elapsed if elapsed else 0.0,
+            "max_lag_s": max_lag.total_seconds() if max_lag else 0.0}
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--levels", default="10,100,1000", help="comma-separated concurrent chat counts")
+    parser.add_argument("--turns", type=int, default=3, help="messages sent by each chat")
+    parser.add_argument("--latency", type=float, default=0.2, help="fake model latency per call (s)")
+    parser.add_argument("--db-latency", type=float, default=0.005, help="simulated tool latency without a database (s)")
+    parser.add_argument("--reminders", type=int, default=1000, help="due reminders to drain (database mode only)")
+    parser.add_argument("--json", help="write results to this file for regression tracking")
+    parser.add_argument("--verbose", action="store_true", help="keep the bot's INFO logs")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.getLogger(crmbotrender.__name__).setLevel(logging.CRITICAL)
+
+    url = os.environ.get("BENCH_DATABASE_URL")
+    pool = None
+    if url:
+        count_real_queries()
+        pool = await setup_database(url)
+    else:
+        install_fake_tools(args.db_latency)
+
+    tracemalloc.start()
+    mode = "postgres" if pool else f"fake tools ({args.db_latency * 1000:.0f}ms)"
+    print(f"fake model latency={args.latency}s, GEMINI_MAX_CONCURRENCY={crmbotrender.GEMINI_MAX_CONCURRENCY}, "
+          f"db={mode}, history={crmbotrender.HISTORY_STORE}")
+    print(f"{'chats':>6} {'turns':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'msgs/s':>8} {'db q/turn':>9} "
+          f"{'KB/chat':>8} {'in mem':>6}")
+    results = {"mode": mode, "latency": args.latency, "levels": []}
+    try:
+        for index, level in enumerate(int(x) for x in args.levels.split(",")):
+            r = await run_level(level, args.turns, args.latency, base_chat_id=(index + 1) * 100_000)
+            results["levels"].append(r)
+            print(f"{r['chats']:>6} {r['turns']:>6} {r['p50_ms']:>8.1f} {r['p95_ms']:>8.1f} {r['p99_ms']:>8.1f} "
+                  f"{r['msgs_per_s']:>8.1f} {r['db_queries_per_turn']:>9.2f} {r['memory_kb_per_chat']:>8.1f} "
+                  f"{r['history_chats_in_memory']:>6}")
+        if pool is not None and args.reminders:
+            r = await run_reminders(pool, args.reminders)
+            results["reminders"] = r
+            print(f"\nreminders: {r['sent']}/{r['reminders']} sent in {r['seconds']:.2f}s "
+                  f"({r['per_s']:.0f}/s, max lag {r['max_lag_s']:.2f}s)")
+    finally:
+        if pool is not None:
+            async with pool.connection() as conn:
+                await conn.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE")
+            await pool.close()
+        shutil.rmtree(_history_dir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"\nresults written to {args.json}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,35 +1,346 @@
+import time
+# زمان شروع فرآیند، پیش از import کتابخانه‌ها (مبنای زمان‌بندی مراحل راه‌اندازی)
+PROCESS_STARTED = time.perf_counter()
 import os
 import logging
-from datetime import datetime
+from collections import Counter, OrderedDict, deque
+from dataclasses import dataclass
+from datetime import datetime, timedelta, time as dtime
 import json
+import multiprocessing
 import asyncio
-import psycopg2 
+import contextlib
+import contextvars
+import csv
+import gzip
+import hashlib
+import random
+import re
+import secrets
+import signal
+import sqlite3
+import heapq
+import inspect
+import functools
+import io
+import itertools
+import tempfile
+import threading
+import zlib
+from zoneinfo import ZoneInfo
+from concurrent.futures import ThreadPoolExecutor
+import psycopg
+from psycopg_pool import AsyncConnectionPool
 import pytz # اضافه شدن کتابخانه مدیریت منطقه زمانی
-from telegram import Update, ReplyKeyboardMarkup
+from telegram import Bot, Update, ReplyKeyboardMarkup, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.constants import ChatAction
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
 from telegram.ext import (
     Application,
     MessageHandler,
+    CallbackQueryHandler,
     filters,
     ContextTypes,
     CommandHandler,
 )
-from google import genai
-from google.genai import types
-from google.genai.errors import APIError
+try:
+    # در requirements.txt آمده است؛ بدون آن خروجی XLSX به CSV برمی‌گردد و ورود فایل XLSX پذیرفته نمی‌شود
+    import openpyxl
+except ImportError:
+    openpyxl = None
+# google-genai (همراه pydantic، httpx و google-auth) سنگین‌ترین import برنامه است؛
+# load_genai آن را هنگام ساخت کلاینت (در حالت webhook سریع، در پس‌زمینه) بارگذاری می‌کند
+genai = None
+types = None
+
+class APIError(Exception):
+    """جایگزین google.genai.errors.APIError تا پیش از بارگذاری SDK."""
+
+# --- شناسه همبستگی نوبت‌ها در لاگ‌ها ---
+# هر نوبت گفتگو شناسه‌ای دارد که به همه خطوط لاگ همان نوبت (از جمله توابع موازی) اضافه می‌شود
+turn_id_var = contextvars.ContextVar("turn_id", default="-")
+_default_record_factory = logging.getLogRecordFactory()
+
+def _record_with_turn_id(*args, **kwargs):
+    record = _default_record_factory(*args, **kwargs)
+    record.turn_id = turn_id_var.get()
+    return record
+
+logging.setLogRecordFactory(_record_with_turn_id)
 
 # --- تنظیمات لاگ‌گیری ---
 logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+    format="%(asctime)s - %(name)s - %(levelname)s - [%(turn_id)s] %(message)s", level=logging.INFO
 )
 logging.getLogger("httpx").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
+# =================================================================
+# --- متریک‌ها با قالب متنی Prometheus (بدون وابستگی خارجی) ---
+# =================================================================
+# پورت جداگانه برای /metrics (کنار پورت webhook)؛ خالی یعنی غیرفعال
+METRICS_PORT = os.environ.get("METRICS_PORT")
+# با 1 برای هر نوبت یک خط JSON شامل زمان گام‌های مدل و توابع لاگ می‌شود
+TRACE_TURNS = os.environ.get("TRACE_TURNS", "0") == "1"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+METRICS_REGISTRY = []
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    """پایه متریک‌ها؛ مقدارها بر اساس tuple برچسب‌ها نگه داشته می‌شوند.
+
+    collect (اختیاری) تابعی است که هنگام خواندن /metrics دیکشنری {tuple برچسب‌ها: مقدار} برمی‌گرداند.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labelnames=(), collect=None):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+        self._values = {}
+        METRICS_REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def samples(self):
+        values = self.collect() if self.collect is not None else self._values
+        for key, value in sorted(values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class CounterMetric(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class GaugeMetric(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        self._values[self._key(labels)] = value
+
+
+class HistogramMetric(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        entry = self._values.get(key)
+        if entry is None:
+            # شمارش هر bucket (غیرتجمعی)، جمع و تعداد
+            entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[0][index] += 1
+                break
+        entry[1] += value
+        entry[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        for key, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, 'le="%s"' % bound)
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, key, 'le="+Inf"')
+            yield f"{self.name}_bucket{labels} {count}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, key)} {count}"
+
+
+def render_metrics() -> str:
+    return "\n".join(metric.render() for metric in METRICS_REGISTRY) + "\n"
+
+
+TURN_SECONDS = HistogramMetric("crm_turn_seconds", "End-to-end latency of a chat turn", ["path"])
+GEMINI_SECONDS = HistogramMetric("crm_gemini_seconds", "Gemini call latency", ["call", "outcome"])
+GEMINI_FIRST_TEXT_SECONDS = HistogramMetric("crm_gemini_first_text_seconds", "Time from turn start to the first streamed text")
+TOOL_SECONDS = HistogramMetric("crm_tool_seconds", "Tool (DB) latency", ["tool"])
+TOOL_CALLS = CounterMetric("crm_tool_calls_total", "Tool invocations", ["tool", "status"])
+API_ERRORS = CounterMetric("crm_api_errors_total", "Errors surfaced to users", ["kind"])
+EXPORT_SECONDS = HistogramMetric("crm_export_seconds", "Export file build and upload latency", ["table", "format"])
+REMINDERS_DELIVERED = CounterMetric("crm_reminders_total", "Reminder deliveries by final status", ["status"])
+REMINDERS_LATE = CounterMetric("crm_reminders_late_total", "Reminders delivered later than REMINDER_LATE_SECONDS after due")
+REMINDER_LAG_SECONDS = HistogramMetric(
+    "crm_reminder_lag_seconds", "Reminder send time minus due_date_time", buckets=(0.5, 1, 2, 5, 10, 30, 60, 120, 300, 900)
+)
+REMINDER_LAST_LAG = GaugeMetric("crm_reminder_last_lag_seconds", "Lag of the most recently delivered reminder")
+FAST_PATH_TURNS = CounterMetric(
+    "crm_fast_path_turns_total", "Turns by route (llm means Gemini was called, response_cache a cached reply)", ["intent"],
+    collect=lambda: {(intent,): count for intent, count in fast_path_stats.items()}
+)
+HISTORY_CHATS = GaugeMetric("crm_history_chats", "Chat histories held in memory",
+                            collect=lambda: {(): len(history_manager._chats)})
+HISTORY_TOKENS = GaugeMetric("crm_history_tokens", "Estimated tokens held in chat histories",
+                             collect=lambda: {(): history_manager.total_tokens()})
+CACHE_ENTRIES = GaugeMetric("crm_cache_entries", "Entries per in-process cache", ["cache"],
+                            collect=lambda: {(name,): cache.stats()["size"] for name, cache in _metric_caches()})
+CACHE_HITS = CounterMetric("crm_cache_hits_total", "Cache hits", ["cache"],
+                           collect=lambda: {(name,): cache.hits for name, cache in _metric_caches()})
+CACHE_MISSES = CounterMetric("crm_cache_misses_total", "Cache misses", ["cache"],
+                             collect=lambda: {(name,): cache.misses for name, cache in _metric_caches()})
+UPDATES_ENQUEUED = CounterMetric("crm_updates_enqueued_total", "Updates stored in update_queue by the ingress")
+UPDATES_PROCESSED = CounterMetric("crm_updates_processed_total", "Queued updates processed by this worker")
+DIGESTS_SENT = CounterMetric("crm_followup_digests_total", "Daily follow-up digest messages queued")
+JOBS = CounterMetric("crm_jobs_total", "Background jobs by kind and final status", ["kind", "status"])
+JOB_SECONDS = HistogramMetric("crm_job_seconds", "Background job run time", ["kind"],
+                              buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+JOB_QUEUE = GaugeMetric("crm_job_queue_depth", "Background jobs waiting to run",
+                        collect=lambda: {(): job_runner._queue.qsize() if job_runner else 0})
+DELIVERY_QUEUE = GaugeMetric("crm_delivery_queue_depth", "Messages waiting in the outbound delivery queue",
+                             collect=lambda: {(): outbound_delivery.qsize() if outbound_delivery else 0})
+
+def _metric_caches():
+    return (("customer", customer_cache), ("report", report_cache), ("response", response_cache),
+            ("customer_miss", customer_miss_cache))
+
+
+# --- ردیابی ساخت‌یافته هر نوبت ---
+# رویدادهای نوبت جاری: (نوع، نام، ثانیه)؛ تسک‌های موازی توابع همان لیست را می‌بینند
+turn_trace_var = contextvars.ContextVar("turn_trace", default=None)
+
+def start_turn_trace(chat_id: int) -> None:
+    turn_id_var.set(f"{chat_id}-{secrets.token_hex(3)}")
+    turn_trace_var.set([] if TRACE_TURNS else None)
+
+def trace_event(kind: str, name: str, seconds: float) -> None:
+    events = turn_trace_var.get()
+    if events is not None:
+        events.append((kind, name, round(seconds, 4)))
+
+def log_turn_trace(chat_id: int, path: str, seconds: float) -> None:
+    events = turn_trace_var.get()
+    if events is None:
+        return
+    logger.info("TRACE " + json.dumps({
+        "turn_id": turn_id_var.get(), "chat_id": chat_id, "path": path, "seconds": round(seconds, 4),
+        "events": [{"kind": kind, "name": name, "seconds": secs} for kind, name, secs in events],
+    }, ensure_ascii=False))
+
+
+# --- زمان‌بندی مراحل راه‌اندازی (cold start) ---
+# مرحله -> ثانیه از شروع فرآیند (یا مدت خود مرحله برای کارهای هم‌زمان)
+startup_phases = {}
+
+def mark_startup_phase(phase: str, seconds: float = None) -> None:
+    if seconds is None:
+        seconds = time.perf_counter() - PROCESS_STARTED
+        logger.info(f"Startup: {phase} at {seconds:.2f}s after process start")
+    else:
+        logger.info(f"Startup: {phase} took {seconds:.2f}s")
+    startup_phases[phase] = seconds
+
+STARTUP_SECONDS = GaugeMetric("crm_startup_phase_seconds", "Startup phase timings (elapsed since process start or phase duration)",
+                              ["phase"], collect=lambda: {(phase,): seconds for phase, seconds in startup_phases.items()})
+
+
+# --- سرور HTTP کوچک (برای /metrics، ورودی webhook و بررسی سلامت) ---
+# سقف حجم بدنه درخواست (به‌روزرسانی‌های تلگرام چند کیلوبایت‌اند)
+HTTP_MAX_BODY = 1024 * 1024
+
+async def metrics_route(method: str, headers: dict, body: bytes):
+    return "200 OK", "text/plain; version=0.0.4; charset=utf-8", render_metrics()
+
+def _http_handler(routes: dict):
+    """ساخت handler برای asyncio.start_server؛ هر مسیر: async (method, headers, body) -> (status, content_type, text)."""
+    async def handle(reader, writer) -> None:
+        try:
+            request_line = (await asyncio.wait_for(reader.readline(), timeout=5)).decode("latin-1").split()
+            headers = {}
+            while True:
+                line = await asyncio.wait_for(reader.readline(), timeout=5)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            length = min(int(headers.get("content-length") or 0), HTTP_MAX_BODY)
+            body = await asyncio.wait_for(reader.readexactly(length), timeout=10) if length else b""
+            method = request_line[0] if request_line else ""
+            path = request_line[1].split("?", 1)[0] if len(request_line) >= 2 else ""
+            route = routes.get(path)
+            if route is None:
+                status, content_type, text = "404 Not Found", "text/plain", "not found\n"
+            else:
+                status, content_type, text = await route(method, headers, body)
+            payload = text.encode("utf-8")
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(payload)}\r\n"
+                f"Connection: close\r\n\r\n".encode("latin-1") + payload
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+    return handle
+
+async def start_http_server(port: int, routes: dict):
+    """باز کردن پورت و شروع پاسخ‌گویی؛ شیء server را برای بستن برمی‌گرداند."""
+    server = await asyncio.start_server(_http_handler(routes), "0.0.0.0", port)
+    logger.info(f"HTTP server listening on :{port} ({', '.join(routes)})")
+    return server
+
+async def serve_http(port: int, routes: dict) -> None:
+    """سرور HTTP روی پورت داده‌شده تا پایان برنامه."""
+    server = await start_http_server(port, routes)
+    async with server:
+        await server.serve_forever()
+
+async def serve_metrics(port: int) -> None:
+    await serve_http(port, {"/metrics": metrics_route})
+
+
 # =================================================================
 # --- متغیرهای حیاتی و محیطی ---
 TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN", "YOUR_TELEGRAM_BOT_TOKEN_HERE")
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY", "YOUR_API_KEY_HERE")
 DATABASE_URL = os.environ.get("DATABASE_URL")
+# سقف فراخوانی‌های هم‌زمان Gemini در کل فرآیند
+GEMINI_MAX_CONCURRENCY = int(os.environ.get("GEMINI_MAX_CONCURRENCY", "8"))
+# حداکثر تعداد دورهای «فراخوانی تابع -> پاسخ مدل» در یک نوبت گفتگو
+AGENT_MAX_STEPS = int(os.environ.get("AGENT_MAX_STEPS", "5"))
+# بودجه تاریخچه گفتگو: توکن هر چت، تعداد نوبت‌های کامل اخیر و سقف کل حافظه بین چت‌ها
+HISTORY_TOKEN_BUDGET = int(os.environ.get("HISTORY_TOKEN_BUDGET", "6000"))
+HISTORY_KEEP_TURNS = int(os.environ.get("HISTORY_KEEP_TURNS", "4"))
+HISTORY_MAX_CHATS = int(os.environ.get("HISTORY_MAX_CHATS", "500"))
+HISTORY_GLOBAL_TOKEN_BUDGET = int(os.environ.get("HISTORY_GLOBAL_TOKEN_BUDGET", "1000000"))
+# محل ذخیره پایدار تاریخچه: postgres (پیش‌فرض)، sqlite یا memory
+HISTORY_STORE = os.environ.get("HISTORY_STORE", "postgres").lower()
+HISTORY_SQLITE_PATH = os.environ.get("HISTORY_SQLITE_PATH", "crm_history.sqlite3")
 # متغیرهای Webhook/Render
 PORT = int(os.environ.get('PORT', '8000'))
 RENDER_EXTERNAL_URL = os.environ.get("RENDER_EXTERNAL_URL")
@@ -43,136 +354,574 @@ TODAY_DATE = datetime.now().strftime("%Y-%m-%d")
 IRAN_TZ = pytz.timezone('Asia/Tehran')
 
 # --- آماده‌سازی دیتابیس PostgreSQL ---
-db_connection = None
-
-def get_db_connection():
-    """اتصال به PostgreSQL با استفاده از DATABASE_URL."""
-    global db_connection
-    if db_connection is None or db_connection.closed != 0:
-        if not DATABASE_URL:
-            logger.error("DATABASE_URL is not set. Persistent memory is disabled.")
-            return None
-        try:
-            db_connection = psycopg2.connect(DATABASE_URL, sslmode='require')
-            db_connection.autocommit = True
-            logger.info("PostgreSQL Connection Established Successfully.")
-        except Exception as e:
-            logger.error(f"Failed to connect to PostgreSQL: {e}")
-            db_connection = None
-    return db_connection
-
-def init_db():
-    """ایجاد جداول در دیتابیس PostgreSQL در صورت عدم وجود."""
-    conn = get_db_connection()
-    if conn is None:
+# استخر اتصال async؛ هر فراخوانی یک اتصال می‌گیرد و پس از پایان کار آن را پس می‌دهد
+DB_POOL_MIN_SIZE = int(os.environ.get("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "10"))
+db_pool = None
+_db_pool_lock = asyncio.Lock()
+
+async def get_db_pool():
+    """برگرداندن استخر اتصال PostgreSQL (در اولین فراخوانی ساخته و باز می‌شود)."""
+    global db_pool
+    if db_pool is not None:
+        return db_pool
+    if not DATABASE_URL:
+        logger.error("DATABASE_URL is not set. Persistent memory is disabled.")
+        return None
+    async with _db_pool_lock:
+        if db_pool is None:
+            pool = AsyncConnectionPool(
+                DATABASE_URL,
+                min_size=DB_POOL_MIN_SIZE,
+                max_size=DB_POOL_MAX_SIZE,
+                timeout=DB_POOL_TIMEOUT,
+                kwargs={"sslmode": "require", "autocommit": True},
+                # قبل از تحویل هر اتصال، سالم بودن آن بررسی می‌شود
+                check=AsyncConnectionPool.check_connection,
+                open=False,
+            )
+            try:
+                await pool.open(wait=True, timeout=DB_POOL_TIMEOUT)
+                db_pool = pool
+                logger.info(f"PostgreSQL Connection Pool Established Successfully (min={DB_POOL_MIN_SIZE}, max={DB_POOL_MAX_SIZE}).")
+            except Exception as e:
+                logger.error(f"Failed to connect to PostgreSQL: {e}")
+                await pool.close()
+    return db_pool
+
+async def close_db_pool():
+    """بستن استخر اتصال هنگام خاموش شدن ربات."""
+    global db_pool
+    if db_pool is not None:
+        await db_pool.close()
+        db_pool = None
+        logger.info("PostgreSQL Connection Pool Closed.")
+
+# --- دریافت رویدادهای LISTEN/NOTIFY از PostgreSQL ---
+# کانال اعلان ثبت یادآوری جدید (payload: "<id>,<epoch زمان سررسید>")
+REMINDERS_CHANNEL = "crm_reminders"
+
+class PgListener:
+    """اتصال اختصاصی LISTEN که اعلان‌های کانال‌های ثبت‌شده را به callbackها می‌رساند."""
+
+    def __init__(self):
+        self._callbacks = {}
+        self._connect_callbacks = []
+
+    def subscribe(self, channel: str, callback) -> None:
+        if callback not in self._callbacks.get(channel, []):
+            self._callbacks.setdefault(channel, []).append(callback)
+
+    def on_connect(self, callback) -> None:
+        """callback پس از هر اتصال (و اتصال مجدد)؛ برای جبران اعلان‌هایی که در زمان قطع بودن از دست رفته‌اند."""
+        if callback not in self._connect_callbacks:
+            self._connect_callbacks.append(callback)
+
+    async def run(self) -> None:
+        """حلقه دریافت اعلان‌ها؛ در صورت قطع اتصال دوباره وصل می‌شود."""
+        while True:
+            try:
+                conn = await psycopg.AsyncConnection.connect(DATABASE_URL, sslmode='require', autocommit=True)
+                async with conn:
+                    for channel in self._callbacks:
+                        await conn.execute(f"LISTEN {channel}")
+                    logger.info(f"PostgreSQL listener subscribed to: {', '.join(self._callbacks)}")
+                    for callback in self._connect_callbacks:
+                        callback()
+                    async for notify in conn.notifies():
+                        for callback in self._callbacks.get(notify.channel, []):
+                            try:
+                                callback(notify.payload)
+                            except Exception as e:
+                                logger.error(f"Error handling notification on {notify.channel}: {e}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"PostgreSQL listener disconnected: {e}. Reconnecting in 5s.")
+                await asyncio.sleep(5)
+
+pg_listener = PgListener()
+
+# --- مهاجرت‌های نسخه‌دار اسکیمای دیتابیس ---
+# یکسان‌سازی متن برای جستجوی متن کامل: ی/ک عربی، ة و ۀ، همزه‌دارها، ارقام فارسی/عربی و نیم‌فاصله؛
+# حرکت‌ها و کشیده (کاراکترهای انتهای FROM بدون معادل در TO) حذف می‌شوند
+FA_NORMALIZE_FROM = (
+    "\u064a\u0649\u0643\u0629\u06c0\u0623\u0625\u0622\u0624" "۰۱۲۳۴۵۶۷۸۹" "٠١٢٣٤٥٦٧٨٩" "\u200c"
+    "\u064b\u064c\u064d\u064e\u064f\u0650\u0651\u0652\u0670\u0640"
+)
+FA_NORMALIZE_TO = "\u06cc\u06cc\u06a9\u0647\u0647\u0627\u0627\u0627\u0648" "0123456789" "0123456789" " "
+# یکسان‌سازی نام‌ها برای جستجوی دقیق مشتری (همان normalize_lookup_key، در پایتون و تابع crm_name_key دیتابیس)
+NAME_KEY_FROM = "\u064a\u0649\u0643\u200c"
+NAME_KEY_TO = "\u06cc\u06cc\u06a9 "
+# متن قابل جستجوی هر تعامل: نام مشتری (وزن A) و متن گزارش (وزن B)
+INTERACTION_TSV_SQL = """
+    setweight(to_tsvector('simple', crm_normalize_fa(coalesce({row}customer_name, ''))), 'A')
+    || setweight(to_tsvector('simple', crm_normalize_fa(coalesce({row}report, ''))), 'B')
+"""
+
+# هر مهاجرت: (نسخه، توضیح، لیست دستورات SQL). مهاجرت‌ها فقط اضافه می‌شوند و هرگز ویرایش نمی‌شوند.
+SCHEMA_MIGRATIONS = [
+    (1, "base tables", [
+        # ۱. جدول مشتریان
+        """
+        CREATE TABLE IF NOT EXISTS customers (
+            id SERIAL PRIMARY KEY,
+            name VARCHAR(255) NOT NULL,
+            phone VARCHAR(50) UNIQUE,
+            company VARCHAR(255),
+            industry VARCHAR(255),
+            services TEXT
+        );
+        """,
+        # ۲. جدول تعاملات
+        """
+        CREATE TABLE IF NOT EXISTS interactions (
+            id SERIAL PRIMARY KEY,
+            customer_name VARCHAR(255) NOT NULL, 
+            interaction_date DATE,
+            report TEXT,
+            follow_up_date DATE
+        );
+        """,
+        # ۳. جدول هشدارها - نوع ستون زمان باید بتواند زمان با منطقه زمانی را ذخیره کند
+        """
+        CREATE TABLE IF NOT EXISTS reminders (
+            id SERIAL PRIMARY KEY,
+            chat_id BIGINT,
+            customer_name VARCHAR(255),
+            reminder_text TEXT,
+            due_date_time TIMESTAMP WITH TIME ZONE, -- اصلاح شده برای پشتیبانی از Timezone
+            sent BOOLEAN DEFAULT FALSE
+        );
+        """,
+    ]),
+    (2, "customer foreign keys, trigram and partial indexes", [
+        "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+        "ALTER TABLE interactions ADD COLUMN IF NOT EXISTS customer_id INTEGER",
+        "ALTER TABLE reminders ADD COLUMN IF NOT EXISTS customer_id INTEGER",
+        # پر کردن customer_id ردیف‌های موجود از روی نام (در صورت نام تکراری، قدیمی‌ترین مشتری)
+        """
+        UPDATE interactions i SET customer_id = c.id
+        FROM (SELECT lower(name) AS name_key, MIN(id) AS id FROM customers GROUP BY lower(name)) c
+        WHERE i.customer_id IS NULL AND lower(i.customer_name) = c.name_key
+        """,
+        """
+        UPDATE reminders r SET customer_id = c.id
+        FROM (SELECT lower(name) AS name_key, MIN(id) AS id FROM customers GROUP BY lower(name)) c
+        WHERE r.customer_id IS NULL AND lower(r.customer_name) = c.name_key
+        """,
+        """
+        ALTER TABLE interactions ADD CONSTRAINT interactions_customer_id_fkey
+            FOREIGN KEY (customer_id) REFERENCES customers (id) ON DELETE CASCADE
+        """,
+        """
+        ALTER TABLE reminders ADD CONSTRAINT reminders_customer_id_fkey
+            FOREIGN KEY (customer_id) REFERENCES customers (id) ON DELETE CASCADE
+        """,
+        "CREATE INDEX IF NOT EXISTS interactions_customer_id_idx ON interactions (customer_id, interaction_date DESC)",
+        "CREATE INDEX IF NOT EXISTS reminders_customer_id_idx ON reminders (customer_id)",
+        # ILIKE روی نام و حوزه فعالیت (با یا بدون %) از ایندکس trigram استفاده می‌کند
+        "CREATE INDEX IF NOT EXISTS customers_name_trgm_idx ON customers USING gin (name gin_trgm_ops)",
+        "CREATE INDEX IF NOT EXISTS customers_industry_trgm_idx ON customers USING gin (industry gin_trgm_ops)",
+        "CREATE INDEX IF NOT EXISTS reminders_due_unsent_idx ON reminders (due_date_time) WHERE sent = FALSE",
+    ]),
+    (3, "reminder claim and sent timestamps", [
+        "ALTER TABLE reminders ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMP WITH TIME ZONE",
+        "ALTER TABLE reminders ADD COLUMN IF NOT EXISTS sent_at TIMESTAMP WITH TIME ZONE",
+    ]),
+    (4, "reminder delivery status", [
+        "ALTER TABLE reminders ADD COLUMN IF NOT EXISTS delivery_status VARCHAR(20) NOT NULL DEFAULT 'pending'",
+        "ALTER TABLE reminders ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE reminders ADD COLUMN IF NOT EXISTS last_error TEXT",
+        "UPDATE reminders SET delivery_status = 'sent' WHERE sent = TRUE",
+    ]),
+    (5, "persistent conversation history", [
+        """
+        CREATE TABLE IF NOT EXISTS chat_history_turns (
+            chat_id BIGINT NOT NULL,
+            seq INTEGER NOT NULL,
+            payload BYTEA NOT NULL,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT now(),
+            PRIMARY KEY (chat_id, seq)
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS chat_history_state (
+            chat_id BIGINT PRIMARY KEY,
+            summary TEXT NOT NULL DEFAULT '',
+            first_seq INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP WITH TIME ZONE DEFAULT now()
+        );
+        """,
+    ]),
+    (6, "update queue for scale-out workers", [
+        """
+        CREATE TABLE IF NOT EXISTS update_queue (
+            id BIGSERIAL PRIMARY KEY,
+            chat_id BIGINT NOT NULL,
+            worker_partition INTEGER NOT NULL,
+            payload JSONB NOT NULL,
+            received_at TIMESTAMP WITH TIME ZONE DEFAULT now(),
+            claimed_at TIMESTAMP WITH TIME ZONE
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS update_queue_partition_idx ON update_queue (worker_partition, id)",
+    ]),
+    (7, "full-text search on interaction reports", [
+        f"""
+        CREATE OR REPLACE FUNCTION crm_normalize_fa(input TEXT) RETURNS TEXT
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE
+        AS $$ SELECT translate(lower(input), '{FA_NORMALIZE_FROM}', '{FA_NORMALIZE_TO}') $$
+        """,
+        "ALTER TABLE interactions ADD COLUMN IF NOT EXISTS report_tsv tsvector",
+        f"""
+        CREATE OR REPLACE FUNCTION interactions_report_tsv_update() RETURNS trigger
+        LANGUAGE plpgsql
+        AS $$
+        BEGIN
+            NEW.report_tsv := {INTERACTION_TSV_SQL.format(row="NEW.")};
+            RETURN NEW;
+        END
+        $$
+        """,
+        "DROP TRIGGER IF EXISTS interactions_report_tsv_trigger ON interactions",
+        """
+        CREATE TRIGGER interactions_report_tsv_trigger
+            BEFORE INSERT OR UPDATE OF report, customer_name ON interactions
+            FOR EACH ROW EXECUTE FUNCTION interactions_report_tsv_update()
+        """,
+        f"UPDATE interactions SET report_tsv = {INTERACTION_TSV_SQL.format(row='')}",
+        "CREATE INDEX IF NOT EXISTS interactions_report_tsv_idx ON interactions USING gin (report_tsv)",
+    ]),
+    (8, "daily follow-up digests", [
+        # کاربری که تعامل را ثبت کرده و خلاصه پیگیری‌هایش را دریافت می‌کند
+        "ALTER TABLE interactions ADD COLUMN IF NOT EXISTS chat_id BIGINT",
+        "CREATE INDEX IF NOT EXISTS interactions_follow_up_idx ON interactions (follow_up_date) WHERE follow_up_date IS NOT NULL",
+        """
+        CREATE TABLE IF NOT EXISTS followup_digests (
+            chat_id BIGINT NOT NULL,
+            digest_date DATE NOT NULL,
+            due_count INTEGER NOT NULL,
+            overdue_count INTEGER NOT NULL,
+            body TEXT NOT NULL,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT now(),
+            PRIMARY KEY (chat_id, digest_date)
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS followup_digest_runs (
+            digest_date DATE PRIMARY KEY,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT now()
+        );
+        """,
+    ]),
+    (9, "reminder delivery retries", [
+        # تعداد دورهای ناموفق ارسال و زمان تلاش بعدی (delivery_status: pending / sending / retry / sent / failed)
+        "ALTER TABLE reminders ADD COLUMN IF NOT EXISTS failures INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE reminders ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMP WITH TIME ZONE",
+    ]),
+    (10, "normalized customer name lookups", [
+        # نام‌هایی که فقط در ی/ک عربی، نیم‌فاصله، فاصله‌ها یا بزرگی حروف فرق دارند یک مشتری‌اند (مثل کلید کش‌ها)
+        f"""
+        CREATE OR REPLACE FUNCTION crm_name_key(input TEXT) RETURNS TEXT
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE
+        AS $$ SELECT btrim(regexp_replace(translate(lower(input), '{NAME_KEY_FROM}', '{NAME_KEY_TO}'), '\\s+', ' ', 'g')) $$
+        """,
+        "CREATE INDEX IF NOT EXISTS customers_name_key_idx ON customers (crm_name_key(name))",
+        # ردیف‌های قدیمی که در backfill به مشتری‌ای وصل نشدند هنگام حذف مشتری با نامشان پیدا می‌شوند
+        "CREATE INDEX IF NOT EXISTS interactions_orphan_name_idx ON interactions (crm_name_key(customer_name)) WHERE customer_id IS NULL",
+        "CREATE INDEX IF NOT EXISTS reminders_orphan_name_idx ON reminders (crm_name_key(customer_name)) WHERE customer_id IS NULL",
+    ]),
+]
+# شناسه قفل advisory برای جلوگیری از اجرای هم‌زمان مهاجرت‌ها در چند نمونه ربات
+MIGRATION_LOCK_ID = 48151623
+
+async def run_migrations(conn, target_version: int = None) -> int:
+    """اعمال مهاجرت‌های اجرا نشده، هر کدام در یک تراکنش؛ نسخه نهایی اسکیما را برمی‌گرداند."""
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP WITH TIME ZONE DEFAULT now()
+        );
+    """)
+    await conn.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+    try:
+        cursor = await conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+        current = (await cursor.fetchone())[0]
+        
+        for version, description, statements in SCHEMA_MIGRATIONS:
+            if version <= current or (target_version is not None and version > target_version):
+                continue
+            started = time.perf_counter()
+            async with conn.transaction():
+                for statement in statements:
+                    await conn.execute(statement)
+                await conn.execute(
+                    "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                    (version, description)
+                )
+            current = version
+            logger.info(f"Applied schema migration {version} ({description}) in {time.perf_counter() - started:.2f}s")
+        return current
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+
+async def stored_schema_version(conn) -> int:
+    """آخرین نسخه ثبت‌شده اسکیما (۰ اگر جدول schema_migrations هنوز وجود ندارد)."""
+    try:
+        cursor = await conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+        return (await cursor.fetchone())[0]
+    except psycopg.errors.UndefinedTable:
+        return 0
+
+async def init_db():
+    """ایجاد یا به‌روزرسانی جداول دیتابیس PostgreSQL با اجرای مهاجرت‌های باقی‌مانده."""
+    pool = await get_db_pool()
+    if pool is None:
         return False
     try:
-        with conn.cursor() as cursor:
-            # ۱. جدول مشتریان
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS customers (
-                    id SERIAL PRIMARY KEY,
-                    name VARCHAR(255) NOT NULL,
-                    phone VARCHAR(50) UNIQUE,
-                    company VARCHAR(255),
-                    industry VARCHAR(255),
-                    services TEXT
-                );
-            """)
-            # ۲. جدول تعاملات
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS interactions (
-                    id SERIAL PRIMARY KEY,
-                    customer_name VARCHAR(255) NOT NULL, 
-                    interaction_date DATE,
-                    report TEXT,
-                    follow_up_date DATE
-                );
-            """)
-            # ۳. جدول هشدارها - نوع ستون زمان باید بتواند زمان با منطقه زمانی را ذخیره کند
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS reminders (
-                    id SERIAL PRIMARY KEY,
-                    chat_id BIGINT,
-                    customer_name VARCHAR(255),
-                    reminder_text TEXT,
-                    due_date_time TIMESTAMP WITH TIME ZONE, -- اصلاح شده برای پشتیبانی از Timezone
-                    sent BOOLEAN DEFAULT FALSE
-                );
-            """)
-            logger.info("PostgreSQL Tables Initialized Successfully. Persistent memory is now ON.")
+        async with pool.connection() as conn:
+            # در راه‌اندازی‌های عادی اسکیما به‌روز است؛ یک SELECT به‌جای DDL و قفل مهاجرت
+            version = await stored_schema_version(conn)
+            if version < SCHEMA_MIGRATIONS[-1][0]:
+                version = await run_migrations(conn)
+            logger.info(f"PostgreSQL Tables Initialized Successfully (schema version {version}). Persistent memory is now ON.")
             return True
     except Exception as e:
         logger.error(f"Error initializing PostgreSQL tables: {e}")
         return False
 
+# --- کش درون‌فرآیندی رکورد مشتریان و گزارش‌های full_customer ---
+CACHE_TTL_SECONDS = float(os.environ.get("CACHE_TTL_SECONDS", "300"))
+CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES", "1000"))
+# در حالت چند نمونه‌ای، invalidation از طریق NOTIFY به نمونه‌های دیگر هم اعلام می‌شود؛
+# در BOT_MODE=worker/cluster (چند فرآیند با کش‌های جدا) همیشه فعال است تا پاسخ کهنه از کش داده نشود
+CACHE_NOTIFY_INVALIDATION = os.environ.get("CACHE_NOTIFY_INVALIDATION", "0") == "1" \
+    or os.environ.get("BOT_MODE", "single").lower() in ("worker", "cluster")
+CACHE_CHANNEL = "crm_cache_invalidate"
+
+_ARABIC_TO_PERSIAN = str.maketrans(NAME_KEY_FROM, NAME_KEY_TO)
+
+def normalize_lookup_key(text: str) -> str:
+    """کلید نرمال‌شده نام یا عبارت: حروف کوچک، فاصله‌های یکسان و یکسان‌سازی ی/ک عربی و فارسی (معادل crm_name_key)."""
+    return " ".join(str(text or "").translate(_ARABIC_TO_PERSIAN).lower().split())
+
+
+class TTLCache:
+    """کش LRU با زمان انقضا برای هر ورودی و شمارنده‌های hit/miss."""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value) -> None:
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key) -> None:
+        self._data.pop(key, None)
+
+    def invalidate_where(self, predicate) -> None:
+        for key in [key for key in self._data if predicate(key)]:
+            del self._data[key]
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 3) if total else 0.0}
+
+
+# کلید: (نام نرمال‌شده، تلفن) -> ردیف مشتری
+customer_cache = TTLCache(CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS)
+# کلید: نام نرمال‌شده -> متن گزارش full_customer
+report_cache = TTLCache(CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS)
+# پاسخ نهایی نوبت‌های فقط‌خواندنی (تنها get_report)؛ کلید شامل data_version است و با هر نوشتن کهنه می‌شود
+RESPONSE_CACHE_TTL_SECONDS = float(os.environ.get("RESPONSE_CACHE_TTL_SECONDS", "600"))
+# با 1 پاسخ‌ها بین چت‌ها مشترک می‌شوند؛ پیش‌فرض هر چت کش خودش را دارد (پرسش‌ها ممکن است به گفتگو وابسته باشند)
+RESPONSE_CACHE_SHARED = os.environ.get("RESPONSE_CACHE_SHARED", "0") == "1"
+response_cache = TTLCache(CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL_SECONDS)
+# شماره نسخه داده‌ها؛ توابع نوشتن آن را افزایش می‌دهند
+data_version = 0
+
+def bump_data_version() -> None:
+    global data_version
+    data_version += 1
+
+def response_cache_key(chat_id: int, user_text: str, version: int):
+    return (None if RESPONSE_CACHE_SHARED else chat_id, normalize_lookup_key(user_text).strip(" .!؟?"), version)
+
+# نام‌هایی که اخیراً مشتری نبوده‌اند (مسیر سریع؛ تا پیام‌های کوتاه عادی هر بار به دیتابیس نروند)
+customer_miss_cache = TTLCache(CACHE_MAX_ENTRIES, 60)
+
+def _drop_cached_customers(keys: set) -> None:
+    customer_cache.invalidate_where(lambda key: key[0] in keys)
+    for key in keys:
+        report_cache.invalidate(key)
+        customer_miss_cache.invalidate(key)
+
+async def invalidate_customer_cache(*names) -> None:
+    """حذف رکورد و گزارش کش‌شده مشتری‌ها پس از هر نوشتن (و اعلام به نمونه‌های دیگر در صورت فعال بودن)."""
+    bump_data_version()
+    keys = {normalize_lookup_key(name) for name in names if name}
+    if not keys:
+        return
+    _drop_cached_customers(keys)
+    if CACHE_NOTIFY_INVALIDATION:
+        pool = await get_db_pool()
+        if pool is None:
+            return
+        try:
+            async with pool.connection() as conn:
+                await conn.execute("SELECT pg_notify(%s, %s)", (CACHE_CHANNEL, json.dumps(sorted(keys), ensure_ascii=False)))
+        except Exception as e:
+            logger.warning(f"Failed to broadcast cache invalidation: {e}")
+
+async def invalidate_all_customer_caches() -> None:
+    """پاک کردن کامل کش‌های مشتری (پس از تغییرات دسته‌ای مانند ورود فایل)."""
+    bump_data_version()
+    _clear_customer_caches()
+    if CACHE_NOTIFY_INVALIDATION:
+        pool = await get_db_pool()
+        if pool is None:
+            return
+        try:
+            async with pool.connection() as conn:
+                await conn.execute("SELECT pg_notify(%s, %s)", (CACHE_CHANNEL, json.dumps("*")))
+        except Exception as e:
+            logger.warning(f"Failed to broadcast cache invalidation: {e}")
+
+def _clear_customer_caches() -> None:
+    customer_cache.clear()
+    report_cache.clear()
+    customer_miss_cache.clear()
+
+def on_cache_listener_connect() -> None:
+    """اعلان‌های invalidation در زمان قطع بودن LISTEN از دست رفته‌اند؛ کل کش‌های این نمونه پاک می‌شود."""
+    bump_data_version()
+    _clear_customer_caches()
+
+def enable_cache_invalidation_listener() -> None:
+    """دریافت invalidation نمونه‌های دیگر از CACHE_CHANNEL (تکرار فراخوانی بی‌اثر است)."""
+    pg_listener.subscribe(CACHE_CHANNEL, on_cache_invalidation_notify)
+    pg_listener.on_connect(on_cache_listener_connect)
+
+def on_cache_invalidation_notify(payload: str) -> None:
+    """callback کانال CACHE_CHANNEL؛ حذف همان کلیدها (یا با "*" کل کش) از کش این نمونه."""
+    bump_data_version()
+    keys = json.loads(payload)
+    if keys == "*":
+        _clear_customer_caches()
+    else:
+        _drop_cached_customers(set(keys))
+
 # --- توابع (Functions) که هوش مصنوعی به آنها دسترسی دارد (Tools) ---
 
 # ... (توابع find_customer_data, delete_customer, manage_customer_data, log_interaction بدون تغییر) ...
 
-def find_customer_data(name: str, phone: str = None):
-    """جستجوی مشتری بر اساس نام و/یا تلفن و بازگرداندن داده‌ها."""
-    conn = get_db_connection()
-    if conn is None: return None
+# ستون‌های ردیف مشتری به همین ترتیب (ایندکس‌های customer[0..5] در توابع زیر)
+CUSTOMER_COLUMNS = "id, name, phone, company, industry, services"
+
+async def find_customer_data(name: str, phone: str = None):
+    """جستجوی مشتری بر اساس نام و/یا تلفن و بازگرداندن داده‌ها (ابتدا از کش)."""
+    cache_key = (normalize_lookup_key(name), (phone or "").strip())
+    cached = customer_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
+    pool = await get_db_pool()
+    if pool is None: return None
     try:
-        with conn.cursor() as cursor:
+        async with pool.connection() as conn, conn.cursor() as cursor:
+            result = None
             # ابتدا با نام و تلفن جستجو
             if phone:
-                cursor.execute("SELECT * FROM customers WHERE name ILIKE %s AND phone = %s", (name, phone))
-                result = cursor.fetchone()
-                if result: return result
+                await cursor.execute(f"SELECT {CUSTOMER_COLUMNS} FROM customers WHERE crm_name_key(name) = crm_name_key(%s) AND phone = %s", (name, phone))
+                result = await cursor.fetchone()
             
             # در غیر این صورت، فقط با نام جستجو
-            cursor.execute("SELECT * FROM customers WHERE name ILIKE %s", (name,))
-            return cursor.fetchone()
+            if not result:
+                await cursor.execute(f"SELECT {CUSTOMER_COLUMNS} FROM customers WHERE crm_name_key(name) = crm_name_key(%s) ORDER BY id LIMIT 1", (name,))
+                result = await cursor.fetchone()
+        # نتیجه منفی کش نمی‌شود تا مشتری تازه ثبت‌شده فوراً پیدا شود
+        if result:
+            customer_cache.set(cache_key, result)
+        return result
     except Exception as e:
         logger.error(f"Error finding customer: {e}")
         return None
         
-def delete_customer(name: str, phone: str = None) -> str:
+async def delete_customer(name: str, phone: str = None) -> str:
     """حذف یک مشتری و گزارشات تعامل مرتبط با او."""
-    conn = get_db_connection()
-    if conn is None:
+    pool = await get_db_pool()
+    if pool is None:
         return "خطا: سرویس حافظه دائمی (PostgreSQL) فعال نیست."
 
-    customer = find_customer_data(name, phone)
+    customer = await find_customer_data(name, phone)
     
     if not customer:
         return f"خطا: مشتری با نام '{name}' در دیتابیس پیدا نشد."
         
     try:
-        with conn.cursor() as cursor:
+        async with pool.connection() as conn, conn.cursor() as cursor:
             customer_name = customer[1] 
             customer_id = customer[0]
 
-            # حذف تعاملات مرتبط
-            cursor.execute("DELETE FROM interactions WHERE customer_name = %s", (customer_name,))
-            deleted_interactions = cursor.rowcount
-            
-            # حذف یادآوری‌های مرتبط
-            cursor.execute("DELETE FROM reminders WHERE customer_name = %s", (customer_name,))
-            deleted_reminders = cursor.rowcount
-
-            # حذف مشتری اصلی
-            cursor.execute("DELETE FROM customers WHERE id = %s", (customer_id,))
+            # حذف مشتری، تعاملات و یادآوری‌های مرتبط در یک دستور؛ ردیف‌های قدیمی بدون customer_id با نام حذف می‌شوند
+            await cursor.execute("""
+                WITH deleted_interactions AS (
+                    DELETE FROM interactions
+                    WHERE customer_id = %(id)s OR (customer_id IS NULL AND crm_name_key(customer_name) = crm_name_key(%(name)s))
+                    RETURNING 1
+                ), deleted_reminders AS (
+                    DELETE FROM reminders
+                    WHERE customer_id = %(id)s OR (customer_id IS NULL AND crm_name_key(customer_name) = crm_name_key(%(name)s))
+                    RETURNING 1
+                ), deleted_customer AS (
+                    DELETE FROM customers WHERE id = %(id)s RETURNING 1
+                )
+                SELECT (SELECT COUNT(*) FROM deleted_interactions), (SELECT COUNT(*) FROM deleted_reminders)
+            """, {"id": customer_id, "name": customer_name})
+            deleted_interactions, deleted_reminders = await cursor.fetchone()
+            await invalidate_customer_cache(name, customer_name)
 
             return f"مشتری '{customer_name}' با موفقیت حذف شد. ({deleted_interactions} گزارش تعامل و {deleted_reminders} یادآوری نیز حذف شدند.)"
     except Exception as e:
         return f"خطای دیتابیس در حذف مشتری: {e}"
 
 
-def manage_customer_data(name: str, phone: str, company: str = None, industry: str = None, services: str = None) -> str:
+async def manage_customer_data(name: str, phone: str, company: str = None, industry: str = None, services: str = None) -> str:
     """ثبت مشتری جدید یا به‌روزرسانی اطلاعات مشتری موجود."""
-    conn = get_db_connection()
-    if conn is None:
+    pool = await get_db_pool()
+    if pool is None:
         return "خطا: سرویس حافظه دائمی (PostgreSQL) فعال نیست."
     if not name or not phone:
         return "خطا: نام و شماره تلفن برای ثبت یا به‌روزرسانی مشتری الزامی هستند."
 
-    existing = find_customer_data(name, phone)
+    existing = await find_customer_data(name, phone)
     
     try:
-        with conn.cursor() as cursor:
+        async with pool.connection() as conn, conn.cursor() as cursor:
             if existing:
                 # به‌روزرسانی مشتری موجود
                 updates = []
@@ -185,53 +934,57 @@ def manage_customer_data(name: str, phone: str, company: str = None, industry: s
                 if updates:
                     query = f"UPDATE customers SET {', '.join(updates)} WHERE id = %s"
                     params.append(existing[0])
-                    cursor.execute(query, tuple(params))
+                    await cursor.execute(query, tuple(params))
+                    await invalidate_customer_cache(name, existing[1])
                     return f"اطلاعات مشتری '{name}' با موفقیت به‌روزرسانی شد."
                 else:
                     return f"مشتری '{name}' قبلاً ثبت شده و اطلاعات جدیدی برای به‌روزرسانی وجود نداشت."
             else:
                 # ثبت مشتری جدید
-                cursor.execute(
+                await cursor.execute(
                     "INSERT INTO customers (name, phone, company, industry, services) VALUES (%s, %s, %s, %s, %s) RETURNING id",
                     (name, phone, company, industry, services)
                 )
-                new_id = cursor.fetchone()[0]
+                new_id = (await cursor.fetchone())[0]
+                await invalidate_customer_cache(name)
                 return f"عملیات ثبت مشتری موفق بود. مشتری '{name}' (ID: {new_id}) با موفقیت ثبت شد."
-    except psycopg2.Error as e:
-        if e.pgcode == '23505': # خطای Unique Violation (شماره تلفن تکراری)
+    except psycopg.Error as e:
+        if e.sqlstate == '23505': # خطای Unique Violation (شماره تلفن تکراری)
             return f"خطا: شماره تلفن '{phone}' قبلاً برای مشتری دیگری ثبت شده است."
         return f"خطای دیتابیس در ثبت مشتری: {e}"
     except Exception as e:
         return f"خطای ناشناخته در ثبت مشتری: {e}"
 
-def log_interaction(customer_name: str, interaction_report: str, follow_up_date: str = None) -> str:
-    """ثبت گزارش تماس یا تعامل جدید با یک مشتری موجود."""
-    conn = get_db_connection()
-    if conn is None:
+async def log_interaction(customer_name: str, interaction_report: str, follow_up_date: str = None, chat_id: int = None) -> str:
+    """ثبت گزارش تماس یا تعامل جدید با یک مشتری موجود؛ پیگیری‌ها در خلاصه روزانه همان chat_id می‌آیند."""
+    pool = await get_db_pool()
+    if pool is None:
         return "خطا: سرویس حافظه دائمی (PostgreSQL) فعال نیست."
         
-    customer = find_customer_data(customer_name)
+    customer = await find_customer_data(customer_name)
     
     if not customer:
         return f"خطا: مشتری با نام '{customer_name}' در دیتابیس پیدا نشد. لطفا ابتدا او را ثبت کنید."
 
     try:
-        with conn.cursor() as cursor:
-            cursor.execute(
-                "INSERT INTO interactions (customer_name, interaction_date, report, follow_up_date) VALUES (%s, %s, %s, %s) RETURNING id",
-                (customer_name, TODAY_DATE, interaction_report, follow_up_date)
+        async with pool.connection() as conn, conn.cursor() as cursor:
+            await cursor.execute(
+                "INSERT INTO interactions (customer_id, customer_name, interaction_date, report, follow_up_date, chat_id) VALUES (%s, %s, %s, %s, %s, %s) RETURNING id",
+                (customer[0], customer_name, TODAY_DATE, interaction_report, follow_up_date, chat_id)
             )
-            new_id = cursor.fetchone()[0]
+            new_id = (await cursor.fetchone())[0]
+            # گزارش full_customer این مشتری دیگر به‌روز نیست
+            await invalidate_customer_cache(customer_name, customer[1])
             follow_up_msg = f"پیگیری بعدی برای تاریخ {follow_up_date} تنظیم شد." if follow_up_date else ""
             return f"گزارش تماس با '{customer_name}' با موفقیت در دیتابیس ثبت شد. (ID: {new_id}). {follow_up_msg}"
     except Exception as e:
         return f"خطا در ثبت گزارش تعامل: {e}"
 # ...
 
-def set_reminder(customer_name: str, reminder_text: str, date_time: str, chat_id: int) -> str:
+async def set_reminder(customer_name: str, reminder_text: str, date_time: str, chat_id: int) -> str:
     """ثبت یک یادآوری یا هشدار با لحاظ کردن منطقه زمانی (Iran Time -> UTC)."""
-    conn = get_db_connection()
-    if conn is None:
+    pool = await get_db_pool()
+    if pool is None:
         return "خطا: سرویس حافظه دائمی (PostgreSQL) فعال نیست."
     try:
         # ۱. تاریخ و زمان را به عنوان زمان محلی (Naive) پارس می کند
@@ -247,12 +1000,25 @@ def set_reminder(customer_name: str, reminder_text: str, date_time: str, chat_id
         if utc_datetime < datetime.now(pytz.utc):
              return "خطا: زمان یادآوری تعیین شده در گذشته است. لطفا زمان آینده را مشخص کنید."
         
-        with conn.cursor() as cursor:
-            cursor.execute(
-                "INSERT INTO reminders (chat_id, customer_name, reminder_text, due_date_time) VALUES (%s, %s, %s, %s) RETURNING id",
-                (chat_id, customer_name, reminder_text, utc_datetime) # ذخیره زمان آگاه به منطقه زمانی (UTC)
+        async with pool.connection() as conn, conn.cursor() as cursor:
+            # درج و اعلان NOTIFY در یک رفت‌وبرگشت؛ زمان‌بند همه نمونه‌ها از سررسید جدید باخبر می‌شوند
+            await cursor.execute(
+                f"""
+                WITH new_reminder AS (
+                    INSERT INTO reminders (chat_id, customer_id, customer_name, reminder_text, due_date_time)
+                    VALUES (%s, (SELECT id FROM customers WHERE crm_name_key(name) = crm_name_key(%s) ORDER BY id LIMIT 1), %s, %s, %s)
+                    RETURNING id, due_date_time
+                )
+                SELECT id, pg_notify('{REMINDERS_CHANNEL}', id || ',' || EXTRACT(EPOCH FROM due_date_time)) FROM new_reminder
+                """,
+                (chat_id, customer_name, customer_name, reminder_text, utc_datetime) # ذخیره زمان آگاه به منطقه زمانی (UTC)
             )
-            new_id = cursor.fetchone()[0]
+            new_id = (await cursor.fetchone())[0]
+            # نسخه داده‌ها (بخشی از کلید کش پاسخ‌ها) در همه نمونه‌ها بالا می‌رود، نه فقط در این فرآیند
+            await invalidate_customer_cache(customer_name)
+            # بیدار کردن زمان‌بند همین فرآیند حتی اگر LISTEN در دسترس نباشد
+            if reminder_scheduler is not None:
+                reminder_scheduler.notify(utc_datetime)
             return f"هشدار با متن '{reminder_text[:30]}...' برای {date_time} (به وقت ایران) با موفقیت در دیتابیس ثبت شد. (ID: {new_id})"
     except ValueError:
         return "خطا: فرمت تاریخ و زمان هشدار باید به شکل YYYY-MM-DD HH:MM باشد."
@@ -260,31 +1026,148 @@ def set_reminder(customer_name: str, reminder_text: str, date_time: str, chat_id
         return f"خطا در ثبت هشدار: {e}"
 
 
-def get_report(query_type: str, search_term: str = None, fields: str = "all") -> str:
-    """دریافت گزارش یا اطلاعات خاصی از مشتریان."""
-    conn = get_db_connection()
-    if conn is None:
+# --- گزارش‌گیری: فیلدهای مجاز، صفحه‌بندی و تجمیع سمت سرور ---
+# تنها ستون‌هایی که می‌توانند در فهرست‌ها درخواست شوند (هرگز ورودی کاربر مستقیماً در SQL قرار نمی‌گیرد)
+REPORT_FIELDS = ("id", "name", "phone", "company", "industry", "services")
+REPORT_DEFAULT_FIELDS = ["name", "phone", "company", "industry"]
+REPORT_PAGE_SIZE = int(os.environ.get("REPORT_PAGE_SIZE", "20"))
+REPORT_MAX_PAGE_SIZE = 50
+# گزارش‌هایی که فهرست صفحه‌بندی‌شده مشتریان برمی‌گردانند
+LISTING_REPORT_TYPES = ("all", "industry_search")
+AGGREGATE_REPORT_TYPES = ("count_by_industry", "followups_by_week")
+
+def parse_report_fields(fields: str):
+    """تبدیل رشته fields به لیست ستون‌های مجاز؛ در صورت وجود ستون نامعتبر None برمی‌گرداند."""
+    if not fields or fields.strip().lower() == "all":
+        return list(REPORT_DEFAULT_FIELDS)
+    names = [f.strip().lower() for f in fields.split(',') if f.strip()]
+    if not names or any(name not in REPORT_FIELDS for name in names):
+        return None
+    return names
+
+def _parse_page_cursor(page_cursor) -> int:
+    try:
+        return max(int(page_cursor or 0), 0)
+    except (TypeError, ValueError):
+        return 0
+
+def _clamp_page_size(page_size) -> int:
+    try:
+        page_size = int(page_size or REPORT_PAGE_SIZE)
+    except (TypeError, ValueError):
+        page_size = REPORT_PAGE_SIZE
+    return max(1, min(page_size, REPORT_MAX_PAGE_SIZE))
+
+async def fetch_customer_page(conn, query_type: str, search_term: str, field_names: list, cursor: int, page_size: int):
+    """یک صفحه فهرست مشتریان با صفحه‌بندی keyset روی id؛ (ردیف‌ها، cursor صفحه بعد یا None)."""
+    where, params = ["id > %s"], [cursor]
+    if query_type == 'industry_search':
+        where.append("industry ILIKE %s")
+        params.append(f"%{search_term}%")
+    params.append(page_size + 1)
+    db_cursor = await conn.execute(
+        f"SELECT id, {', '.join(field_names)} FROM customers WHERE {' AND '.join(where)} ORDER BY id LIMIT %s",
+        tuple(params)
+    )
+    rows = await db_cursor.fetchall()
+    next_cursor = rows[page_size - 1][0] if len(rows) > page_size else None
+    return [row[1:] for row in rows[:page_size]], next_cursor
+
+def render_customer_page(query_type: str, search_term: str, field_names: list, rows: list, cursor: int, next_cursor) -> str:
+    if not rows:
+        if cursor:
+            return "صفحه دیگری در این فهرست وجود ندارد."
+        if query_type == 'industry_search':
+            return f"هیچ مشتری در حوزه '{search_term}' پیدا نشد."
+        return "هیچ مشتری ثبت شده‌ای در دیتابیس یافت نشد."
+    
+    if query_type == 'industry_search':
+        title = f"مشتریان در حوزه '{search_term}' (فیلدهای: {', '.join(field_names)}):\n"
+    else:
+        title = "لیست مشتریان ثبت شده" + (" (ادامه)" if cursor else "") + ":\n"
+    output = [title, "```text"]
+    output.extend([" | ".join('' if value is None else str(value) for value in row) for row in rows])
+    output.append("```")
+    if next_cursor:
+        output.append(f"\n(ادامه فهرست: page_cursor={next_cursor})")
+    output.append("\n**نکته:** برای دریافت جزئیات کامل و گزارشات تعامل هر مشتری، نام او را درخواست کنید.")
+    return "\n".join(output)
+
+async def get_aggregate_report(conn, query_type: str) -> str:
+    """گزارش‌های تجمیعی که کاملاً در SQL محاسبه می‌شوند."""
+    if query_type == 'count_by_industry':
+        cursor = await conn.execute("""
+            SELECT COALESCE(NULLIF(TRIM(industry), ''), 'نامشخص') AS industry, COUNT(*)
+            FROM customers GROUP BY 1 ORDER BY 2 DESC, 1 LIMIT 50
+        """)
+        rows = await cursor.fetchall()
+        if not rows:
+            return "هیچ مشتری ثبت شده‌ای در دیتابیس یافت نشد."
+        output = ["تعداد مشتریان به تفکیک حوزه فعالیت:\n", "```text"]
+        output.extend([f"{industry} | {count}" for industry, count in rows])
+        output.append("```")
+        return "\n".join(output)
+    
+    # followups_by_week: پیگیری‌های چهار هفته گذشته تا هشت هفته آینده به تفکیک هفته
+    cursor = await conn.execute("""
+        SELECT date_trunc('week', follow_up_date)::date AS week_start,
+               COUNT(*) AS follow_ups,
+               COUNT(DISTINCT customer_id) AS customers,
+               COUNT(*) FILTER (WHERE follow_up_date < current_date) AS overdue
+        FROM interactions
+        WHERE follow_up_date >= date_trunc('week', current_date) - INTERVAL '4 weeks'
+          AND follow_up_date < date_trunc('week', current_date) + INTERVAL '8 weeks'
+        GROUP BY 1 ORDER BY 1
+    """)
+    rows = await cursor.fetchall()
+    if not rows:
+        return "هیچ پیگیری برای هفته‌های اخیر یا آینده ثبت نشده است."
+    output = ["پیگیری‌ها به تفکیک هفته (شروع هفته | تعداد پیگیری | مشتریان | گذشته از موعد):\n", "```text"]
+    output.extend([f"{week.strftime('%Y-%m-%d')} | {follow_ups} | {customers} | {overdue}" for week, follow_ups, customers, overdue in rows])
+    output.append("```")
+    return "\n".join(output)
+
+async def get_report(query_type: str, search_term: str = None, fields: str = "all", page_size: int = REPORT_PAGE_SIZE, page_cursor: int = 0) -> str:
+    """دریافت گزارش یا اطلاعات خاصی از مشتریان.
+
+    query_type یکی از این مقادیر است:
+    'all' (فهرست صفحه‌بندی‌شده همه مشتریان)، 'industry_search' (فهرست مشتریان یک حوزه؛ search_term الزامی)،
+    'full_customer' (جزئیات و تعاملات یک مشتری؛ search_term نام مشتری)،
+    'count_by_industry' (تعداد مشتریان هر حوزه) و 'followups_by_week' (تعداد پیگیری‌های هر هفته).
+    fields فقط برای فهرست‌ها و ترکیبی از id, name, phone, company, industry, services است.
+    page_size حداکثر ۵۰ و page_cursor مقدار «ادامه فهرست» صفحه قبل است.
+    """
+    if query_type == 'full_customer' and search_term:
+        cached = report_cache.get(normalize_lookup_key(search_term))
+        if cached is not None:
+            return cached
+    
+    field_names = None
+    page_cursor = _parse_page_cursor(page_cursor)
+    if query_type in LISTING_REPORT_TYPES:
+        field_names = parse_report_fields(fields)
+        if field_names is None:
+            return f"خطا: فیلدهای درخواستی معتبر نیستند. فیلدهای مجاز: {', '.join(REPORT_FIELDS)}"
+    
+    pool = await get_db_pool()
+    if pool is None:
         return "خطا: سرویس حافظه دائمی (PostgreSQL) فعال نیست."
         
     try:
-        with conn.cursor() as cursor:
-            if query_type == 'industry_search' and search_term:
-                field_names = [f.strip() for f in fields.split(',')] if fields != "all" else ["name", "phone", "company", "industry"]
-                
-                cursor.execute(f"SELECT {', '.join(field_names)} FROM customers WHERE industry ILIKE %s", (f"%{search_term}%",))
-                results = cursor.fetchall()
-                
-                if not results:
-                    return f"هیچ مشتری در حوزه '{search_term}' پیدا نشد."
-                    
-                output = [f"مشتریان در حوزه '{search_term}' (فیلدهای: {', '.join(field_names)}):\n", "```text"]
-                output.extend([" | ".join(map(str, row)) for row in results])
-                output.append("```")
-                return "\n".join(output)
+        async with pool.connection() as conn, conn.cursor() as cursor:
+            if query_type in LISTING_REPORT_TYPES and (query_type == 'all' or search_term):
+                rows, next_cursor = await fetch_customer_page(
+                    conn, query_type, search_term, field_names, page_cursor, _clamp_page_size(page_size)
+                )
+                return render_customer_page(query_type, search_term, field_names, rows, page_cursor, next_cursor)
+            
+            if query_type in AGGREGATE_REPORT_TYPES:
+                return await get_aggregate_report(conn, query_type)
                 
-            elif query_type == 'full_customer' and search_term:
-                cursor.execute("SELECT id, name, phone, company, industry, services FROM customers WHERE name ILIKE %s", (search_term,))
-                customer = cursor.fetchone()
+            if query_type == 'full_customer' and search_term:
+                report_key = normalize_lookup_key(search_term)
+                await cursor.execute(f"SELECT {CUSTOMER_COLUMNS} FROM customers WHERE crm_name_key(name) = crm_name_key(%s) ORDER BY id LIMIT 1", (search_term,))
+                customer = await cursor.fetchone()
                 
                 if not customer:
                     return f"خطا: مشتری با نام '{search_term}' پیدا نشد."
@@ -302,8 +1185,8 @@ def get_report(query_type: str, search_term: str = None, fields: str = "all") ->
                 ]
 
                 # جستجوی تعاملات
-                cursor.execute("SELECT interaction_date, report, follow_up_date FROM interactions WHERE customer_name ILIKE %s ORDER BY interaction_date DESC", (search_term,))
-                interactions = cursor.fetchall()
+                await cursor.execute("SELECT interaction_date, report, follow_up_date FROM interactions WHERE customer_id = %s ORDER BY interaction_date DESC", (customer[0],))
+                interactions = await cursor.fetchall()
                 
                 if interactions:
                     output.append("\nگزارشات تعامل:\n")
@@ -315,263 +1198,3368 @@ def get_report(query_type: str, search_term: str = None, fields: str = "all") ->
                 else:
                     output.append("هیچ گزارش تعاملی ثبت نشده است.")
                 
-                return "\n".join(output)
-            
-            elif query_type == 'all':
-                cursor.execute(f"SELECT name, phone, company, industry FROM customers")
-                results = cursor.fetchall()
-                
-                if not results:
-                    return "هیچ مشتری ثبت شده‌ای در دیتابیس یافت نشد."
-                    
-                output = ["لیست کامل مشتریان ثبت شده:\n", "```text"]
-                output.extend([" | ".join(map(str, row)) for row in results])
-                output.append("```")
-                output.append("\n**نکته:** برای دریافت جزئیات کامل و گزارشات تعامل هر مشتری، نام او را درخواست کنید.")
-                return "\n".join(output)
+                report = "\n".join(output)
+                report_cache.set(report_key, report)
+                report_cache.set(normalize_lookup_key(customer[1]), report)
+                return report
 
             return f"نوع گزارش '{query_type}' پشتیبانی نمی‌شود یا عبارت جستجو مشخص نیست."
     except Exception as e:
         logger.error(f"Error getting report: {e}")
         return f"خطای دیتابیس هنگام گزارش‌گیری: {e}"
 
-# =================================================================
-# --- توابع مدیریت تلگرام و وظیفه بک‌گراند ---
-# =================================================================
+# --- جستجوی متن کامل در گزارش‌های تعامل (ستون tsvector با ایندکس GIN؛ یک کوئری برای هر صفحه) ---
+SEARCH_PAGE_SIZE = 10
+SEARCH_MAX_PAGE_SIZE = 25
+# بریده متن اطراف کلمات پیدا شده؛ کلمات با «» مشخص می‌شوند
+SEARCH_HEADLINE_OPTIONS = 'MaxFragments=2, MaxWords=18, MinWords=6, StartSel=«, StopSel=», FragmentDelimiter=" … "'
 
-async def export_data_to_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """تولید فایل CSV از اطلاعات کامل مشتریان و ارسال آن به کاربر."""
-    conn = get_db_connection()
-    if conn is None:
-        await context.bot.send_message(chat_id=update.effective_chat.id, text="⚠️ سرویس حافظه دائمی (PostgreSQL) فعال نیست.")
-        return
-        
-    chat_id = update.effective_chat.id
-    await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.UPLOAD_DOCUMENT)
+async def search_interactions(query: str, customer_name: str = None, date_from: str = None, date_to: str = None,
+                              since_days: int = None, page_size: int = SEARCH_PAGE_SIZE, page_cursor: int = 0) -> str:
+    """جستجوی متن کامل در گزارش‌های تعامل همه مشتریان؛ نتایج به ترتیب ارتباط همراه بریده‌ای از متن گزارش برمی‌گردند.
+
+    query عبارت جستجو است (چند کلمه، "عبارت دقیق" داخل گیومه، or بین دو کلمه و -کلمه برای حذف).
+    customer_name جستجو را به مشتریانی با این نام محدود می‌کند.
+    date_from و date_to بازه تاریخ تعامل به فرمت YYYY-MM-DD و since_days فقط N روز اخیر (مثلاً 30 برای ماه گذشته).
+    page_size حداکثر ۲۵ و page_cursor مقدار «ادامه نتایج» صفحه قبل است.
+    """
+    if not query or not query.strip():
+        return "خطا: عبارت جستجو خالی است."
+    try:
+        start = datetime.strptime(date_from, "%Y-%m-%d").date() if date_from else None
+        end = datetime.strptime(date_to, "%Y-%m-%d").date() if date_to else None
+        if since_days:
+            since = datetime.now(IRAN_TZ).date() - timedelta(days=int(since_days))
+            start = max(start, since) if start else since
+    except (TypeError, ValueError):
+        return "خطا: فرمت تاریخ باید YYYY-MM-DD و since_days یک عدد باشد."
+    try:
+        page_size = max(1, min(int(page_size or SEARCH_PAGE_SIZE), SEARCH_MAX_PAGE_SIZE))
+    except (TypeError, ValueError):
+        page_size = SEARCH_PAGE_SIZE
+    offset = _parse_page_cursor(page_cursor)
+    
+    pool = await get_db_pool()
+    if pool is None:
+        return "خطا: سرویس حافظه دائمی (PostgreSQL) فعال نیست."
     
+    where, params = ["r.report_tsv @@ q.query"], []
+    if customer_name:
+        where.append("r.customer_name ILIKE %s")
+        params.append(f"%{customer_name.strip()}%")
+    if start:
+        where.append("r.interaction_date >= %s")
+        params.append(start)
+    if end:
+        where.append("r.interaction_date <= %s")
+        params.append(end)
     try:
-        with conn.cursor() as cursor:
-            cursor.execute("SELECT * FROM customers")
-            columns = [desc[0] for desc in cursor.description]
-            rows = cursor.fetchall()
-            
-            if not rows:
-                await context.bot.send_message(chat_id=chat_id, text="⚠️ دیتابیس مشتریان خالی است. فایلی برای ارسال وجود ندارد.")
-                return
-
-            csv_content = [",".join(columns)]
-            for row in rows:
-                safe_row = [str(item).replace(',', ';') if item else '' for item in row]
-                csv_content.append(",".join(safe_row))
-                
-            file_name = f"CRM_Customers_Export_{TODAY_DATE}.csv"
-            
-            await context.bot.send_document(
-                chat_id=chat_id, 
-                document=bytes("\n".join(csv_content).encode('utf-8')),
-                filename=file_name,
-                caption="فایل کامل مشتریان CRM (حافظه دائمی PostgreSQL) با فرمت CSV"
+        async with pool.connection() as conn:
+            # رتبه‌بندی و صفحه‌بندی فقط روی ایندکس؛ ts_headline (پرهزینه) فقط برای ردیف‌های همین صفحه
+            cursor = await conn.execute(
+                f"""
+                WITH q AS (SELECT websearch_to_tsquery('simple', crm_normalize_fa(%s)) AS query)
+                SELECT i.customer_name, i.interaction_date, i.follow_up_date,
+                       ts_headline('simple', crm_normalize_fa(i.report), q.query, %s)
+                FROM q, LATERAL (
+                    SELECT r.id, ts_rank_cd(r.report_tsv, q.query) AS rank
+                    FROM interactions r
+                    WHERE {' AND '.join(where)}
+                    ORDER BY rank DESC, r.id DESC
+                    LIMIT %s OFFSET %s
+                ) hits
+                JOIN interactions i ON i.id = hits.id
+                ORDER BY hits.rank DESC, i.id DESC
+                """,
+                (query, SEARCH_HEADLINE_OPTIONS, *params, page_size + 1, offset)
             )
+            rows = await cursor.fetchall()
     except Exception as e:
-        logger.error(f"Error exporting data from PostgreSQL: {e}")
-        await context.bot.send_message(chat_id=chat_id, text="❌ خطایی هنگام استخراج داده‌ها از دیتابیس رخ داد.")
-
-async def reminder_checker(application: Application):
-    """وظیفه دوره‌ای برای بررسی و ارسال هشدارهای ثبت شده (بررسی بر اساس زمان UTC سرور)."""
+        logger.error(f"Error searching interactions: {e}")
+        return f"خطای دیتابیس هنگام جستجو: {e}"
     
-    while True:
-        await asyncio.sleep(60) # هر ۶۰ ثانیه یک بار چک می‌کند
-        
-        conn = get_db_connection() 
-        if conn is None:
-            logger.warning("Reminder checker skipped: PostgreSQL not initialized.")
-            continue
-            
-        try:
-            # زمان حال را دقیقاً به وقت UTC می‌خوانیم
-            now_time = datetime.now(pytz.utc)
-            
-            with conn.cursor() as cursor:
-                # خواندن هشدارهایی که هنوز ارسال نشده و زمان آن‌ها گذشته یا رسیده است (مقایسه آگاه به منطقه زمانی)
-                cursor.execute(
-                    "SELECT id, chat_id, customer_name, reminder_text FROM reminders WHERE sent = FALSE AND due_date_time <= %s", (now_time,)
-                )
-                reminders_to_send = cursor.fetchall()
-                
-                for reminder in reminders_to_send:
-                    r_id, chat_id, customer_name, reminder_text = reminder
-                    
-                    # ارسال پیام هشدار
-                    message = f"🔔 **هشدار CRM**\n\nمشتری: **{customer_name or 'عمومی'}**\nپیام: _{reminder_text}_\n\n"
-                    await application.bot.send_message(chat_id=chat_id, text=message, parse_mode='Markdown')
-                    
-                    # به‌روزرسانی وضعیت ارسال
-                    with conn.cursor() as update_cursor:
-                        update_cursor.execute("UPDATE reminders SET sent = TRUE WHERE id = %s", (r_id,))
-                    
-        except Exception as e:
-            logger.error(f"Failed to run reminder checker: {e}")
+    if not rows:
+        if offset:
+            return "نتیجه دیگری برای این جستجو وجود ندارد."
+        return f"هیچ گزارش تعاملی مطابق «{query}» پیدا نشد."
+    output = [f"گزارش‌های تعامل مطابق «{query}» (به ترتیب ارتباط):\n"]
+    for name, date, follow_up, snippet in rows[:page_size]:
+        date = date.strftime("%Y-%m-%d") if date else 'N/A'
+        follow_up = follow_up.strftime("%Y-%m-%d") if follow_up else 'ندارد'
+        output.append(f"- {name} | تاریخ: {date} | پیگیری: {follow_up}\n  {' '.join((snippet or '').split())}")
+    if len(rows) > page_size:
+        output.append(f"\n(ادامه نتایج: page_cursor={offset + page_size})")
+    return "\n".join(output)
 
-# ... (توابع message_handler, start_command, main بدون تغییر) ...
+# --- ارسال مستقیم فهرست‌ها با دکمه «صفحه بعد» (بدون عبور از مدل) ---
+REPORT_PAGE_CALLBACK = "rpt"
+# تعداد فهرست‌های اخیر هر چت که وضعیت صفحه‌بندی‌شان نگه داشته می‌شود
+REPORT_QUERIES_PER_CHAT = 20
 
-async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not ai_client or not update.message or not update.message.text:
-        return
+def _report_page_keyboard(token: str, next_cursor):
+    if not next_cursor:
+        return None
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton("صفحه بعد ⬅️", callback_data=f"{REPORT_PAGE_CALLBACK}:{token}:{next_cursor}")
+    ]])
 
-    user_text = update.message.text
-    chat_id = update.effective_chat.id
-    
-    if user_text.strip() == "📥 ارسال فایل کل مشتریان":
-        await export_data_to_file(update, context)
-        return
+def _store_report_query(chat_data: dict, params: dict) -> str:
+    """نگهداری پارامترهای فهرست در chat_data؛ callback_data تلگرام حداکثر ۶۴ بایت است."""
+    queries = chat_data.setdefault('report_queries', OrderedDict())
+    token = secrets.token_hex(4)
+    queries[token] = params
+    while len(queries) > REPORT_QUERIES_PER_CHAT:
+        queries.popitem(last=False)
+    return token
+
+async def _send_markdown_or_plain(send, text: str, **kwargs):
+    """ارسال یا ویرایش با Markdown؛ اگر داده‌ها (مثلاً _ یا * در عبارت جستجو) Markdown را نامعتبر کنند، همان متن بدون قالب."""
+    try:
+        return await send(text, parse_mode='Markdown', **kwargs)
+    except BadRequest as e:
+        if "not modified" in str(e).lower():
+            return None
+        return await send(text, **kwargs)
+
+async def send_report_listing(context: ContextTypes.DEFAULT_TYPE, chat_id: int, args: dict, send_empty: bool = False):
+    """فهرست را مستقیماً برای کاربر می‌فرستد و فقط خلاصه‌ای کوتاه به مدل برمی‌گرداند؛ None یعنی اجرای عادی تابع.
+
+    با send_empty=True پیام «فهرست خالی» هم مستقیماً ارسال می‌شود (برای مسیر سریع بدون مدل).
+    """
+    query_type = args.get('query_type')
+    if query_type not in LISTING_REPORT_TYPES or (query_type == 'industry_search' and not args.get('search_term')):
+        return None
+    field_names = parse_report_fields(args.get('fields'))
+    if field_names is None:
+        return None
+    pool = await get_db_pool()
+    if pool is None:
+        return None
     
-    if 'history' not in context.user_data:
-        context.user_data['history'] = []
+    params = {
+        "query_type": query_type,
+        "search_term": args.get('search_term'),
+        "fields": field_names,
+        "page_size": _clamp_page_size(args.get('page_size')),
+    }
+    cursor = _parse_page_cursor(args.get('page_cursor'))
+    try:
+        async with pool.connection() as conn:
+            rows, next_cursor = await fetch_customer_page(conn, query_type, params["search_term"], field_names, cursor, params["page_size"])
+    except Exception as e:
+        logger.error(f"Error fetching report listing: {e}")
+        return f"خطای دیتابیس در دریافت فهرست مشتریان: {e}"
+    if not rows:
+        empty = render_customer_page(query_type, params["search_term"], field_names, rows, cursor, next_cursor)
+        if send_empty:
+            await context.bot.send_message(chat_id=chat_id, text=empty)
+        return empty
     
-    user_part = types.Part(text=user_text)
-    context.user_data['history'].append(types.Content(role="user", parts=[user_part]))
-    conversation_history = context.user_data['history']
-    
-    system_instruction = (
-        "شما یک دستیار هوشمند CRM با **حافظه کامل (PostgreSQL)** و تحلیلگر هوشمند هستید. "
-        "وظایف شما: ۱. ثبت، به‌روزرسانی، حذف، ثبت گزارش‌ها و تنظیم هشدارها با استفاده از توابع (Tools). "
-        "۲. ارائه گزارش هوشمند و فیلتر شده. در هنگام گزارش‌گیری لیست کامل مشتریان، هوش مصنوعی باید از تابع get_report با query_type='all' استفاده کند. "
-        "۳. **تحلیل هوشمند و ارائه پیشنهاد عملی:** پس از اجرای موفقیت‌آمیز هر تابع **ثبت/حذف**، یک پیشنهاد عملی برای پیگیری بعدی ارائه دهید. "
-        "**قوانین:** 1. هرگاه داده‌های اجباری برای یک تابع جمع‌آوری شد، آن را فراخوانی کنید. 2. همیشه پاسخ های خود را به زبان فارسی و دوستانه بنویسید. 3. در فراخوانی تابع set_reminder، 'chat_id' را برابر با **" + str(chat_id) + "** قرار دهید."
+    token = _store_report_query(context.chat_data, params)
+    await _send_markdown_or_plain(
+        functools.partial(context.bot.send_message, chat_id),
+        render_customer_page(query_type, params["search_term"], field_names, rows, cursor, next_cursor),
+        reply_markup=_report_page_keyboard(token, next_cursor)
+    )
+    more = " و دکمه «صفحه بعد» برای ادامه فهرست زیر آن قرار دارد" if next_cursor else ""
+    return (
+        f"فهرست {len(rows)} مشتری مستقیماً برای کاربر ارسال شد{more}. "
+        "فهرست را تکرار نکن؛ در صورت نیاز فقط یک جمع‌بندی یا پیشنهاد کوتاه بده."
     )
 
-    await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+async def report_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """پاسخ به دکمه «صفحه بعد»؛ صفحه بعد مستقیماً از دیتابیس خوانده و جایگزین پیام می‌شود."""
+    query = update.callback_query
+    _, token, cursor = query.data.split(":", 2)
+    params = context.chat_data.get('report_queries', {}).get(token)
+    if params is None:
+        await query.answer("این فهرست منقضی شده است؛ لطفاً دوباره درخواست کنید.", show_alert=True)
+        return
+    pool = await get_db_pool()
+    if pool is None:
+        await query.answer("⚠️ سرویس حافظه دائمی (PostgreSQL) فعال نیست.", show_alert=True)
+        return
     
+    cursor = int(cursor)
     try:
-        response = ai_client.models.generate_content(
-            model=AI_MODEL,
-            contents=conversation_history, 
-            config=types.GenerateContentConfig(
-                system_instruction=system_instruction,
-                tools=[manage_customer_data, log_interaction, set_reminder, get_report, delete_customer]
+        async with pool.connection() as conn:
+            rows, next_cursor = await fetch_customer_page(
+                conn, params["query_type"], params["search_term"], params["fields"], cursor, params["page_size"]
             )
-        )
-        
-        if response.function_calls:
-            function_calls = response.function_calls
-            tool_responses = []
-            context.user_data['history'].append(types.Content(role="model", parts=[types.Part.from_function_calls(function_calls)]))
-            
-            for call in function_calls:
-                function_name = call.name
-                args = dict(call.args)
-                
-                if function_name == 'manage_customer_data': tool_result = manage_customer_data(**args)
-                elif function_name == 'log_interaction': tool_result = log_interaction(**args)
-                elif function_name == 'set_reminder':
-                    if 'chat_id' not in args: args['chat_id'] = chat_id 
-                    tool_result = set_reminder(**args)
-                elif function_name == 'get_report': tool_result = get_report(**args)
-                elif function_name == 'delete_customer': tool_result = delete_customer(**args)
-                else: tool_result = f"خطا: تابع {function_name} ناشناخته است."
-                    
-                tool_responses.append(
-                    types.Part.from_function_response(
-                        name=function_name,
-                        response={"result": tool_result}
-                    )
-                )
+    except Exception as e:
+        logger.error(f"Error fetching report page: {e}")
+        await query.answer("⚠️ خطای دیتابیس در دریافت صفحه بعد؛ لطفاً دوباره تلاش کنید.", show_alert=True)
+        return
+    await query.answer()
+    await _send_markdown_or_plain(
+        query.edit_message_text,
+        render_customer_page(params["query_type"], params["search_term"], params["fields"], rows, cursor, next_cursor),
+        reply_markup=_report_page_keyboard(token, next_cursor)
+    )
 
-            context.user_data['history'].append(types.Content(role="tool", parts=tool_responses))
-            
-            final_response = ai_client.models.generate_content(
-                model=AI_MODEL,
-                contents=context.user_data['history'], 
-                config=types.GenerateContentConfig(
-                    system_instruction=system_instruction,
-                    tools=[manage_customer_data, log_interaction, set_reminder, get_report, delete_customer]
-                )
-            )
-            
-            if final_response.candidates and final_response.candidates[0].content:
-                context.user_data['history'].append(final_response.candidates[0].content)
+# --- کارهای پس‌زمینه: خروجی فایل و گزارش‌های سنگین خارج از مسیر پاسخ ---
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "2"))
+# سقف کارهای در صف یا در حال اجرای هر چت
+JOB_MAX_PER_CHAT = int(os.environ.get("JOB_MAX_PER_CHAT", "3"))
+# تعداد کارهای پایان‌یافته هر چت که برای /jobs نگه داشته می‌شوند
+JOB_HISTORY_PER_CHAT = 10
+# عدد کمتر یعنی اولویت بیشتر؛ گزارش‌ها پیش از خروجی‌های فایل اجرا می‌شوند
+JOB_PRIORITY_REPORT = 10
+JOB_PRIORITY_EXPORT = 20
+# گزارش تجمیعی روی جدولی با بیش از این تعداد ردیف (تخمین pg_class) به کار پس‌زمینه سپرده می‌شود
+JOB_REPORT_ROW_THRESHOLD = int(os.environ.get("JOB_REPORT_ROW_THRESHOLD", "50000"))
+# جدولی که هر گزارش تجمیعی روی آن اسکن می‌کند
+AGGREGATE_REPORT_TABLES = {"count_by_industry": "customers", "followups_by_week": "interactions"}
+# پیشوند پاسخ تابع وقتی نتیجه به کار پس‌زمینه سپرده شده است (این نوبت‌ها در response_cache ذخیره نمی‌شوند)
+JOB_ACK_PREFIX = "کار پس‌زمینه #"
+JOB_STATUS_LABELS = {"queued": "⏳ در صف", "running": "⚙️ در حال اجرا", "done": "✅ انجام شد", "failed": "❌ ناموفق"}
 
-            await update.message.reply_text(final_response.text, parse_mode='Markdown')
+# بخش‌های مسدودکننده کارها (فشرده‌سازی، ساخت XLSX) روی thread pool جداگانه اجرا می‌شوند
+# تا asyncio.to_thread بقیه ربات (ورود فایل، تاریخچه SQLite) پشت آن‌ها منتظر نماند
+job_executor = ThreadPoolExecutor(max_workers=max(JOB_WORKERS, 1) * 2, thread_name_prefix="crm-job")
+table_rows_cache = TTLCache(16, 300)
 
-        else:
-            if response.candidates and response.candidates[0].content:
-                context.user_data['history'].append(response.candidates[0].content)
-            await update.message.reply_text(response.text, parse_mode='Markdown')
+async def run_blocking(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(job_executor, functools.partial(func, *args))
 
-    except APIError as e:
-        logger.error(f"Gemini API Error: {e}")
-        await update.message.reply_text("⚠️ خطای API رخ داد. لطفاً چند دقیقه دیگر امتحان کنید.")
-    except Exception as e:
-        logger.error(f"An unexpected error occurred: {e}")
-        await update.message.reply_text(f"❓ یک خطای نامشخص رخ داد. لطفاً لاگ‌های سرور را بررسی کنید. خطا: {e}")
 
+@dataclass
+class Job:
+    """یک کار پس‌زمینه؛ run(bot) نتیجه را خودش برای کاربر می‌فرستد و خلاصه‌ای کوتاه برای /jobs برمی‌گرداند."""
+    id: int
+    chat_id: int
+    kind: str
+    title: str
+    priority: int
+    run: object
+    status: str = "queued"
+    created_at: float = 0.0
+    started_at: float = None
+    finished_at: float = None
+    result: str = None
 
-async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """پاسخ به دستور /start و راهنمایی اولیه."""
-    
-    if 'history' in context.user_data:
-        del context.user_data['history']
-        
-    ai_status = "✅ متصل و آماده" if ai_client else "❌ غیرفعال (کلید API را بررسی کنید)."
-    
-    conn = get_db_connection()
-    db_status = "✅ متصل به PostgreSQL" if conn else "❌ مشکل در اتصال به دیتابیس"
-    if conn: conn.close()
-    
-    reply_keyboard = [
-        ["✍️ ثبت اطلاعات جدید", "📞 ثبت گزارش تماس"],
-        ["📊 درخواست گزارش هوشمند", "📥 ارسال فایل کل مشتریان"],
-    ]
-    markup = ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=False, resize_keyboard=True)
-    
-    message = (
-        f"🤖 **CRM Bot هوشمند با حافظه دائمی PostgreSQL**\n\n"
-        f"✨ وضعیت AI: {ai_status}\n"
-        f"💾 وضعیت حافظه: {db_status}\n"
-        f"**نحوه استفاده:** هرگونه پیام یا درخواستی که دارید را ارسال کنید، یا از دکمه‌های زیر استفاده کنید. ربات نیت شما را درک و عملیات لازم را انجام می‌دهد و **پیشنهاد هوشمندانه** می‌دهد.\n\n"
-        f"**مثال‌های هوشمند:**\n"
-        f" - **ثبت و تحلیل:** 'با آقای نوری صحبت کردم. گفت قیمت رقبا بالاتره.'\n"
-        f" - **هشدار فعال (اصلاح شده):** 'برای هفته بعد دوشنبه ساعت ۱۰:۰۰ پیگیری با نوری رو برام یادآوری کن.' (فرمت **YYYY-MM-DD HH:MM**)\n"
-        f" - **حذف:** 'آقای الف رو از لیست مشتریان حذف کن.'\n"
-    )
-    
-    await update.message.reply_text(message, reply_markup=markup, parse_mode='Markdown')
 
+class JobRunner:
+    """صف اولویت‌دار کارهای سنگین با تعداد worker محدود و سقف کارهای هم‌زمان هر چت."""
 
-def main() -> None:
-    """شروع به کار ربات (با منطق انتخاب Webhook یا Polling)"""
-    
-    global ai_client
-    if GEMINI_API_KEY and GEMINI_API_KEY != "YOUR_API_KEY_HERE":
-        try:
-            ai_client = genai.Client(api_key=GEMINI_API_KEY)
-            logger.info("Gemini Client and Model Initialized Successfully.")
-        except Exception as e:
-            logger.error(f"Error initializing Gemini client: {e}")
+    def __init__(self, bot, workers: int = JOB_WORKERS, max_per_chat: int = JOB_MAX_PER_CHAT):
+        self.bot = bot
+        self.workers = workers
+        self.max_per_chat = max_per_chat
+        self._queue = asyncio.PriorityQueue()
+        self._ids = itertools.count(1)
+        # chat_id -> کارهای اخیر آن چت به ترتیب ثبت
+        self._jobs = {}
+        # کلید (اولویت، شناسه) کارهایی که هنوز برداشته نشده‌اند؛ برای محاسبه نوبت در صف
+        self._waiting = set()
+
+    def start(self) -> None:
+        for _ in range(self.workers):
+            start_background_task(self._worker())
+
+    def jobs_for_chat(self, chat_id: int) -> list:
+        return list(self._jobs.get(chat_id, []))
+
+    def active_jobs(self, chat_id: int) -> list:
+        return [job for job in self._jobs.get(chat_id, []) if job.status in ("queued", "running")]
+
+    def queue_position(self, job: Job) -> int:
+        return 1 + sum(1 for key in self._waiting if key < (job.priority, job.id))
+
+    def submit(self, chat_id: int, kind: str, title: str, run, priority: int):
+        """ثبت کار در صف؛ اگر چت به سقف کارهای هم‌زمان رسیده باشد None برمی‌گرداند."""
+        if len(self.active_jobs(chat_id)) >= self.max_per_chat:
+            return None
+        job = Job(next(self._ids), chat_id, kind, title, priority, run, created_at=time.time())
+        jobs = self._jobs.setdefault(chat_id, [])
+        jobs.append(job)
+        finished = [old for old in jobs if old.status in ("done", "failed")]
+        for old in finished[:max(len(finished) - JOB_HISTORY_PER_CHAT, 0)]:
+            jobs.remove(old)
+        self._waiting.add((priority, job.id))
+        self._queue.put_nowait((priority, job.id, job))
+        logger.info(f"Job {job.id} ({kind}) queued for chat {chat_id} with priority {priority}")
+        return job
+
+    async def join(self) -> None:
+        """انتظار تا اجرای همه کارهای صف (برای تست و بنچمارک)."""
+        await self._queue.join()
+
+    async def _worker(self) -> None:
+        while True:
+            priority, job_id, job = await self._queue.get()
+            self._waiting.discard((priority, job_id))
+            job.status = "running"
+            job.started_at = time.time()
+            started = time.perf_counter()
+            try:
+                job.result = await job.run(self.bot)
+                job.status = "done"
+            except Exception as e:
+                job.status = "failed"
+                job.result = str(e)
+                logger.error(f"Job {job.id} ({job.kind}) for chat {job.chat_id} failed: {e}")
+                API_ERRORS.inc(kind=job.kind)
+                try:
+                    await outbound_delivery.enqueue(OutboundMessage(
+                        job.chat_id, f"❌ کار #{job.id} ({job.title}) ناموفق بود. لطفاً دوباره تلاش کنید."
+                    ))
+                except Exception as notify_error:
+                    # خطای اطلاع‌رسانی نباید این worker را از استخر خارج کند
+                    logger.error(f"Failed to notify chat {job.chat_id} about job {job.id}: {notify_error}")
+            finally:
+                job.finished_at = time.time()
+                seconds = time.perf_counter() - started
+                JOB_SECONDS.observe(seconds, kind=job.kind)
+                JOBS.inc(kind=job.kind, status=job.status)
+                logger.info(f"Job {job.id} ({job.kind}) {job.status} in {seconds:.2f}s")
+                self._queue.task_done()
+
+
+job_runner = None
+
+def job_ack_text(job) -> str:
+    """پیام تأیید فوری ثبت کار برای کاربر."""
+    if job is None:
+        return f"⚠️ {JOB_MAX_PER_CHAT} کار پس‌زمینه این گفتگو هنوز تمام نشده است؛ پس از پایان آن‌ها دوباره تلاش کنید. وضعیت: /jobs"
+    return f"⏳ {job.title} به‌عنوان کار #{job.id} در صف قرار گرفت؛ نتیجه پس از آماده شدن ارسال می‌شود. وضعیت: /jobs"
+
+def format_job(job: Job) -> str:
+    now = time.time()
+    if job.status == "queued":
+        detail = f"نوبت {job_runner.queue_position(job)} در صف"
+    elif job.status == "running":
+        detail = f"{now - job.started_at:.0f} ثانیه"
+    else:
+        detail = f"{job.finished_at - job.started_at:.1f} ثانیه"
+    line = f"#{job.id} {job.title} — {JOB_STATUS_LABELS[job.status]} ({detail})"
+    if job.result:
+        line += f"\n    {job.result}"
+    return line
+
+async def jobs_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """دستور /jobs: وضعیت کارهای پس‌زمینه این گفتگو."""
+    jobs = job_runner.jobs_for_chat(update.effective_chat.id) if job_runner else []
+    if not jobs:
+        await update.message.reply_text("هیچ کار پس‌زمینه‌ای برای این گفتگو ثبت نشده است.")
+        return
+    lines = ["🗂 کارهای پس‌زمینه این گفتگو (جدیدترین اول):\n"]
+    lines.extend(format_job(job) for job in reversed(jobs))
+    await update.message.reply_text("\n".join(lines))
+
+async def estimated_table_rows(table: str) -> int:
+    """تخمین تعداد ردیف‌های جدول از آمار pg_class (بدون اسکن جدول)."""
+    rows = table_rows_cache.get(table)
+    if rows is not None:
+        return rows
+    pool = await get_db_pool()
+    if pool is None:
+        return 0
+    async with pool.connection() as conn:
+        cursor = await conn.execute("SELECT GREATEST(reltuples, 0)::bigint FROM pg_class WHERE oid = %s::regclass", (table,))
+        row = await cursor.fetchone()
+    rows = row[0] if row else 0
+    table_rows_cache.set(table, rows)
+    return rows
+
+async def is_heavy_report(query_type: str) -> bool:
+    table = AGGREGATE_REPORT_TABLES.get(query_type)
+    return job_runner is not None and table is not None and await estimated_table_rows(table) > JOB_REPORT_ROW_THRESHOLD
+
+def submit_report_job(chat_id: int, query_type: str, search_term: str = None):
+    """اجرای get_report در کار پس‌زمینه و ارسال مستقیم نتیجه از صف ارسال."""
+    async def run(bot):
+        report = await get_report(query_type, search_term)
+        if report.startswith("خطا"):
+            raise RuntimeError(report)
+        await outbound_delivery.enqueue(OutboundMessage(chat_id, report, parse_mode='Markdown'))
+        return "گزارش ارسال شد."
+    return job_runner.submit(chat_id, "report", f"گزارش {query_type}", run, JOB_PRIORITY_REPORT)
+
+async def send_report_direct(context: ContextTypes.DEFAULT_TYPE, chat_id: int, args: dict):
+    """هندلر مستقیم get_report: فهرست‌ها مستقیماً ارسال و گزارش‌های تجمیعی سنگین به کار پس‌زمینه سپرده می‌شوند."""
+    query_type = args.get('query_type')
+    if await is_heavy_report(query_type):
+        job = submit_report_job(chat_id, query_type)
+        if job is None:
+            return f"خطا: {JOB_MAX_PER_CHAT} کار پس‌زمینه این کاربر هنوز تمام نشده است؛ از او بخواه کمی بعد دوباره درخواست کند."
+        return (
+            f"{JOB_ACK_PREFIX}{job.id} ثبت شد؛ گزارش پس از آماده شدن مستقیماً برای کاربر ارسال می‌شود. "
+            "منتظر نتیجه نمان؛ فقط به کاربر بگو گزارش در حال آماده شدن است و وضعیت آن با /jobs قابل مشاهده است."
+        )
+    return await send_report_listing(context, chat_id, args)
+
+def is_job_ack(part) -> bool:
+    """True اگر پاسخ تابع فقط تأیید ثبت یک کار پس‌زمینه باشد."""
+    result = part.function_response.response.get("result") if part.function_response else None
+    return isinstance(result, str) and result.startswith(JOB_ACK_PREFIX)
+
+# --- رجیستری و اجرای توابع (Tools) ---
+
+# نام تابع در اعلان مدل -> پیاده‌سازی async آن
+TOOL_REGISTRY = {
+    "manage_customer_data": manage_customer_data,
+    "log_interaction": log_interaction,
+    "set_reminder": set_reminder,
+    "get_report": get_report,
+    "search_interactions": search_interactions,
+    "delete_customer": delete_customer,
+}
+# توابعی که chat_id گفتگو به آن‌ها تزریق می‌شود (این پارامتر در اعلان مدل نیست)
+CHAT_ID_TOOLS = {"set_reminder", "log_interaction"}
+# هندلرهایی که خروجی بزرگ را مستقیماً برای کاربر می‌فرستند؛ اگر None برگردانند تابع عادی اجرا می‌شود
+DIRECT_TOOL_HANDLERS = {"get_report": send_report_direct}
+
+# --- پیکربندی ثابت مدل: اعلان توابع از پیش ساخته‌شده و کش زمینه Gemini ---
+# دستورالعمل برای همه چت‌ها یکسان است (chat_id در آن نیست) تا قابل کش شدن باشد
+SYSTEM_INSTRUCTION = (
+    "شما یک دستیار هوشمند CRM با **حافظه کامل (PostgreSQL)** و تحلیلگر هوشمند هستید. "
+    "وظایف شما: ۱. ثبت، به‌روزرسانی، حذف، ثبت گزارش‌ها و تنظیم هشدارها با استفاده از توابع (Tools). "
+    "۲. ارائه گزارش هوشمند و فیلتر شده. در هنگام گزارش‌گیری لیست کامل مشتریان، هوش مصنوعی باید از تابع get_report با query_type='all' استفاده کند؛ فهرست‌ها مستقیماً و صفحه‌بندی‌شده برای کاربر ارسال می‌شوند. برای آمار و شمارش از query_type='count_by_industry' یا 'followups_by_week' استفاده کنید، نه از فهرست کامل. "
+    "برای پرسش‌هایی درباره محتوای گزارش‌های تماس (مثلاً چه کسانی از قیمت رقبا گله کرده‌اند) از search_interactions استفاده کنید، نه از full_customer برای تک‌تک مشتریان. "
+    "۳. **تحلیل هوشمند و ارائه پیشنهاد عملی:** پس از اجرای موفقیت‌آمیز هر تابع **ثبت/حذف**، یک پیشنهاد عملی برای پیگیری بعدی ارائه دهید. "
+    "**قوانین:** 1. هرگاه داده‌های اجباری برای یک تابع جمع‌آوری شد، آن را فراخوانی کنید. 2. همیشه پاسخ های خود را به زبان فارسی و دوستانه بنویسید."
+)
+GEMINI_CONTEXT_CACHE = os.environ.get("GEMINI_CONTEXT_CACHE", "1") == "1"
+GEMINI_CACHE_TTL_SECONDS = int(os.environ.get("GEMINI_CACHE_TTL_SECONDS", "3600"))
+# پس از شکست ساخت کش (مثلاً کمتر بودن محتوا از حداقل توکن کش مدل) تا این مدت فقط پیکربندی عادی استفاده می‌شود
+GEMINI_CACHE_RETRY_SECONDS = 1800
+# کش این مدت پیش از انقضا تمدید می‌شود
+GEMINI_CACHE_RENEW_MARGIN = 120
+
+def build_function_declarations() -> list:
+    """ساخت یک‌باره اعلان توابع از امضا و docstring آن‌ها؛ پارامترهای تزریقی (chat_id) به مدل نشان داده نمی‌شوند."""
+    declarations = []
+    for name, func in TOOL_REGISTRY.items():
+        declaration = types.FunctionDeclaration.from_callable_with_api_option(callable=func, api_option="GEMINI_API")
+        if name in CHAT_ID_TOOLS and declaration.parameters is not None:
+            declaration.parameters.properties.pop("chat_id", None)
+            if declaration.parameters.required:
+                declaration.parameters.required = [p for p in declaration.parameters.required if p != "chat_id"]
+        declarations.append(declaration)
+    return declarations
+
+# اعلان توابع، پیکربندی بدون کش و نسخه «فقط پاسخ متنی» آن یک بار در load_genai ساخته می‌شوند
+AI_TOOLS = None
+MODEL_CONFIG = None
+FORCED_ANSWER_CONFIG = None
+_genai_load_lock = threading.Lock()
+
+def load_genai() -> None:
+    """import تنبل google-genai و ساخت پیکربندی‌های ثابت مدل (یک بار؛ از thread هم قابل فراخوانی است)."""
+    global genai, types, APIError, AI_TOOLS, MODEL_CONFIG, FORCED_ANSWER_CONFIG
+    with _genai_load_lock:
+        if types is not None:
+            return
+        started = time.perf_counter()
+        from google import genai as genai_sdk
+        from google.genai import types as genai_types
+        from google.genai.errors import APIError as genai_api_error
+        genai, types, APIError = genai_sdk, genai_types, genai_api_error
+        
+        AI_TOOLS = [types.Tool(function_declarations=build_function_declarations())]
+        MODEL_CONFIG = types.GenerateContentConfig(
+            system_instruction=SYSTEM_INSTRUCTION,
+            tools=AI_TOOLS,
+            # توابع async هستند و در همین هندلر اجرا می‌شوند، نه توسط SDK
+            automatic_function_calling=types.AutomaticFunctionCallingConfig(disable=True)
+        )
+        FORCED_ANSWER_CONFIG = MODEL_CONFIG.model_copy(update={
+            "tool_config": types.ToolConfig(function_calling_config=types.FunctionCallingConfig(mode="NONE"))
+        })
+        logger.info(f"google-genai loaded and tool declarations built in {time.perf_counter() - started:.2f}s")
+
+
+class GeminiContextCache:
+    """کش صریح Gemini برای دستورالعمل سیستمی و اعلان توابع؛ در صورت عدم امکان MODEL_CONFIG برمی‌گردد."""
+
+    def __init__(self):
+        self.name = None
+        self._config = None
+        self._expires_at = 0.0
+        self._retry_at = 0.0
+        self._lock = asyncio.Lock()
+
+    def _fresh(self) -> bool:
+        return self._config is not None and time.monotonic() < self._expires_at - GEMINI_CACHE_RENEW_MARGIN
+
+    async def config(self):
+        """پیکربندی درخواست: ارجاع به کش در صورت وجود، وگرنه دستورالعمل و توابع درون درخواست."""
+        if not GEMINI_CONTEXT_CACHE or ai_client is None:
+            return MODEL_CONFIG
+        if not self._fresh() and time.monotonic() >= self._retry_at:
+            async with self._lock:
+                if not self._fresh() and time.monotonic() >= self._retry_at:
+                    await self._refresh()
+        return self._config or MODEL_CONFIG
+
+    async def _refresh(self) -> None:
+        ttl = f"{GEMINI_CACHE_TTL_SECONDS}s"
+        try:
+            if self.name:
+                # تمدید کش موجود ارزان‌تر از ساخت دوباره آن است
+                await ai_client.aio.caches.update(name=self.name, config=types.UpdateCachedContentConfig(ttl=ttl))
+            else:
+                cache = await ai_client.aio.caches.create(
+                    model=AI_MODEL,
+                    config=types.CreateCachedContentConfig(
+                        display_name="crm-bot-static", system_instruction=SYSTEM_INSTRUCTION, tools=AI_TOOLS, ttl=ttl
+                    )
+                )
+                self.name = cache.name
+                # درخواست‌های دارای cached_content نباید دستورالعمل و توابع را دوباره بفرستند
+                self._config = types.GenerateContentConfig(
+                    cached_content=cache.name,
+                    automatic_function_calling=types.AutomaticFunctionCallingConfig(disable=True)
+                )
+                logger.info(f"Gemini context cache {cache.name} created for the system instruction and tools.")
+            self._expires_at = time.monotonic() + GEMINI_CACHE_TTL_SECONDS
+        except Exception as e:
+            logger.warning(f"Gemini context cache unavailable; sending instruction and tools inline: {e}")
+            self.invalidate()
+            self._retry_at = time.monotonic() + GEMINI_CACHE_RETRY_SECONDS
+
+    def invalidate(self) -> None:
+        """کنار گذاشتن کش (مثلاً پس از خطای API)؛ در صورت امکان در درخواست بعدی دوباره ساخته می‌شود."""
+        self.name = self._config = None
+        self._expires_at = 0.0
+
+    async def close(self) -> None:
+        """حذف کش هنگام خاموشی تا هزینه نگهداری آن تا پایان TTL ادامه نیابد."""
+        if self.name and ai_client is not None:
+            with contextlib.suppress(Exception):
+                await ai_client.aio.caches.delete(name=self.name)
+        self.invalidate()
+
+
+gemini_context_cache = GeminiContextCache()
+
+
+async def dispatch_tool_call(call, chat_id: int, context: ContextTypes.DEFAULT_TYPE = None):
+    """اجرای یک function call مدل از طریق رجیستری و ساخت Part پاسخ آن."""
+    function_name = call.name
+    args = dict(call.args or {})
+    func = TOOL_REGISTRY.get(function_name)
+    started = time.perf_counter()
+    
+    if func is None:
+        tool_result = f"خطا: تابع {function_name} ناشناخته است."
+    else:
+        if function_name in CHAT_ID_TOOLS:
+            # مدل chat_id را نمی‌بیند؛ همیشه همان گفتگوی جاری است
+            args['chat_id'] = chat_id
+        tool_result = None
+        direct_handler = DIRECT_TOOL_HANDLERS.get(function_name)
+        if direct_handler is not None and context is not None:
+            try:
+                tool_result = await direct_handler(context, chat_id, args)
+            except Exception as e:
+                # خطای ارسال مستقیم یا دیتابیس به‌عنوان نتیجه تابع به مدل برمی‌گردد، نه خطای کل نوبت
+                logger.error(f"Direct handler for {function_name} failed: {e}")
+                tool_result = f"خطا در اجرای تابع {function_name}: {e}"
+        if tool_result is None:
+            try:
+                tool_result = await func(**args)
+            except TypeError as e:
+                tool_result = f"خطا: آرگومان‌های نامعتبر برای تابع {function_name}: {e}"
+    
+    seconds = time.perf_counter() - started
+    TOOL_SECONDS.observe(seconds, tool=function_name)
+    trace_event("tool", function_name, seconds)
+    logger.info(f"Tool {function_name} finished in {seconds:.3f}s")
+    return tool_response_part(function_name, tool_result)
+
+def tool_response_part(function_name: str, tool_result):
+    """ثبت وضعیت فراخوانی در متریک‌ها و ساخت Part پاسخ تابع."""
+    failed = isinstance(tool_result, str) and tool_result.startswith("خطا")
+    TOOL_CALLS.inc(tool=function_name, status="error" if failed else "ok")
+    return types.Part.from_function_response(name=function_name, response={"result": tool_result})
+
+# --- نوشتن دسته‌ای فراخوانی‌های یک نوبت در یک تراکنش (unit of work) ---
+# وقتی مدل در یک نوبت چند تابع نوشتنی فراخوانی می‌کند، همه مشتریان با یک کوئری پیدا و همه نوشتن‌ها در یک تراکنش ثبت می‌شوند
+WRITE_BATCH_ENABLED = os.environ.get("WRITE_BATCH_ENABLED", "1") == "1"
+# ترتیب مرحله‌های WriteBatch
+WRITE_TOOLS = ("manage_customer_data", "log_interaction", "set_reminder", "delete_customer")
+
+
+class WriteBatch:
+    """نوشتن‌های یک نوبت: اعتبارسنجی هر فراخوانی، یافتن و قفل مشتریان با یک SELECT ... FOR UPDATE و اعمال با executemany.
+
+    فراخوانی‌ها در مرحله‌هایی به ترتیب WRITE_TOOLS (ثبت/به‌روزرسانی، تعامل، یادآوری، حذف و دوباره از اول) اعمال می‌شوند؛
+    هر فراخوانی در نخستین مرحله هم‌نوع پس از فراخوانی‌های قبلی همان مشتری (یا همان تلفن) قرار می‌گیرد،
+    پس ترتیب مدل برای هر مشتری حفظ می‌شود و فراخوانی‌های مشتریان مختلف با هم دسته می‌شوند.
+    فراخوانی نامعتبر (مثلاً مشتری ناموجود) فقط نتیجه خطای خودش را می‌گیرد؛
+    خطای دیتابیس کل تراکنش را برمی‌گرداند و به همه فراخوانی‌ها گزارش می‌شود.
+    """
+
+    def __init__(self, calls: list, chat_id: int):
+        self.calls = calls
+        self.chat_id = chat_id
+        self.results = [None] * len(calls)
+        # normalize_lookup_key نام (معادل crm_name_key) -> ردیف‌های مشتری (به ترتیب id)
+        self.by_name = {}
+        self.by_phone = {}
+        self.touched_names = set()
+        self.due_times = []
+
+    def _bind_args(self, index: int):
+        """آرگومان‌های فراخوانی با امضای تابع؛ در صورت نامعتبر بودن نتیجه خطا ثبت و None برگردانده می‌شود."""
+        call = self.calls[index]
+        args = dict(call.args or {})
+        if call.name in CHAT_ID_TOOLS:
+            args['chat_id'] = self.chat_id
+        try:
+            bound = inspect.signature(TOOL_REGISTRY[call.name]).bind(**args)
+        except TypeError as e:
+            self.results[index] = f"خطا: آرگومان‌های نامعتبر برای تابع {call.name}: {e}"
+            return None
+        bound.apply_defaults()
+        return bound.arguments
+
+    def _find(self, name: str, phone: str = None):
+        """همان قاعده find_customer_data: ابتدا نام و تلفن، سپس قدیمی‌ترین مشتری هم‌نام."""
+        rows = self.by_name.get(normalize_lookup_key(name), [])
+        if phone:
+            for row in rows:
+                if row[2] == phone:
+                    return row
+        return rows[0] if rows else None
+
+    def _remember(self, row) -> None:
+        rows = self.by_name.setdefault(normalize_lookup_key(row[1]), [])
+        rows[:] = sorted([r for r in rows if r[0] != row[0]] + [row])
+        if row[2]:
+            self.by_phone[row[2]] = row
+
+    def _forget(self, customer_id: int) -> None:
+        for rows in self.by_name.values():
+            rows[:] = [r for r in rows if r[0] != customer_id]
+        self.by_phone = {phone: row for phone, row in self.by_phone.items() if row[0] != customer_id}
+
+    def _order_keys(self, name: str, args: dict) -> set:
+        """کلیدهایی که ترتیب فراخوانی‌ها روی آن‌ها باید حفظ شود: نام مشتری و تلفن‌هایی که ثبت یا آزاد می‌کند."""
+        key = normalize_lookup_key(args.get("name") or args.get("customer_name"))
+        keys = {key}
+        if name == "manage_customer_data" and args.get("phone"):
+            keys.add(("phone", args["phone"]))
+        elif name == "delete_customer":
+            keys.update(("phone", row[2]) for row in self.by_name.get(key, []))
+        return keys
+
+    def _stages(self, bound: list) -> list:
+        """تقسیم فراخوانی‌ها به مرحله‌ها؛ مرحله s از نوع WRITE_TOOLS[s % len(WRITE_TOOLS)] است."""
+        last_stage = {}
+        stages = {}
+        for i, args in enumerate(bound):
+            if args is None:
+                continue
+            name = self.calls[i].name
+            keys = self._order_keys(name, args)
+            floor = max(last_stage.get(key, 0) for key in keys)
+            # نخستین مرحله هم‌نوع از floor به بعد (در همان مرحله executemany ترتیب را حفظ می‌کند)
+            stage = floor + (WRITE_TOOLS.index(name) - floor) % len(WRITE_TOOLS)
+            for key in keys:
+                last_stage[key] = stage
+            stages.setdefault(stage, []).append(i)
+        return [stages[stage] for stage in sorted(stages)]
+
+    async def run(self) -> list:
+        bound = [self._bind_args(i) for i in range(len(self.calls))]
+        names, phones = set(), set()
+        for args in filter(None, bound):
+            name = args.get("name") or args.get("customer_name")
+            if name:
+                names.add(normalize_lookup_key(name))
+            if args.get("phone"):
+                phones.add(args["phone"])
+        
+        pool = await get_db_pool()
+        if pool is None:
+            return ["خطا: سرویس حافظه دائمی (PostgreSQL) فعال نیست." if r is None else r for r in self.results]
+        pending = [i for i, args in enumerate(bound) if args is not None]
+        appliers = {
+            "manage_customer_data": self._apply_customers,
+            "log_interaction": self._apply_interactions,
+            "set_reminder": self._apply_reminders,
+            "delete_customer": self._apply_deletes,
+        }
+        try:
+            async with pool.connection() as conn, conn.transaction(), conn.cursor() as cursor:
+                # یافتن و قفل مشتریان داخل همان تراکنش تا نوشتن هم‌زمان دیگری بین بررسی و نوشتن آن‌ها را تغییر ندهد
+                await cursor.execute(
+                    f"SELECT {CUSTOMER_COLUMNS} FROM customers WHERE crm_name_key(name) = ANY(%s) OR phone = ANY(%s) ORDER BY id FOR UPDATE",
+                    (list(names), list(phones))
+                )
+                for row in await cursor.fetchall():
+                    self._remember(row)
+                for indexes in self._stages(bound):
+                    await appliers[self.calls[indexes[0]].name](cursor, bound, indexes)
+        except psycopg.Error as e:
+            if e.sqlstate == '23505':  # شماره تلفن تکراری
+                error = f"خطا: شماره تلفن تکراری است ({e.diag.message_detail}). هیچ‌کدام از تغییرات این نوبت ثبت نشد."
+            else:
+                error = f"خطای دیتابیس؛ هیچ‌کدام از تغییرات این نوبت ثبت نشد: {e}"
+            for i in pending:
+                self.results[i] = error
+            return self.results
+        
+        # پس از commit: یک باطل‌سازی کش (و یک NOTIFY) برای همه مشتریان تغییرکرده
+        if self.touched_names:
+            await invalidate_customer_cache(*self.touched_names)
+        for due_time in self.due_times:
+            if reminder_scheduler is not None:
+                reminder_scheduler.notify(due_time)
+        return self.results
+
+    async def _apply_customers(self, cursor, bound: list, indexes: list) -> None:
+        inserts = {}  # نام نرمال‌شده -> [آرگومان‌های ادغام‌شده، شماره فراخوانی‌ها]
+        updates = []
+        for i in indexes:
+            args = bound[i]
+            name, phone = args["name"], args["phone"]
+            if not name or not phone:
+                self.results[i] = "خطا: نام و شماره تلفن برای ثبت یا به‌روزرسانی مشتری الزامی هستند."
+                continue
+            existing = self._find(name, phone)
+            if existing is None:
+                key = normalize_lookup_key(name)
+                owner = self.by_phone.get(phone)
+                if (owner is not None and normalize_lookup_key(owner[1]) != key) or any(
+                        entry[0]["phone"] == phone and other != key for other, entry in inserts.items()):
+                    # همان پیام manage_customer_data؛ بقیه نوشتن‌های نوبت به خاطر این فراخوانی برنمی‌گردند
+                    self.results[i] = f"خطا: شماره تلفن '{phone}' قبلاً برای مشتری دیگری ثبت شده است."
+                    continue
+                entry = inserts.setdefault(key, [dict(args), []])
+                entry[0].update({k: args[k] for k in ("company", "industry", "services") if args[k] is not None})
+                entry[1].append(i)
+                continue
+            changed = {
+                field: args[field] for position, field in ((3, "company"), (4, "industry"), (5, "services"))
+                if args[field] is not None and args[field] != existing[position]
+            }
+            if not changed:
+                self.results[i] = f"مشتری '{name}' قبلاً ثبت شده و اطلاعات جدیدی برای به‌روزرسانی وجود نداشت."
+                continue
+            updated = (existing[0], existing[1], existing[2], changed.get("company", existing[3]),
+                       changed.get("industry", existing[4]), changed.get("services", existing[5]))
+            self._remember(updated)
+            updates.append((updated[3], updated[4], updated[5], existing[0]))
+            self.touched_names.update((name, existing[1]))
+            self.results[i] = f"اطلاعات مشتری '{name}' با موفقیت به‌روزرسانی شد."
+        
+        if updates:
+            await cursor.executemany("UPDATE customers SET company = %s, industry = %s, services = %s WHERE id = %s", updates)
+        if inserts:
+            entries = list(inserts.values())
+            await cursor.executemany(
+                f"INSERT INTO customers (name, phone, company, industry, services) VALUES (%s, %s, %s, %s, %s) RETURNING {CUSTOMER_COLUMNS}",
+                [(a["name"], a["phone"], a["company"], a["industry"], a["services"]) for a, _ in entries],
+                returning=True
+            )
+            for args, call_indexes in entries:
+                row = await cursor.fetchone()
+                cursor.nextset()
+                self._remember(row)
+                self.touched_names.add(args["name"])
+                for i in call_indexes:
+                    self.results[i] = f"عملیات ثبت مشتری موفق بود. مشتری '{args['name']}' (ID: {row[0]}) با موفقیت ثبت شد."
+
+    async def _apply_interactions(self, cursor, bound: list, indexes: list) -> None:
+        rows, applied = [], []
+        for i in indexes:
+            args = bound[i]
+            customer = self._find(args["customer_name"])
+            if customer is None:
+                self.results[i] = f"خطا: مشتری با نام '{args['customer_name']}' در دیتابیس پیدا نشد. لطفا ابتدا او را ثبت کنید."
+                continue
+            rows.append((customer[0], args["customer_name"], TODAY_DATE, args["interaction_report"], args["follow_up_date"], args["chat_id"]))
+            applied.append(i)
+            self.touched_names.update((args["customer_name"], customer[1]))
+        if not rows:
+            return
+        await cursor.executemany(
+            "INSERT INTO interactions (customer_id, customer_name, interaction_date, report, follow_up_date, chat_id) VALUES (%s, %s, %s, %s, %s, %s) RETURNING id",
+            rows, returning=True
+        )
+        for i in applied:
+            new_id = (await cursor.fetchone())[0]
+            cursor.nextset()
+            args = bound[i]
+            follow_up_msg = f"پیگیری بعدی برای تاریخ {args['follow_up_date']} تنظیم شد." if args["follow_up_date"] else ""
+            self.results[i] = f"گزارش تماس با '{args['customer_name']}' با موفقیت در دیتابیس ثبت شد. (ID: {new_id}). {follow_up_msg}"
+
+    async def _apply_reminders(self, cursor, bound: list, indexes: list) -> None:
+        rows, applied = [], []
+        for i in indexes:
+            args = bound[i]
+            try:
+                utc_datetime = IRAN_TZ.localize(datetime.strptime(args["date_time"], "%Y-%m-%d %H:%M")).astimezone(pytz.utc)
+            except (TypeError, ValueError):
+                self.results[i] = "خطا: فرمت تاریخ و زمان هشدار باید به شکل YYYY-MM-DD HH:MM باشد."
+                continue
+            if utc_datetime < datetime.now(pytz.utc):
+                self.results[i] = "خطا: زمان یادآوری تعیین شده در گذشته است. لطفا زمان آینده را مشخص کنید."
+                continue
+            customer = self._find(args["customer_name"])
+            rows.append((args["chat_id"], customer[0] if customer else None, args["customer_name"], args["reminder_text"], utc_datetime))
+            applied.append(i)
+        if not rows:
+            return
+        await cursor.executemany(
+            "INSERT INTO reminders (chat_id, customer_id, customer_name, reminder_text, due_date_time) VALUES (%s, %s, %s, %s, %s) RETURNING id",
+            rows, returning=True
+        )
+        payloads = []
+        for i, row in zip(applied, rows):
+            new_id = (await cursor.fetchone())[0]
+            cursor.nextset()
+            payloads.append(f"{new_id},{row[4].timestamp()}")
+            self.due_times.append(row[4])
+            args = bound[i]
+            self.touched_names.add(args["customer_name"])
+            self.results[i] = f"هشدار با متن '{args['reminder_text'][:30]}...' برای {args['date_time']} (به وقت ایران) با موفقیت در دیتابیس ثبت شد. (ID: {new_id})"
+        # NOTIFYهای داخل تراکنش پس از commit تحویل داده می‌شوند
+        await cursor.execute("SELECT pg_notify(%s, payload) FROM unnest(%s::text[]) AS payload", (REMINDERS_CHANNEL, payloads))
+
+    async def _apply_deletes(self, cursor, bound: list, indexes: list) -> None:
+        targets = {}  # id مشتری -> (نام، شماره فراخوانی‌ها)
+        for i in indexes:
+            args = bound[i]
+            customer = self._find(args["name"], args["phone"])
+            if customer is None:
+                self.results[i] = f"خطا: مشتری با نام '{args['name']}' در دیتابیس پیدا نشد."
+                continue
+            targets.setdefault(customer[0], (customer[1], []))[1].append(i)
+            self.touched_names.update((args["name"], customer[1]))
+            # فراخوانی‌های بعدی همین مرحله (و مرحله‌های بعد) این مشتری را دیگر نمی‌بینند
+            self._forget(customer[0])
+        if not targets:
+            return
+        # حذف همه مشتریان، تعاملات و یادآوری‌هایشان در یک دستور (ردیف‌های قدیمی بدون customer_id با نام)
+        await cursor.execute("""
+            WITH targets AS (
+                SELECT * FROM unnest(%(ids)s::int[], %(names)s::text[]) AS t(id, name)
+            ), deleted_interactions AS (
+                DELETE FROM interactions i USING targets t
+                WHERE i.customer_id = t.id OR (i.customer_id IS NULL AND crm_name_key(i.customer_name) = crm_name_key(t.name))
+                RETURNING t.id
+            ), deleted_reminders AS (
+                DELETE FROM reminders r USING targets t
+                WHERE r.customer_id = t.id OR (r.customer_id IS NULL AND crm_name_key(r.customer_name) = crm_name_key(t.name))
+                RETURNING t.id
+            ), deleted_customers AS (
+                DELETE FROM customers WHERE id = ANY(%(ids)s) RETURNING id
+            )
+            SELECT c.id,
+                   (SELECT COUNT(*) FROM deleted_interactions d WHERE d.id = c.id),
+                   (SELECT COUNT(*) FROM deleted_reminders r WHERE r.id = c.id)
+            FROM deleted_customers c
+        """, {"ids": list(targets), "names": [name for name, _ in targets.values()]})
+        for customer_id, deleted_interactions, deleted_reminders in await cursor.fetchall():
+            customer_name, call_indexes = targets[customer_id]
+            for i in call_indexes:
+                self.results[i] = f"مشتری '{customer_name}' با موفقیت حذف شد. ({deleted_interactions} گزارش تعامل و {deleted_reminders} یادآوری نیز حذف شدند.)"
+
+
+def _tool_call_group(call, index: int):
+    """کلید وابستگی فراخوانی: توابعی که به یک مشتری مربوط‌اند به ترتیب و بقیه موازی اجرا می‌شوند."""
+    args = call.args or {}
+    customer = args.get("name") or args.get("customer_name")
+    if customer:
+        return normalize_lookup_key(customer)
+    return index
+
+async def execute_tool_calls(function_calls, chat_id: int, context: ContextTypes.DEFAULT_TYPE = None) -> list:
+    """اجرای فراخوانی‌های یک دور؛ نوشتن‌ها در یک تراکنش و گروه‌های مستقل خواندن هم‌زمان روی استخر دیتابیس اجرا می‌شوند."""
+    results = [None] * len(function_calls)
+    pending = range(len(function_calls))
+    
+    write_indexes = [i for i, call in enumerate(function_calls) if call.name in WRITE_TOOLS]
+    if WRITE_BATCH_ENABLED and len(write_indexes) > 1 and await get_db_pool() is not None:
+        started = time.perf_counter()
+        batch_results = await WriteBatch([function_calls[i] for i in write_indexes], chat_id).run()
+        seconds = time.perf_counter() - started
+        TOOL_SECONDS.observe(seconds, tool="write_batch")
+        trace_event("tool", "write_batch", seconds)
+        logger.info(f"Write batch of {len(write_indexes)} calls finished in {seconds:.3f}s")
+        for i, tool_result in zip(write_indexes, batch_results):
+            results[i] = tool_response_part(function_calls[i].name, tool_result)
+        # خواندن‌ها پس از commit اجرا می‌شوند تا تغییرات همین نوبت را ببینند
+        pending = [i for i in pending if results[i] is None]
+    
+    groups = {}
+    for index in pending:
+        groups.setdefault(_tool_call_group(function_calls[index], index), []).append(index)
+    
+    async def run_group(indexes):
+        for i in indexes:
+            results[i] = await dispatch_tool_call(function_calls[i], chat_id, context)
+    
+    await asyncio.gather(*(run_group(indexes) for indexes in groups.values()))
+    # ترتیب پاسخ‌ها باید با ترتیب فراخوانی‌های مدل یکسان باشد
+    return results
+
+# =================================================================
+# --- توابع مدیریت تلگرام و وظیفه بک‌گراند ---
+# =================================================================
+
+# --- خروجی فایل به‌صورت جریانی (بدون بارگذاری کل جدول در حافظه) ---
+# نام جدول -> (پیشوند نام فایل، عنوان فارسی، کوئری)
+EXPORT_TABLES = {
+    "customers": ("CRM_Customers", "مشتریان",
+                  f"SELECT {CUSTOMER_COLUMNS} FROM customers ORDER BY id"),
+    "interactions": ("CRM_Interactions", "گزارشات تعامل",
+                     "SELECT id, customer_id, customer_name, interaction_date, report, follow_up_date FROM interactions ORDER BY id"),
+    "reminders": ("CRM_Reminders", "یادآوری‌ها",
+                  "SELECT id, chat_id, customer_id, customer_name, reminder_text, due_date_time, sent, delivery_status FROM reminders ORDER BY id"),
+}
+# فایل موقت تا این حجم در حافظه می‌ماند و پس از آن روی دیسک نوشته می‌شود
+EXPORT_SPOOL_BYTES = 8 * 1024 * 1024
+# اندازه تکه‌هایی که در thread جداگانه فشرده/نوشته می‌شوند و تعداد ردیف هر fetch در XLSX
+EXPORT_WRITE_CHUNK = 256 * 1024
+EXPORT_FETCH_SIZE = 2000
+
+def _xlsx_value(value):
+    """تبدیل مقادیر به نوع قابل ذخیره در XLSX (زمان‌ها به وقت ایران و بدون tzinfo)."""
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        return value.astimezone(IRAN_TZ).replace(tzinfo=None)
+    return value
+
+def _append_xlsx_rows(sheet, rows) -> None:
+    for row in rows:
+        sheet.append([_xlsx_value(value) for value in row])
+
+async def _export_csv(pool, query: str, out) -> int:
+    """COPY ... TO STDOUT (نقل‌قول استاندارد CSV توسط خود PostgreSQL) به‌صورت تکه‌تکه در فایل خروجی."""
+    buffer = bytearray(b"\xef\xbb\xbf")  # BOM برای نمایش درست فارسی در Excel
+    async with pool.connection() as conn, conn.cursor() as cursor:
+        async with cursor.copy(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER true)") as copy:
+            async for chunk in copy:
+                buffer += chunk
+                if len(buffer) >= EXPORT_WRITE_CHUNK:
+                    # فشرده‌سازی و نوشتن روی دیسک خارج از event loop
+                    await run_blocking(out.write, bytes(buffer))
+                    buffer.clear()
+        row_count = cursor.rowcount
+    if buffer:
+        await run_blocking(out.write, bytes(buffer))
+    return row_count
+
+async def _export_xlsx(pool, query: str, spool) -> int:
+    """خواندن با server-side cursor و نوشتن در workbook حالت write-only (در thread جداگانه)."""
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    row_count = 0
+    async with pool.connection() as conn:
+        # cursor نام‌دار فقط داخل تراکنش معتبر است
+        async with conn.transaction(), conn.cursor(name="crm_export") as cursor:
+            await cursor.execute(query)
+            header_written = False
+            while True:
+                rows = await cursor.fetchmany(EXPORT_FETCH_SIZE)
+                if not header_written:
+                    sheet.append([desc[0] for desc in cursor.description])
+                    header_written = True
+                if not rows:
+                    break
+                row_count += len(rows)
+                await run_blocking(_append_xlsx_rows, sheet, rows)
+    await run_blocking(workbook.save, spool)
+    return row_count
+
+async def build_export_file(table: str = "customers", file_format: str = "csv", compress: bool = False):
+    """ساخت فایل خروجی یک جدول در فایل موقت spooled؛ (فایل، نام فایل، تعداد ردیف) را برمی‌گرداند."""
+    pool = await get_db_pool()
+    if pool is None:
+        return None, None, 0
+    prefix, _, query = EXPORT_TABLES[table]
+    spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES)
+    file_name = f"{prefix}_Export_{TODAY_DATE}.{file_format}"
+    try:
+        if file_format == "xlsx":
+            row_count = await _export_xlsx(pool, query, spool)
+        else:
+            out = gzip.GzipFile(fileobj=spool, mode="wb") if compress else spool
+            row_count = await _export_csv(pool, query, out)
+            if compress:
+                await run_blocking(out.close)
+                file_name += ".gz"
+    except BaseException:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool, file_name, row_count
+
+async def send_export_file(bot, chat_id: int, table: str, file_format: str, compress: bool) -> str:
+    """ساخت فایل خروجی و ارسال آن به کاربر (داخل کار پس‌زمینه)؛ خلاصه نتیجه را برمی‌گرداند."""
+    await bot.send_chat_action(chat_id=chat_id, action=ChatAction.UPLOAD_DOCUMENT)
+    started = time.perf_counter()
+    spool, file_name, row_count = await build_export_file(table, file_format, compress)
+    if spool is None:
+        raise RuntimeError("PostgreSQL is not configured")
+    with spool:
+        if not row_count:
+            await bot.send_message(chat_id=chat_id, text=f"⚠️ جدول {EXPORT_TABLES[table][1]} خالی است. فایلی برای ارسال وجود ندارد.")
+            return "جدول خالی بود؛ فایلی ارسال نشد."
+        logger.info(f"Built export {file_name} ({row_count} rows) in {time.perf_counter() - started:.2f}s")
+        await bot.send_document(
+            chat_id=chat_id, 
+            document=spool,
+            filename=file_name,
+            caption=f"فایل کامل {EXPORT_TABLES[table][1]} CRM (حافظه دائمی PostgreSQL) - {row_count} ردیف"
+        )
+    EXPORT_SECONDS.observe(time.perf_counter() - started, table=table, format=file_format)
+    return f"{file_name} ({row_count} ردیف) ارسال شد."
+
+async def export_data_to_file(update: Update, context: ContextTypes.DEFAULT_TYPE, table: str = "customers",
+                              file_format: str = "csv", compress: bool = False) -> None:
+    """ثبت خروجی (CSV، CSV.GZ یا XLSX) یک جدول CRM به‌عنوان کار پس‌زمینه و تأیید فوری آن به کاربر."""
+    chat_id = update.effective_chat.id
+    pool = await get_db_pool()
+    if pool is None:
+        await context.bot.send_message(chat_id=chat_id, text="⚠️ سرویس حافظه دائمی (PostgreSQL) فعال نیست.")
+        return
+    
+    title = f"خروجی {EXPORT_TABLES[table][1]} ({file_format}{'.gz' if compress else ''})"
+    job = job_runner.submit(
+        chat_id, "export", title,
+        lambda bot: send_export_file(bot, chat_id, table, file_format, compress),
+        JOB_PRIORITY_EXPORT
+    )
+    await context.bot.send_message(chat_id=chat_id, text=job_ack_text(job))
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """دستور /export [customers|interactions|reminders] [csv|gz|xlsx]"""
+    table, file_format, compress = "customers", "csv", False
+    for arg in (a.lower() for a in context.args or []):
+        if arg in EXPORT_TABLES:
+            table = arg
+        elif arg in ("gz", "gzip"):
+            compress = True
+        elif arg == "xlsx":
+            if openpyxl is None:
+                await update.message.reply_text("⚠️ خروجی XLSX در این سرور فعال نیست (کتابخانه openpyxl نصب نشده). از CSV استفاده کنید.")
+                return
+            file_format = "xlsx"
+        elif arg != "csv":
+            await update.message.reply_text(
+                "راهنما: `/export [customers|interactions|reminders] [csv|gz|xlsx]`", parse_mode='Markdown'
+            )
+            return
+    async with chat_turn_lock(update.effective_chat.id):
+        await export_data_to_file(update, context, table, file_format, compress)
+
+# --- ورود دسته‌ای مشتریان و تعاملات از فایل CSV/XLSX (COPY به جدول موقت و upsert یک‌جا) ---
+# سقف حجم فایلی که Bot API اجازه دانلود می‌دهد
+IMPORT_MAX_BYTES = 20 * 1024 * 1024
+# تعداد ردیف‌هایی که در هر نوبت از فایل خوانده و با COPY ارسال می‌شوند
+IMPORT_BATCH_ROWS = 5000
+# تعداد نمونه خطاهایی که به کاربر نشان داده می‌شود
+IMPORT_ERROR_SAMPLES = 5
+
+# نام ستون‌های قابل قبول در سطر عنوان فایل (نرمال‌شده) -> فیلد
+IMPORT_COLUMN_ALIASES = {
+    "name": "name", "customer": "name", "customer_name": "name", "نام": "name", "نام مشتری": "name",
+    "phone": "phone", "mobile": "phone", "tel": "phone", "تلفن": "phone", "شماره": "phone",
+    "شماره تلفن": "phone", "موبایل": "phone", "شماره تماس": "phone",
+    "company": "company", "شرکت": "company", "نام شرکت": "company",
+    "industry": "industry", "صنعت": "industry", "حوزه": "industry", "حوزه فعالیت": "industry",
+    "services": "services", "خدمات": "services",
+    "report": "report", "interaction_report": "report", "گزارش": "report", "گزارش تماس": "report",
+    "date": "interaction_date", "interaction_date": "interaction_date", "تاریخ": "interaction_date",
+    "follow_up_date": "follow_up_date", "follow_up": "follow_up_date", "پیگیری": "follow_up_date",
+    "تاریخ پیگیری": "follow_up_date",
+}
+# فیلدهای جدول موقت هر نوع فایل به ترتیب ستون‌های COPY
+IMPORT_FIELDS = {
+    "customers": ("name", "phone", "company", "industry", "services"),
+    "interactions": ("name", "phone", "report", "interaction_date", "follow_up_date"),
+}
+
+_DIGITS_TO_ASCII = str.maketrans("۰۱۲۳۴۵۶۷۸۹٠١٢٣٤٥٦٧٨٩", "01234567890123456789")
+
+def normalize_phone(raw) -> str:
+    """شماره تلفن با ارقام لاتین و پیش‌شماره ایران به‌صورت 0...؛ شماره نامعتبر None برمی‌گرداند."""
+    if raw is None:
+        return None
+    if isinstance(raw, float) and raw.is_integer():
+        # Excel شماره‌ها را عدد ذخیره می‌کند و صفر ابتدایی حذف می‌شود
+        raw = str(int(raw))
+    digits = "".join(ch for ch in str(raw).translate(_DIGITS_TO_ASCII) if ch.isdigit())
+    if digits.startswith("0098"):
+        digits = "0" + digits[4:]
+    elif digits.startswith("98") and len(digits) == 12:
+        digits = "0" + digits[2:]
+    elif digits.startswith("9") and len(digits) == 10:
+        digits = "0" + digits
+    if not 7 <= len(digits) <= 15:
+        return None
+    return digits
+
+def _parse_import_date(value):
+    if value is None or value == "":
+        return None
+    if isinstance(value, datetime):
+        return value.date()
+    text = str(value).translate(_DIGITS_TO_ASCII).strip()
+    for fmt in ("%Y-%m-%d", "%Y/%m/%d", "%Y-%m-%d %H:%M:%S"):
+        try:
+            return datetime.strptime(text, fmt).date()
+        except ValueError:
+            continue
+    raise ValueError(f"تاریخ نامعتبر '{text}'")
+
+def _import_cell(value):
+    if value is None:
+        return None
+    text = str(value).strip()
+    return text or None
+
+def _open_import_rows(spool, file_format: str):
+    """iterator سطرهای فایل (هر سطر یک tuple)؛ فایل به‌صورت جریانی خوانده می‌شود."""
+    spool.seek(0)
+    if file_format == "xlsx":
+        workbook = openpyxl.load_workbook(spool, read_only=True, data_only=True)
+        return workbook.active.iter_rows(values_only=True)
+    text = io.TextIOWrapper(spool, encoding="utf-8-sig", newline="")
+    return csv.reader(text)
+
+def _read_import_batch(rows, size: int) -> list:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            break
+    return batch
+
+def _map_import_header(header) -> dict:
+    """فیلد -> ایندکس ستون بر اساس سطر عنوان."""
+    columns = {}
+    for index, title in enumerate(header or ()):
+        field = IMPORT_COLUMN_ALIASES.get(normalize_lookup_key(title).replace(" ", "_")) \
+            or IMPORT_COLUMN_ALIASES.get(normalize_lookup_key(title))
+        if field and field not in columns:
+            columns[field] = index
+    return columns
+
+def _validate_import_row(kind: str, columns: dict, row) -> tuple:
+    """تبدیل یک سطر فایل به سطر جدول موقت؛ در صورت نامعتبر بودن ValueError."""
+    def cell(field):
+        index = columns.get(field)
+        return row[index] if index is not None and index < len(row) else None
+    
+    name = _import_cell(cell("name"))
+    raw_phone = cell("phone")
+    phone = normalize_phone(raw_phone)
+    if raw_phone not in (None, "") and phone is None:
+        raise ValueError(f"شماره تلفن نامعتبر '{raw_phone}'")
+    if kind == "customers":
+        if not name or not phone:
+            raise ValueError("نام و شماره تلفن الزامی هستند")
+        return (name, phone, _import_cell(cell("company")), _import_cell(cell("industry")), _import_cell(cell("services")))
+    report = _import_cell(cell("report"))
+    if not report or not (name or phone):
+        raise ValueError("گزارش و نام یا تلفن مشتری الزامی هستند")
+    return (name, phone, report, _parse_import_date(cell("interaction_date")), _parse_import_date(cell("follow_up_date")))
+
+async def _upsert_imported_customers(cursor) -> dict:
+    # تکرار یک تلفن در فایل: آخرین سطر معتبر است؛ ستون‌های خالی مقدار قبلی را پاک نمی‌کنند
+    await cursor.execute("""
+        WITH staged AS (
+            SELECT DISTINCT ON (phone) name, phone, company, industry, services
+            FROM import_rows ORDER BY phone, row_no DESC
+        ), upserted AS (
+            INSERT INTO customers (name, phone, company, industry, services)
+            SELECT name, phone, company, industry, services FROM staged
+            ON CONFLICT (phone) DO UPDATE SET
+                company = COALESCE(EXCLUDED.company, customers.company),
+                industry = COALESCE(EXCLUDED.industry, customers.industry),
+                services = COALESCE(EXCLUDED.services, customers.services)
+            WHERE (customers.company, customers.industry, customers.services) IS DISTINCT FROM
+                  (COALESCE(EXCLUDED.company, customers.company), COALESCE(EXCLUDED.industry, customers.industry),
+                   COALESCE(EXCLUDED.services, customers.services))
+            RETURNING (xmax = 0) AS inserted
+        )
+        SELECT (SELECT COUNT(*) FROM staged),
+               COUNT(*) FILTER (WHERE inserted),
+               COUNT(*) FILTER (WHERE NOT inserted)
+        FROM upserted
+    """)
+    staged, inserted, updated = await cursor.fetchone()
+    return {"inserted": inserted, "updated": updated, "unchanged": staged - inserted - updated}
+
+async def _insert_imported_interactions(cursor, chat_id: int = None) -> dict:
+    # مشتری ابتدا با تلفن و سپس با نام (قدیمی‌ترین مشتری هم‌نام، با همان crm_name_key جستجوی چت) پیدا می‌شود
+    await cursor.execute("""
+        WITH resolved AS (
+            SELECT s.row_no, COALESCE(by_phone.id, by_name.id) AS customer_id,
+                   s.interaction_date, s.report, s.follow_up_date
+            FROM import_rows s
+            LEFT JOIN customers by_phone ON by_phone.phone = s.phone
+            LEFT JOIN LATERAL (
+                SELECT id FROM customers
+                WHERE by_phone.id IS NULL AND crm_name_key(name) = crm_name_key(s.name)
+                ORDER BY id LIMIT 1
+            ) by_name ON true
+        ), inserted AS (
+            INSERT INTO interactions (customer_id, customer_name, interaction_date, report, follow_up_date, chat_id)
+            SELECT r.customer_id, c.name, COALESCE(r.interaction_date, current_date), r.report, r.follow_up_date, %s
+            FROM resolved r JOIN customers c ON c.id = r.customer_id
+            ORDER BY r.row_no
+            RETURNING 1
+        )
+        SELECT (SELECT COUNT(*) FROM inserted), (SELECT COUNT(*) FROM resolved WHERE customer_id IS NULL)
+    """, (chat_id,))
+    inserted, unknown = await cursor.fetchone()
+    return {"inserted": inserted, "unknown_customer": unknown}
+
+async def import_file(spool, file_format: str, kind: str = None, chat_id: int = None) -> dict:
+    """خواندن جریانی فایل، COPY سطرهای معتبر به جدول موقت و upsert یک‌جا در یک تراکنش.
+
+    kind (customers یا interactions) در صورت خالی بودن از روی ستون «گزارش» تشخیص داده می‌شود.
+    تعاملات واردشده به chat_id فرستنده فایل نسبت داده می‌شوند (برای خلاصه روزانه پیگیری‌ها).
+    """
+    pool = await get_db_pool()
+    if pool is None:
+        raise RuntimeError("PostgreSQL is not configured")
+    rows = await asyncio.to_thread(_open_import_rows, spool, file_format)
+    header = (await asyncio.to_thread(_read_import_batch, rows, 1) or [None])[0]
+    columns = _map_import_header(header)
+    kind = kind or ("interactions" if "report" in columns else "customers")
+    stats = {"kind": kind, "rows": 0, "rejected": 0, "errors": []}
+    if "name" not in columns and "phone" not in columns:
+        stats["errors"].append("سطر اول فایل باید عنوان ستون‌ها (مثلاً name, phone) باشد.")
+        return stats
+    
+    fields = IMPORT_FIELDS[kind]
+    async with pool.connection() as conn, conn.transaction(), conn.cursor() as cursor:
+        await cursor.execute(f"""
+            CREATE TEMP TABLE import_rows (
+                row_no INTEGER, name TEXT, phone TEXT,
+                {"company TEXT, industry TEXT, services TEXT" if kind == "customers" else "report TEXT, interaction_date DATE, follow_up_date DATE"}
+            ) ON COMMIT DROP
+        """)
+        row_no = 1
+        while True:
+            batch = await asyncio.to_thread(_read_import_batch, rows, IMPORT_BATCH_ROWS)
+            if not batch:
+                break
+            async with cursor.copy(f"COPY import_rows (row_no, {', '.join(fields)}) FROM STDIN") as copy:
+                for row in batch:
+                    row_no += 1
+                    if not any(value not in (None, "") for value in row):
+                        continue
+                    stats["rows"] += 1
+                    try:
+                        await copy.write_row((row_no, *_validate_import_row(kind, columns, row)))
+                    except ValueError as e:
+                        stats["rejected"] += 1
+                        if len(stats["errors"]) < IMPORT_ERROR_SAMPLES:
+                            stats["errors"].append(f"سطر {row_no}: {e}")
+        
+        if kind == "customers":
+            stats.update(await _upsert_imported_customers(cursor))
+        else:
+            stats.update(await _insert_imported_interactions(cursor, chat_id))
+    await invalidate_all_customer_caches()
+    return stats
+
+def format_import_summary(file_name: str, stats: dict, seconds: float) -> str:
+    if stats["kind"] == "customers":
+        lines = [
+            f"📥 ورود مشتریان از «{file_name}» ({stats['rows']} سطر در {seconds:.1f} ثانیه):",
+            f"✅ جدید: {stats.get('inserted', 0)}",
+            f"🔄 به‌روزرسانی: {stats.get('updated', 0)}",
+            f"➖ بدون تغییر: {stats.get('unchanged', 0)}",
+        ]
+    else:
+        lines = [
+            f"📥 ورود گزارشات تعامل از «{file_name}» ({stats['rows']} سطر در {seconds:.1f} ثانیه):",
+            f"✅ ثبت‌شده: {stats.get('inserted', 0)}",
+            f"❔ مشتری پیدا نشد: {stats.get('unknown_customer', 0)}",
+        ]
+    lines.append(f"⛔ رد شده: {stats['rejected']}")
+    if stats["errors"]:
+        lines.append("\nنمونه خطاها:")
+        lines.extend(f" - {error}" for error in stats["errors"])
+    return "\n".join(lines)
+
+async def document_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """دریافت فایل CSV/XLSX و ورود دسته‌ای آن (کپشن interactions یا «تعاملات» نوع فایل را مشخص می‌کند)."""
+    document = update.message.document
+    file_name = document.file_name or "upload"
+    file_format = "xlsx" if file_name.lower().endswith(".xlsx") else "csv"
+    if file_format == "xlsx" and openpyxl is None:
+        await update.message.reply_text("⚠️ خواندن XLSX در این سرور فعال نیست (کتابخانه openpyxl نصب نشده). فایل را CSV بفرستید.")
+        return
+    if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+        await update.message.reply_text("⚠️ حجم فایل بیشتر از ۲۰ مگابایت است؛ لطفاً آن را در چند فایل بفرستید.")
+        return
+    if await get_db_pool() is None:
+        await update.message.reply_text("⚠️ سرویس حافظه دائمی (PostgreSQL) فعال نیست.")
+        return
+    
+    caption = normalize_lookup_key(update.message.caption)
+    kind = "interactions" if caption in ("interactions", "تعاملات", "گزارشات", "گزارش تماس") else \
+        "customers" if caption in ("customers", "مشتریان") else None
+    
+    async with chat_turn_lock(update.effective_chat.id):
+        await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
+        started = time.perf_counter()
+        with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES) as spool:
+            try:
+                telegram_file = await document.get_file()
+                await telegram_file.download_to_memory(out=spool)
+                stats = await import_file(spool, file_format, kind, update.effective_chat.id)
+            except Exception as e:
+                logger.error(f"Error importing {file_name}: {e}")
+                await update.message.reply_text("❌ خطایی هنگام خواندن یا ثبت فایل رخ داد؛ هیچ سطری ثبت نشد.")
+                return
+        seconds = time.perf_counter() - started
+        logger.info(
+            f"Imported {file_name} into {stats['kind']}: {stats['rows']} rows, {stats['rejected']} rejected "
+            f"in {seconds:.2f}s ({stats['rows'] / seconds if seconds else 0:.0f} rows/s)"
+        )
+        await update.message.reply_text(format_import_summary(file_name, stats, seconds))
+
+# --- صف ارسال پیام‌های خروجی با رعایت محدودیت نرخ تلگرام ---
+# محدودیت‌های Bot API: حدود ۳۰ پیام در ثانیه در کل و ۱ پیام در ثانیه برای هر چت
+TELEGRAM_GLOBAL_RATE = float(os.environ.get("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(os.environ.get("TELEGRAM_CHAT_RATE", "1"))
+DELIVERY_WORKERS = int(os.environ.get("DELIVERY_WORKERS", "20"))
+DELIVERY_QUEUE_SIZE = int(os.environ.get("DELIVERY_QUEUE_SIZE", "1000"))
+DELIVERY_MAX_ATTEMPTS = int(os.environ.get("DELIVERY_MAX_ATTEMPTS", "5"))
+
+
+class TokenBucket:
+    """سطل توکن: rate توکن در ثانیه با ظرفیت burst برابر capacity."""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def try_acquire(self) -> float:
+        """برداشتن یک توکن بدون انتظار؛ اگر توکنی نباشد زمان لازم تا توکن بعدی را برمی‌گرداند."""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def pause(self, seconds: float) -> None:
+        """توقف صدور توکن به مدت seconds (برای رعایت RetryAfter)."""
+        self._refill()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+    def is_idle(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+@dataclass
+class OutboundMessage:
+    """یک پیام در صف ارسال؛ on_done(message, ok, error) پس از ارسال یا شکست نهایی صدا زده می‌شود."""
+    chat_id: int
+    text: str
+    parse_mode: str = None
+    reply_markup: object = None
+    on_done: object = None
+    ref: object = None
+    attempts: int = 0
+    # سررسید (برای یادآوری‌ها؛ محاسبه تأخیر ارسال)
+    due_at: datetime = None
+
+
+def _retry_after_seconds(error: RetryAfter) -> float:
+    delay = error.retry_after
+    return delay.total_seconds() if isinstance(delay, timedelta) else float(delay)
+
+
+class OutboundDelivery:
+    """ارسال هم‌زمان پیام‌ها با چند worker، سطل توکن سراسری و هر چت، و تلاش مجدد با backoff.
+
+    هر چت صف جداگانه خود را دارد و workerها به نوبت از چت‌های آماده برمی‌دارند؛ چتی که سطل توکنش خالی است
+    تا آماده شدن کنار گذاشته می‌شود، پس موج پیام‌های چند چت شلوغ جایگاه workerها را برای بقیه اشغال نمی‌کند.
+    """
+
+    def __init__(self, bot, workers: int = DELIVERY_WORKERS, global_rate: float = TELEGRAM_GLOBAL_RATE,
+                 chat_rate: float = TELEGRAM_CHAT_RATE, queue_size: int = DELIVERY_QUEUE_SIZE,
+                 max_attempts: int = DELIVERY_MAX_ATTEMPTS):
+        self.bot = bot
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.max_attempts = max_attempts
+        # chat_id -> پیام‌های در انتظار آن چت به ترتیب؛ هر چت حداکثر یک بار در _ready است یا در دست یک worker
+        self._chat_queues = {}
+        self._ready = asyncio.Queue()
+        self._space = asyncio.Semaphore(queue_size)
+        self._unfinished = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._global_bucket = TokenBucket(global_rate)
+        self._chat_buckets = {}
+        self.stats = {"sent": 0, "failed": 0, "retries": 0, "retry_after": 0}
+
+    def start(self) -> None:
+        for _ in range(self.workers):
+            start_background_task(self._worker())
+
+    def qsize(self) -> int:
+        """تعداد پیام‌هایی که هنوز ارسال یا شکست نهایی‌شان ثبت نشده است."""
+        return self._unfinished
+
+    async def enqueue(self, message: OutboundMessage) -> None:
+        """افزودن پیام به صف؛ وقتی صف پر است منتظر می‌ماند (فشار معکوس روی تولیدکننده)."""
+        await self._space.acquire()
+        self._unfinished += 1
+        self._idle.clear()
+        self._push(message)
+
+    async def join(self) -> None:
+        """انتظار تا خالی شدن صف (برای تست و بنچمارک)."""
+        await self._idle.wait()
+
+    def _push(self, message: OutboundMessage, front: bool = False) -> None:
+        queue = self._chat_queues.get(message.chat_id)
+        if queue is None:
+            # چت تازه فعال شده است؛ در نوبت workerها قرار می‌گیرد
+            queue = self._chat_queues[message.chat_id] = deque()
+            self._ready.put_nowait(message.chat_id)
+        if front:
+            queue.appendleft(message)
+        else:
+            queue.append(message)
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000:
+                # سطل چت‌هایی که مدتی پیامی نداشته‌اند دور ریخته می‌شود
+                self._chat_buckets = {cid: b for cid, b in self._chat_buckets.items() if not b.is_idle()}
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, 1)
+        return bucket
+
+    async def _worker(self) -> None:
+        while True:
+            chat_id = await self._ready.get()
+            queue = self._chat_queues[chat_id]
+            wait = self._chat_bucket(chat_id).try_acquire()
+            if wait:
+                # سطل این چت خالی است؛ worker سراغ چت بعدی می‌رود و این چت پس از wait دوباره آماده می‌شود
+                asyncio.get_running_loop().call_later(wait, self._ready.put_nowait, chat_id)
+                continue
+            message = queue.popleft()
+            try:
+                await self._deliver(message)
+            except Exception as e:
+                logger.error(f"Unexpected delivery error for chat {message.chat_id}: {e}")
+                self._finish(message, False, str(e))
+            finally:
+                if queue:
+                    # پیام بعدی همین چت پشت چت‌های آماده دیگر قرار می‌گیرد (نوبت‌دهی چرخشی)
+                    self._ready.put_nowait(chat_id)
+                else:
+                    del self._chat_queues[chat_id]
+
+    async def _deliver(self, message: OutboundMessage) -> None:
+        await self._global_bucket.acquire()
+        message.attempts += 1
+        try:
+            await self.bot.send_message(
+                chat_id=message.chat_id,
+                text=message.text,
+                parse_mode=message.parse_mode,
+                reply_markup=message.reply_markup
+            )
+        except RetryAfter as e:
+            # محدودیت تلگرام: همان مدتی که خواسته صبر می‌کنیم؛ این تلاش جزو سقف تلاش‌ها حساب نمی‌شود
+            delay = _retry_after_seconds(e)
+            self.stats["retry_after"] += 1
+            message.attempts -= 1
+            self._retry_later(message, delay)
+        except Forbidden as e:
+            # کاربر ربات را مسدود کرده است؛ تلاش مجدد فایده‌ای ندارد
+            self._finish(message, False, str(e))
+        except BadRequest as e:
+            if message.parse_mode:
+                # احتمالاً Markdown نامعتبر است؛ یک بار بدون قالب‌بندی ارسال می‌شود
+                message.parse_mode = None
+                self._retry_later(message, 0)
+            else:
+                self._finish(message, False, str(e))
+        except TelegramError as e:
+            if message.attempts >= self.max_attempts:
+                self._finish(message, False, str(e))
+            else:
+                self._retry_later(message, min(2 ** message.attempts, 60) * random.uniform(0.5, 1.5))
+        else:
+            self._finish(message, True, None)
+
+    def _retry_later(self, message: OutboundMessage, delay: float) -> None:
+        """بازگرداندن پیام به ابتدای صف چتش؛ تأخیر با توقف سطل همان چت اعمال می‌شود تا ترتیب پیام‌ها حفظ شود."""
+        self.stats["retries"] += 1
+        if delay > 0:
+            self._chat_bucket(message.chat_id).pause(delay)
+        self._push(message, front=True)
+
+    def _finish(self, message: OutboundMessage, ok: bool, error: str) -> None:
+        self.stats["sent" if ok else "failed"] += 1
+        self._unfinished -= 1
+        self._space.release()
+        if not self._unfinished:
+            self._idle.set()
+        if not ok:
+            logger.warning(f"Delivery to chat {message.chat_id} failed after {message.attempts} attempt(s): {error}")
+        if message.on_done is not None:
+            message.on_done(message, ok, error)
+
+
+class ReminderStatusWriter:
+    """ثبت دسته‌ای نتیجه ارسال یادآوری‌ها (sent / retry / failed، تعداد تلاش و آخرین خطا) در جدول reminders.
+
+    یادآوری‌هایی که برداشته شده‌اند و نتیجه‌شان هنوز ثبت نشده (در صف خروجی یا در انتظار flush)
+    در in_flight نگه داشته می‌شوند و claimed_at آن‌ها مرتب تمدید می‌شود تا نمونه دیگری دوباره برشان ندارد.
+    """
+
+    def __init__(self, flush_interval: float = 1.0, max_batch: int = 200):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._pending = []
+        self._full = asyncio.Event()
+        self.in_flight = set()
+        self._last_refresh = time.monotonic()
+
+    def track(self, reminder_ids) -> None:
+        """ثبت یادآوری‌های تازه برداشته‌شده تا پایان ثبت نتیجه ارسالشان."""
+        self.in_flight.update(reminder_ids)
+
+    def record(self, message: OutboundMessage, ok: bool, error: str) -> None:
+        """callback مناسب OutboundMessage.on_done؛ message.ref شناسه یادآوری است."""
+        if ok:
+            REMINDERS_DELIVERED.inc(status="sent")
+        if ok and message.due_at is not None:
+            lag = (datetime.now(pytz.utc) - message.due_at).total_seconds()
+            REMINDER_LAG_SECONDS.observe(lag)
+            REMINDER_LAST_LAG.set(lag)
+            if lag > REMINDER_LATE_SECONDS:
+                REMINDERS_LATE.inc()
+        self._pending.append((message.ref, ok, message.attempts, error))
+        if len(self._pending) >= self.max_batch:
+            self._full.set()
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            await self.flush()
+            if time.monotonic() - self._last_refresh >= REMINDER_CLAIM_TIMEOUT / 3:
+                await self.refresh_claims()
+
+    async def refresh_claims(self) -> None:
+        """تمدید claimed_at یادآوری‌هایی که هنوز در صف خروجی این نمونه‌اند (صف شلوغ یا RetryAfter طولانی)."""
+        self._last_refresh = time.monotonic()
+        if not self.in_flight:
+            return
+        pool = await get_db_pool()
+        if pool is None:
+            return
+        try:
+            async with pool.connection() as conn:
+                await conn.execute(
+                    "UPDATE reminders SET claimed_at = now() WHERE id = ANY(%s) AND delivery_status = 'sending'",
+                    (list(self.in_flight),)
+                )
+        except Exception as e:
+            logger.error(f"Failed to refresh reminder claims: {e}")
+
+    async def flush(self) -> None:
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        pool = await get_db_pool()
+        if pool is None:
+            return
+        ids, oks, attempts, errors = (list(column) for column in zip(*batch))
+        try:
+            async with pool.connection() as conn:
+                # ارسال ناموفق تا REMINDER_MAX_FAILURES دور با فاصله فزاینده دوباره انجام می‌شود و سپس failed می‌ماند
+                cursor = await conn.execute(
+                    """
+                    UPDATE reminders r SET
+                        sent = v.ok,
+                        sent_at = CASE WHEN v.ok THEN now() END,
+                        delivery_status = CASE WHEN v.ok THEN 'sent'
+                                               WHEN r.failures + 1 >= %s THEN 'failed' ELSE 'retry' END,
+                        failures = r.failures + CASE WHEN v.ok THEN 0 ELSE 1 END,
+                        next_attempt_at = CASE WHEN v.ok THEN NULL
+                                               ELSE now() + (r.failures + 1) * %s * INTERVAL '1 second' END,
+                        attempts = r.attempts + v.attempts,
+                        last_error = v.error,
+                        claimed_at = NULL
+                    FROM unnest(%s::int[], %s::bool[], %s::int[], %s::text[]) AS v(id, ok, attempts, error)
+                    WHERE r.id = v.id
+                    RETURNING r.id, r.delivery_status, r.next_attempt_at, r.last_error
+                    """,
+                    (REMINDER_MAX_FAILURES, REMINDER_RETRY_DELAY, ids, oks, attempts, errors)
+                )
+                updated = await cursor.fetchall()
+        except Exception as e:
+            # نتایج برای تلاش بعدی نگه داشته می‌شوند تا وضعیت ارسال گم نشود
+            logger.error(f"Failed to write reminder delivery status: {e}")
+            self._pending = batch + self._pending
+            return
+        self.in_flight.difference_update(ids)
+        for r_id, status, next_attempt_at, last_error in updated:
+            if status == "retry":
+                REMINDERS_DELIVERED.inc(status="retry")
+                if reminder_scheduler is not None:
+                    reminder_scheduler.notify(next_attempt_at)
+            elif status == "failed":
+                REMINDERS_DELIVERED.inc(status="failed")
+                logger.error(f"Reminder {r_id} failed permanently after {REMINDER_MAX_FAILURES} delivery rounds: {last_error}")
+
+
+outbound_delivery = None
+reminder_status_writer = ReminderStatusWriter()
+
+# --- زمان‌بند رویدادمحور یادآوری‌ها ---
+# حداکثر خواب زمان‌بند و فاصله همگام‌سازی مجدد صف با دیتابیس (برای درج‌های نمونه‌های دیگر بدون NOTIFY)
+REMINDER_MAX_SLEEP = float(os.environ.get("REMINDER_MAX_SLEEP", "300"))
+# یادآوری claim شده‌ای که تا این مدت ارسال نشده باشد دوباره قابل برداشت است (مثلاً پس از کرش یک نمونه)
+REMINDER_CLAIM_TIMEOUT = int(os.environ.get("REMINDER_CLAIM_TIMEOUT", "300"))
+REMINDER_BATCH_SIZE = int(os.environ.get("REMINDER_BATCH_SIZE", "500"))
+# تعداد دورهای ناموفق ارسال پیش از failed شدن یادآوری و فاصله پایه تلاش دوباره (ثانیه، ضرب در شماره دور)
+REMINDER_MAX_FAILURES = int(os.environ.get("REMINDER_MAX_FAILURES", "3"))
+REMINDER_RETRY_DELAY = int(os.environ.get("REMINDER_RETRY_DELAY", "300"))
+# یادآوری‌هایی که بیش از این مقدار پس از سررسید ارسال شوند «دیرکرد» شمرده می‌شوند
+REMINDER_LATE_SECONDS = float(os.environ.get("REMINDER_LATE_SECONDS", "60"))
+# تعداد سررسیدهای آینده که در heap حافظه نگه داشته می‌شوند
+REMINDER_PRELOAD = 1000
+
+def format_reminder_message(customer_name: str, reminder_text: str) -> str:
+    return f"🔔 **هشدار CRM**\n\nمشتری: **{customer_name or 'عمومی'}**\nپیام: _{reminder_text}_\n\n"
+
+
+class ReminderScheduler:
+    """زمان‌بند یادآوری‌ها: دقیقاً در سررسید بعدی بیدار می‌شود و ردیف‌های سررسید را به‌صورت اتمیک برمی‌دارد."""
+
+    def __init__(self, application: Application):
+        self.application = application
+        # min-heap از زمان‌های سررسید آینده (UTC)
+        self._heap = []
+        self._wake = asyncio.Event()
+        self._last_sync = 0.0
+        # فقط وقتی حلقه در این نمونه (رهبر) در حال اجراست سررسیدها نگه داشته می‌شوند
+        self.active = False
+
+    def notify(self, due_time: datetime) -> None:
+        """ثبت یک سررسید جدید (از set_reminder یا NOTIFY) و بیدار کردن حلقه."""
+        if not self.active:
+            return
+        heapq.heappush(self._heap, due_time)
+        self._wake.set()
+
+    def on_notify(self, payload: str) -> None:
+        """callback کانال REMINDERS_CHANNEL."""
+        _, epoch = payload.split(",", 1)
+        self.notify(datetime.fromtimestamp(float(epoch), pytz.utc))
+
+    async def run(self) -> None:
+        self.active = True
+        self._last_sync = 0.0
+        try:
+            await self._loop()
+        finally:
+            self.active = False
+            self._heap.clear()
+
+    async def _loop(self) -> None:
+        while True:
+            # پاک کردن رویداد پیش از کار تا اعلان‌های رسیده در حین پردازش از دست نروند
+            self._wake.clear()
+            try:
+                if time.monotonic() - self._last_sync >= REMINDER_MAX_SLEEP or not self._heap:
+                    await self._sync()
+                if self._heap and self._heap[0] <= datetime.now(pytz.utc):
+                    await self._dispatch_due()
+                    continue
+            except Exception as e:
+                logger.error(f"Failed to run reminder scheduler: {e}")
             
+            delay = REMINDER_MAX_SLEEP
+            if self._heap:
+                delay = min(delay, max((self._heap[0] - datetime.now(pytz.utc)).total_seconds(), 0))
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _sync(self) -> None:
+        """بارگذاری نزدیک‌ترین سررسیدهای ارسال‌نشده از دیتابیس در heap."""
+        pool = await get_db_pool()
+        if pool is None:
+            logger.warning("Reminder scheduler skipped: PostgreSQL not initialized.")
+            return
+        async with pool.connection() as conn:
+            # زمان قابل برداشت شدن: سررسید، زمان تلاش دوباره یا (برای sending) انقضای claim
+            cursor = await conn.execute(
+                """
+                SELECT CASE WHEN delivery_status = 'sending'
+                            THEN claimed_at + %s * INTERVAL '1 second'
+                            ELSE GREATEST(due_date_time, next_attempt_at) END AS ready_at
+                FROM reminders WHERE sent = FALSE AND delivery_status <> 'failed'
+                ORDER BY ready_at LIMIT %s
+                """,
+                (REMINDER_CLAIM_TIMEOUT, REMINDER_PRELOAD)
+            )
+            self._heap = [row[0] for row in await cursor.fetchall()]
+        heapq.heapify(self._heap)
+        self._last_sync = time.monotonic()
+
+    async def _dispatch_due(self) -> None:
+        """برداشت اتمیک یادآوری‌های سررسید، ارسال آن‌ها و ثبت دسته‌ای وضعیت."""
+        now = datetime.now(pytz.utc)
+        while self._heap and self._heap[0] <= now:
+            heapq.heappop(self._heap)
+        
+        pool = await get_db_pool()
+        if pool is None:
+            return
+        # FOR UPDATE SKIP LOCKED: چند نمونه ربات هم‌زمان کار می‌کنند بدون اینکه یک یادآوری دو بار ارسال شود
+        async with pool.connection() as conn:
+            cursor = await conn.execute(
+                """
+                UPDATE reminders SET claimed_at = now(), delivery_status = 'sending'
+                WHERE id IN (
+                    SELECT id FROM reminders
+                    WHERE sent = FALSE AND due_date_time <= now() AND delivery_status <> 'failed'
+                      AND (next_attempt_at IS NULL OR next_attempt_at <= now())
+                      AND (claimed_at IS NULL OR claimed_at < now() - %s * INTERVAL '1 second')
+                    ORDER BY due_date_time
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, chat_id, customer_name, reminder_text, due_date_time
+                """,
+                (REMINDER_CLAIM_TIMEOUT, REMINDER_BATCH_SIZE)
+            )
+            claimed = await cursor.fetchall()
+        # تا ثبت نتیجه، claim این یادآوری‌ها تمدید می‌شود (بدون ارسال دوباره توسط نمونه دیگر)
+        reminder_status_writer.track(row[0] for row in claimed)
+        
+        # ارسال به صف خروجی سپرده می‌شود؛ نتیجه هر ارسال به‌صورت دسته‌ای در جدول ثبت می‌شود
+        for r_id, chat_id, customer_name, reminder_text, due_date_time in claimed:
+            await outbound_delivery.enqueue(OutboundMessage(
+                chat_id=chat_id,
+                text=format_reminder_message(customer_name, reminder_text),
+                parse_mode='Markdown',
+                on_done=reminder_status_writer.record,
+                ref=r_id,
+                due_at=due_date_time
+            ))
+        if len(claimed) == REMINDER_BATCH_SIZE:
+            # دسته پر بود؛ احتمالاً یادآوری سررسید دیگری باقی مانده است
+            self.notify(now)
+        if claimed:
+            logger.info(f"Reminder scheduler queued {len(claimed)} due reminders for delivery.")
+
+
+reminder_scheduler = None
+
+# --- خلاصه روزانه پیگیری‌ها (follow_up_date) برای هر کاربر ---
+DIGEST_ENABLED = os.environ.get("DIGEST_ENABLED", "1") == "1"
+# ساعت ارسال خلاصه به وقت ایران (HH:MM)
+DIGEST_TIME = os.environ.get("DIGEST_TIME", "08:00")
+# پیگیری‌های عقب‌افتاده قدیمی‌تر از این تعداد روز در خلاصه نمی‌آیند
+DIGEST_OVERDUE_DAYS = int(os.environ.get("DIGEST_OVERDUE_DAYS", "14"))
+# حداکثر تعداد مواردی که در پیام هر کاربر فهرست می‌شوند
+DIGEST_MAX_ITEMS = 20
+
+# یک گذر گروه‌بندی‌شده روی ایندکس follow_up_date: پیگیری‌هایی که پس از آن‌ها تعامل دیگری با همان مشتری ثبت نشده
+FOLLOWUP_DIGEST_QUERY = """
+    SELECT i.chat_id,
+           COUNT(*) FILTER (WHERE i.follow_up_date = %(today)s) AS due,
+           COUNT(*) FILTER (WHERE i.follow_up_date < %(today)s) AS overdue,
+           json_agg(json_build_object('name', i.customer_name, 'date', i.follow_up_date, 'report', left(i.report, 80))
+                    ORDER BY i.follow_up_date DESC, i.customer_name) AS items
+    FROM interactions i
+    WHERE i.follow_up_date BETWEEN %(since)s AND %(today)s
+      AND i.chat_id IS NOT NULL {chat_filter}
+      AND NOT EXISTS (
+          SELECT 1 FROM interactions later
+          WHERE later.customer_id = i.customer_id AND later.id > i.id
+      )
+    GROUP BY i.chat_id
+"""
+
+def format_followup_digest(today, due: int, overdue: int, items: list) -> str:
+    lines = [f"📅 پیگیری‌های امروز ({today.strftime('%Y-%m-%d')})", f"🔔 سررسید امروز: {due} | ⏰ عقب‌افتاده: {overdue}"]
+    today_text = today.strftime("%Y-%m-%d")
+    for title, is_due in (("\nامروز:", True), ("\nعقب‌افتاده:", False)):
+        section = [item for item in items if (item["date"] == today_text) == is_due]
+        if section:
+            lines.append(title)
+        for item in section[:DIGEST_MAX_ITEMS]:
+            since = "" if is_due else f" (از {item['date']})"
+            report = ' '.join((item['report'] or '').split())
+            lines.append(f" - {item['name']}{since}" + (f": {report}" if report else ""))
+        if len(section) > DIGEST_MAX_ITEMS:
+            lines.append(f" … و {len(section) - DIGEST_MAX_ITEMS} مورد دیگر")
+    return "\n".join(lines)
+
+async def fetch_followup_digests(conn, today, chat_id: int = None) -> list:
+    """محاسبه خلاصه پیگیری‌ها؛ لیست (chat_id، سررسید، عقب‌افتاده، متن پیام)."""
+    params = {"today": today, "since": today - timedelta(days=DIGEST_OVERDUE_DAYS), "chat_id": chat_id}
+    cursor = await conn.execute(
+        FOLLOWUP_DIGEST_QUERY.format(chat_filter="AND i.chat_id = %(chat_id)s" if chat_id is not None else ""),
+        params
+    )
+    return [
+        (row_chat_id, due, overdue, format_followup_digest(today, due, overdue, items))
+        for row_chat_id, due, overdue, items in await cursor.fetchall()
+    ]
+
+async def build_followup_digests(today) -> list:
+    """محاسبه و ذخیره خلاصه امروز همه کاربران، فقط یک بار در روز در میان همه نمونه‌ها.
+
+    ثبت روز در followup_digest_runs و ذخیره خلاصه‌ها در یک تراکنش انجام می‌شود؛ اگر نمونه دیگری
+    پیش‌تر خلاصه امروز را ساخته باشد لیست خالی برمی‌گردد.
+    """
+    pool = await get_db_pool()
+    if pool is None:
+        return []
+    async with pool.connection() as conn, conn.transaction():
+        cursor = await conn.execute(
+            "INSERT INTO followup_digest_runs (digest_date) VALUES (%s) ON CONFLICT DO NOTHING RETURNING digest_date",
+            (today,)
+        )
+        if await cursor.fetchone() is None:
+            return []
+        digests = await fetch_followup_digests(conn, today)
+        if digests:
+            async with conn.cursor() as cursor:
+                await cursor.executemany(
+                    """
+                    INSERT INTO followup_digests (chat_id, digest_date, due_count, overdue_count, body)
+                    VALUES (%s, %s, %s, %s, %s)
+                    ON CONFLICT (chat_id, digest_date) DO UPDATE
+                    SET due_count = EXCLUDED.due_count, overdue_count = EXCLUDED.overdue_count, body = EXCLUDED.body
+                    """,
+                    [(chat_id, today, due, overdue, body) for chat_id, due, overdue, body in digests]
+                )
+        # خلاصه‌های روزهای گذشته دیگر خوانده نمی‌شوند
+        await conn.execute("DELETE FROM followup_digests WHERE digest_date < %s", (today - timedelta(days=7),))
+    return digests
+
+async def followup_digest_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """وظیفه روزانه: ساخت خلاصه پیگیری‌ها و ارسال یک پیام برای هر کاربر از صف ارسال."""
+    started = time.perf_counter()
+    try:
+        digests = await build_followup_digests(datetime.now(IRAN_TZ).date())
+    except Exception as e:
+        logger.error(f"Error building follow-up digests: {e}")
+        return
+    for chat_id, _, _, body in digests:
+        await outbound_delivery.enqueue(OutboundMessage(chat_id, body))
+    DIGESTS_SENT.inc(len(digests))
+    logger.info(f"Follow-up digest: {len(digests)} chat(s) queued in {time.perf_counter() - started:.2f}s")
+
+async def today_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """دستور /today: خلاصه پیگیری‌های امروز از نتیجه از پیش محاسبه‌شده (بدون Gemini)."""
+    chat_id = update.effective_chat.id
+    pool = await get_db_pool()
+    if pool is None:
+        await update.message.reply_text("⚠️ سرویس حافظه دائمی (PostgreSQL) فعال نیست.")
+        return
+    today = datetime.now(IRAN_TZ).date()
+    async with pool.connection() as conn:
+        cursor = await conn.execute(
+            """
+            SELECT (SELECT body FROM followup_digests WHERE chat_id = %s AND digest_date = %s),
+                   EXISTS (SELECT 1 FROM followup_digest_runs WHERE digest_date = %s)
+            """,
+            (chat_id, today, today)
+        )
+        body, built = await cursor.fetchone()
+        if body is None and not built:
+            # خلاصه امروز هنوز ساخته نشده (پیش از DIGEST_TIME)؛ فقط برای همین کاربر محاسبه می‌شود
+            digests = await fetch_followup_digests(conn, today, chat_id)
+            body = digests[0][3] if digests else None
+    await update.message.reply_text(body or "✅ برای امروز پیگیری سررسید شده یا عقب‌افتاده‌ای ندارید.")
+
+def schedule_followup_digest(application: Application) -> None:
+    hour, minute = (int(part) for part in DIGEST_TIME.split(":"))
+    application.job_queue.run_daily(
+        # منطقه زمانی pytz روی time به‌تنهایی آفست LMT می‌دهد؛ JobQueue با zoneinfo درست کار می‌کند
+        followup_digest_job, time=dtime(hour=hour, minute=minute, tzinfo=ZoneInfo("Asia/Tehran")), name="followup_digest"
+    )
+
+# =================================================================
+# --- هم‌زمانی: فراخوانی غیرمسدودکننده Gemini و صف سریالی هر چت ---
+# =================================================================
+
+_gemini_semaphore = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+# chat_id -> [قفل، تعداد نوبت‌های در حال اجرا یا منتظر]
+_chat_locks = {}
+
+async def generate_ai_content(contents, config):
+    """فراخوانی async مدل با سقف تعداد درخواست‌های هم‌زمان؛ event loop مسدود نمی‌شود."""
+    async with _gemini_semaphore:
+        return await ai_client.aio.models.generate_content(
+            model=AI_MODEL,
+            contents=contents,
+            config=config
+        )
+
+async def stream_ai_content(contents, config):
+    """نسخه جریانی generate_ai_content؛ جایگاه سمافور تا پایان جریان نگه داشته می‌شود."""
+    async with _gemini_semaphore:
+        stream = await ai_client.aio.models.generate_content_stream(
+            model=AI_MODEL,
+            contents=contents,
+            config=config
+        )
+        async for chunk in stream:
+            yield chunk
+
+@contextlib.asynccontextmanager
+async def chat_turn_lock(chat_id: int):
+    """نوبت‌های یک چت را به ترتیب رسیدن اجرا می‌کند؛ چت‌های مختلف موازی پیش می‌روند."""
+    entry = _chat_locks.get(chat_id)
+    if entry is None:
+        entry = _chat_locks[chat_id] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        # قفل چت‌های بیکار نگه داشته نمی‌شود تا حافظه رشد نکند
+        if entry[1] == 0:
+            _chat_locks.pop(chat_id, None)
+
+
+# =================================================================
+# --- پاسخ جریانی: ویرایش تدریجی پیام تلگرام با رسیدن تکه‌های مدل ---
+# =================================================================
+
+# فاصله حداقل بین دو ویرایش یک پیام (تلگرام ویرایش‌های پشت‌سرهم را محدود می‌کند)
+STREAM_EDIT_INTERVAL = float(os.environ.get("STREAM_EDIT_INTERVAL", "1.5"))
+TELEGRAM_TEXT_LIMIT = 4096
+STREAM_CURSOR = " ▌"
+_CODE_FENCE = "```"
+
+def split_message(text: str, limit: int = TELEGRAM_TEXT_LIMIT) -> list:
+    """تقسیم متن طولانی در مرز خط؛ بلوک کدی که در مرز باز مانده در پایان تکه بسته و در تکه بعد دوباره باز می‌شود."""
+    parts = []
+    reserve = len(_CODE_FENCE) + 1
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit - reserve)
+        if cut <= 0:
+            cut = limit - reserve
+        head, text = text[:cut], text[cut:].lstrip("\n")
+        if head.count(_CODE_FENCE) % 2:
+            head += "\n" + _CODE_FENCE
+            text = _CODE_FENCE + "\n" + text
+        parts.append(head)
+    parts.append(text)
+    return parts
+
+def balance_markdown(text: str) -> str:
+    """پیشوند قابل نمایش متن نیمه‌کاره: بلوک کد باز موقتاً بسته می‌شود و * _ ` بی‌جفت تا رسیدن جفتشان نمایش داده نمی‌شوند."""
+    if text.count(_CODE_FENCE) % 2:
+        return text + "\n" + _CODE_FENCE
+    head_end = text.rfind(_CODE_FENCE) + len(_CODE_FENCE) if _CODE_FENCE in text else 0
+    head, tail = text[:head_end], text[head_end:]
+    while True:
+        unbalanced = [tail.rfind(marker) for marker in ("`", "*", "_") if tail.count(marker) % 2]
+        if not unbalanced:
+            return head + tail
+        tail = tail[:max(unbalanced)]
+
+
+class StreamingReply:
+    """پاسخ مدل که با رسیدن تکه‌ها نوشته می‌شود: اولین تکه یک پیام می‌سازد و بقیه آن را (با فاصله زمانی) ویرایش می‌کنند."""
+
+    def __init__(self, message):
+        self.message = message
+        self.text = ""
+        self._sent = []
+        # متنی که اکنون در هر پیام دیده می‌شود (برای جلوگیری از ویرایش بی‌تغییر)
+        self._shown = []
+        self._next_edit = 0.0
+        self.first_text_at = None
+
+    async def feed(self, delta: str) -> None:
+        if self.first_text_at is None:
+            self.first_text_at = time.perf_counter()
+        self.text += delta
+        if time.monotonic() >= self._next_edit:
+            await self._render(final=False)
+
+    async def finish(self, fallback: str = None) -> None:
+        """نمایش متن کامل (بدون نشانگر)؛ اگر مدل متنی نداده باشد fallback ارسال می‌شود."""
+        if not self.text.strip() and fallback:
+            self.text = fallback
+        if self.text:
+            await self._render(final=True)
+
+    async def _render(self, final: bool) -> None:
+        self._next_edit = time.monotonic() + STREAM_EDIT_INTERVAL
+        # جای نشانگر و بستن موقت بلوک کد در هر تکه کنار گذاشته می‌شود
+        parts = split_message(self.text, TELEGRAM_TEXT_LIMIT - len(STREAM_CURSOR) - len(_CODE_FENCE) - 1)
+        for index, part in enumerate(parts):
+            if not final and index == len(parts) - 1:
+                part = (balance_markdown(part) or "⏳") + STREAM_CURSOR
+            if index < len(self._shown) and self._shown[index] == part:
+                continue
+            try:
+                if index < len(self._sent):
+                    await self._edit(self._sent[index], part)
+                    self._shown[index] = part
+                else:
+                    self._sent.append(await self._send(part))
+                    self._shown.append(part)
+            except RetryAfter as e:
+                if not final:
+                    # ویرایش میانی رها می‌شود؛ تکه‌های بعدی پس از مهلت نمایش داده می‌شوند
+                    self._next_edit = time.monotonic() + _retry_after_seconds(e)
+                    return
+                await asyncio.sleep(_retry_after_seconds(e))
+                await self._render(final=True)
+                return
+
+    async def _send(self, text: str):
+        try:
+            return await self.message.reply_text(text, parse_mode='Markdown')
+        except BadRequest:
+            return await self.message.reply_text(text)
+
+    async def _edit(self, sent, text: str) -> None:
+        try:
+            await sent.edit_text(text, parse_mode='Markdown')
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                return
+            # Markdown ناقص یا نامعتبر در داده‌ها؛ همان متن بدون قالب
+            with contextlib.suppress(BadRequest):
+                await sent.edit_text(text)
+
+
+async def reply_full_text(message, text: str) -> None:
+    """ارسال یک متن آماده با همان قواعد پاسخ جریانی (Markdown امن و تقسیم پیام‌های بلند)."""
+    reply = StreamingReply(message)
+    reply.text = text
+    await reply.finish()
+
+
+def _mergeable_text(part) -> bool:
+    return part.text is not None and not part.function_call and not getattr(part, "thought", None) \
+        and not getattr(part, "thought_signature", None)
+
+async def run_model_step(contents, config, reply: StreamingReply):
+    """یک گام مدل به‌صورت جریانی؛ متن به reply فرستاده می‌شود و (Content کامل مدل، function_calls) برمی‌گردد."""
+    parts, function_calls = [], []
+    async for chunk in stream_ai_content(contents, config):
+        if not chunk.candidates or not chunk.candidates[0].content or not chunk.candidates[0].content.parts:
+            continue
+        for part in chunk.candidates[0].content.parts:
+            if part.function_call:
+                function_calls.append(part.function_call)
+            elif part.text and not getattr(part, "thought", None):
+                await reply.feed(part.text)
+            # تکه‌های متنی پشت‌سرهم در تاریخچه یک Part می‌شوند
+            if parts and _mergeable_text(parts[-1]) and _mergeable_text(part):
+                parts[-1] = types.Part(text=parts[-1].text + part.text)
+            else:
+                parts.append(part)
+    content = types.Content(role="model", parts=parts) if parts else None
+    return content, function_calls
+
+
+# =================================================================
+# --- مدیریت تاریخچه گفتگو با بودجه توکن ---
+# =================================================================
+
+# تخمین تقریبی: هر توکن حدود ۳ کاراکتر (متن فارسی)
+CHARS_PER_TOKEN = 3
+# طول نتیجه توابع در نوبت‌های قدیمی و طول خلاصه چرخشی (کاراکتر)
+HISTORY_TOOL_RESULT_CHARS = 300
+HISTORY_SUMMARY_MAX_CHARS = 2000
+
+def _clip(text: str, limit: int) -> str:
+    text = " ".join((text or "").split())
+    return text if len(text) <= limit else text[:limit] + "…"
+
+def estimate_content_tokens(content) -> int:
+    """تخمین تعداد توکن‌های یک Content شامل متن، فراخوانی و پاسخ توابع."""
+    chars = 0
+    for part in content.parts or []:
+        if part.text:
+            chars += len(part.text)
+        elif part.function_call:
+            chars += len(json.dumps(part.function_call.args or {}, ensure_ascii=False, default=str)) + len(part.function_call.name or "")
+        elif part.function_response:
+            chars += len(json.dumps(part.function_response.response or {}, ensure_ascii=False, default=str)) + len(part.function_response.name or "")
+    return chars // CHARS_PER_TOKEN + 1
+
+def _elide_tool_responses(content):
+    """کوتاه کردن خروجی‌های بزرگ توابع (مثل لیست کامل مشتریان) در یک Content قدیمی."""
+    parts = content.parts or []
+    if not any(part.function_response for part in parts):
+        return content
+    new_parts = []
+    for part in parts:
+        response = part.function_response
+        result = str((response.response or {}).get("result", "")) if response else ""
+        if response and len(result) > HISTORY_TOOL_RESULT_CHARS:
+            part = types.Part.from_function_response(
+                name=response.name,
+                response={"result": result[:HISTORY_TOOL_RESULT_CHARS] + "… (ادامه این خروجی قدیمی حذف شد)"}
+            )
+        new_parts.append(part)
+    return types.Content(role=content.role, parts=new_parts)
+
+
+class ChatHistory:
+    """تاریخچه یک چت: خلاصه چرخشی نوبت‌های قدیمی به‌علاوه نوبت‌های اخیر."""
+
+    def __init__(self, summary: str = "", turns: list = None, first_seq: int = 0):
+        self.summary = summary
+        # هر نوبت لیستی از Contentهاست که با پیام کاربر شروع می‌شود
+        self.turns = turns or []
+        # شماره ترتیب نخستین نوبت نگه‌داشته‌شده (برای ذخیره افزایشی در HistoryStore)
+        self.first_seq = first_seq
+        self.summary_dirty = False
+        self.tokens = self._count_tokens()
+
+    @property
+    def next_seq(self) -> int:
+        return self.first_seq + len(self.turns)
+
+    def start_turn(self, user_content) -> None:
+        self.turns.append([user_content])
+        self.tokens += estimate_content_tokens(user_content)
+
+    def append(self, content) -> None:
+        self.turns[-1].append(content)
+        self.tokens += estimate_content_tokens(content)
+
+    def abort_turn(self) -> None:
+        """حذف نوبت جاری در صورت خطا تا تاریخچه ناقص به مدل ارسال نشود."""
+        if self.turns:
+            self.turns.pop()
+            self.tokens = self._count_tokens()
+
+    def contents(self) -> list:
+        """لیست Contentها برای ارسال به مدل (خلاصه، سپس نوبت‌های اخیر)."""
+        result = []
+        if self.summary:
+            result.append(types.Content(role="user", parts=[types.Part(text=f"[خلاصه گفتگوهای قبلی این چت]\n{self.summary}")]))
+        for turn in self.turns:
+            result.extend(turn)
+        return result
+
+    def compact(self) -> None:
+        """کوتاه‌سازی خروجی توابع قدیمی و انتقال قدیمی‌ترین نوبت‌ها به خلاصه تا رعایت بودجه."""
+        for turn in self.turns[:-HISTORY_KEEP_TURNS or None]:
+            turn[:] = [_elide_tool_responses(content) for content in turn]
+        self.tokens = self._count_tokens()
+        
+        while self.tokens > HISTORY_TOKEN_BUDGET and len(self.turns) > 1:
+            self._roll_into_summary(self.turns.pop(0))
+            self.first_seq += 1
+            self.summary_dirty = True
+            self.tokens = self._count_tokens()
+
+    def _roll_into_summary(self, turn) -> None:
+        user_text = " ".join(part.text for part in turn[0].parts or [] if part.text)
+        tool_names = [part.function_call.name for content in turn for part in content.parts or [] if part.function_call]
+        answer = ""
+        if len(turn) > 1 and turn[-1].role == "model":
+            answer = " ".join(part.text for part in turn[-1].parts or [] if part.text)
+        
+        line = f"- کاربر: {_clip(user_text, 150)}"
+        if tool_names:
+            line += f" | توابع: {', '.join(tool_names)}"
+        if answer:
+            line += f" | پاسخ: {_clip(answer, 200)}"
+        
+        lines = (self.summary.split("\n") if self.summary else []) + [line]
+        # قدیمی‌ترین خطوط خلاصه کنار گذاشته می‌شوند تا خود خلاصه هم محدود بماند
+        while len(lines) > 1 and sum(len(l) + 1 for l in lines) > HISTORY_SUMMARY_MAX_CHARS:
+            lines.pop(0)
+        self.summary = "\n".join(lines)
+
+    def _count_tokens(self) -> int:
+        return len(self.summary) // CHARS_PER_TOKEN + sum(
+            estimate_content_tokens(content) for turn in self.turns for content in turn
+        )
+
+
+# --- ذخیره‌سازی پایدار تاریخچه (افزایشی، هر نوبت یک ردیف فشرده) ---
+
+def serialize_turn(contents: list) -> bytes:
+    """تبدیل Contentهای یک نوبت به JSON فشرده‌شده با zlib."""
+    data = "[" + ",".join(content.model_dump_json(exclude_none=True) for content in contents) + "]"
+    return zlib.compress(data.encode("utf-8"))
+
+def deserialize_turn(payload: bytes) -> list:
+    # با model_validate_json فیلدهای bytes (مانند thought_signature) از base64 همان JSON برگردانده می‌شوند
+    return [
+        types.Content.model_validate_json(json.dumps(item, ensure_ascii=False))
+        for item in json.loads(zlib.decompress(payload))
+    ]
+
+
+class HistoryStore:
+    """رابط ذخیره‌سازی تاریخچه چت‌ها؛ این پیاده‌سازی پایه فقط در حافظه کار می‌کند و چیزی ذخیره نمی‌کند."""
+
+    # اگر True باشد، چند نمونه ربات از یک مخزن مشترک استفاده می‌کنند و تازگی نسخه حافظه بررسی می‌شود
+    shared = False
+
+    async def load(self, chat_id: int):
+        """(summary, first_seq, [(seq, payload), ...]) یا None."""
+        return None
+
+    async def latest_seq(self, chat_id: int) -> int:
+        return 0
+
+    async def append_turn(self, chat_id: int, seq: int, payload: bytes) -> None:
+        pass
+
+    async def save_summary(self, chat_id: int, summary: str, first_seq: int) -> None:
+        """ذخیره خلاصه چرخشی و حذف نوبت‌هایی که به خلاصه منتقل شده‌اند."""
+        pass
+
+    async def delete(self, chat_id: int) -> None:
+        pass
+
+
+class PostgresHistoryStore(HistoryStore):
+    """تاریخچه در جداول chat_history_turns و chat_history_state همان دیتابیس CRM."""
+
+    shared = True
+
+    async def load(self, chat_id: int):
+        pool = await get_db_pool()
+        if pool is None:
+            return None
+        async with pool.connection() as conn:
+            cursor = await conn.execute("SELECT summary, first_seq FROM chat_history_state WHERE chat_id = %s", (chat_id,))
+            state = await cursor.fetchone()
+            cursor = await conn.execute("SELECT seq, payload FROM chat_history_turns WHERE chat_id = %s ORDER BY seq", (chat_id,))
+            rows = await cursor.fetchall()
+        if state is None and not rows:
+            return None
+        summary, first_seq = state or ("", 0)
+        return summary, first_seq, rows
+
+    async def latest_seq(self, chat_id: int) -> int:
+        pool = await get_db_pool()
+        if pool is None:
+            return 0
+        async with pool.connection() as conn:
+            cursor = await conn.execute("""
+                SELECT COALESCE(
+                    (SELECT MAX(seq) + 1 FROM chat_history_turns WHERE chat_id = %(chat_id)s),
+                    (SELECT first_seq FROM chat_history_state WHERE chat_id = %(chat_id)s),
+                    0)
+            """, {"chat_id": chat_id})
+            return (await cursor.fetchone())[0]
+
+    async def append_turn(self, chat_id: int, seq: int, payload: bytes) -> None:
+        pool = await get_db_pool()
+        if pool is None:
+            return
+        async with pool.connection() as conn:
+            await conn.execute("""
+                INSERT INTO chat_history_turns (chat_id, seq, payload) VALUES (%s, %s, %s)
+                ON CONFLICT (chat_id, seq) DO UPDATE SET payload = EXCLUDED.payload
+            """, (chat_id, seq, payload))
+
+    async def save_summary(self, chat_id: int, summary: str, first_seq: int) -> None:
+        pool = await get_db_pool()
+        if pool is None:
+            return
+        async with pool.connection() as conn, conn.transaction():
+            await conn.execute("""
+                INSERT INTO chat_history_state (chat_id, summary, first_seq, updated_at) VALUES (%s, %s, %s, now())
+                ON CONFLICT (chat_id) DO UPDATE SET summary = EXCLUDED.summary, first_seq = EXCLUDED.first_seq, updated_at = now()
+            """, (chat_id, summary, first_seq))
+            await conn.execute("DELETE FROM chat_history_turns WHERE chat_id = %s AND seq < %s", (chat_id, first_seq))
+
+    async def delete(self, chat_id: int) -> None:
+        pool = await get_db_pool()
+        if pool is None:
+            return
+        async with pool.connection() as conn, conn.transaction():
+            await conn.execute("DELETE FROM chat_history_turns WHERE chat_id = %s", (chat_id,))
+            await conn.execute("DELETE FROM chat_history_state WHERE chat_id = %s", (chat_id,))
+
+
+class SQLiteHistoryStore(HistoryStore):
+    """جایگزین محلی با SQLite (برای اجرای لوکال یا تک‌نمونه)؛ عملیات در thread جداگانه اجرا می‌شوند."""
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS chat_history_turns (
+                    chat_id INTEGER, seq INTEGER, payload BLOB, PRIMARY KEY (chat_id, seq)
+                )
+            """)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS chat_history_state (
+                    chat_id INTEGER PRIMARY KEY, summary TEXT, first_seq INTEGER
+                )
+            """)
+
+    def _run(self, func):
+        def locked():
+            with self._lock:
+                return func(self._conn)
+        return asyncio.to_thread(locked)
+
+    async def load(self, chat_id: int):
+        def query(conn):
+            state = conn.execute("SELECT summary, first_seq FROM chat_history_state WHERE chat_id = ?", (chat_id,)).fetchone()
+            rows = conn.execute("SELECT seq, payload FROM chat_history_turns WHERE chat_id = ? ORDER BY seq", (chat_id,)).fetchall()
+            return state, rows
+        state, rows = await self._run(query)
+        if state is None and not rows:
+            return None
+        summary, first_seq = state or ("", 0)
+        return summary, first_seq, rows
+
+    async def append_turn(self, chat_id: int, seq: int, payload: bytes) -> None:
+        await self._run(lambda conn: conn.execute(
+            "INSERT OR REPLACE INTO chat_history_turns (chat_id, seq, payload) VALUES (?, ?, ?)", (chat_id, seq, payload)
+        ))
+
+    async def save_summary(self, chat_id: int, summary: str, first_seq: int) -> None:
+        def write(conn):
+            with conn:
+                conn.execute("BEGIN")
+                conn.execute("INSERT OR REPLACE INTO chat_history_state (chat_id, summary, first_seq) VALUES (?, ?, ?)",
+                             (chat_id, summary, first_seq))
+                conn.execute("DELETE FROM chat_history_turns WHERE chat_id = ? AND seq < ?", (chat_id, first_seq))
+        await self._run(write)
+
+    async def delete(self, chat_id: int) -> None:
+        def write(conn):
+            with conn:
+                conn.execute("BEGIN")
+                conn.execute("DELETE FROM chat_history_turns WHERE chat_id = ?", (chat_id,))
+                conn.execute("DELETE FROM chat_history_state WHERE chat_id = ?", (chat_id,))
+        await self._run(write)
+
+
+def create_history_store() -> HistoryStore:
+    """انتخاب مخزن تاریخچه بر اساس HISTORY_STORE (postgres، sqlite یا memory)."""
+    if HISTORY_STORE == "sqlite":
+        return SQLiteHistoryStore(HISTORY_SQLITE_PATH)
+    if HISTORY_STORE == "postgres" and DATABASE_URL:
+        return PostgresHistoryStore()
+    return HistoryStore()
+
+
+class HistoryManager:
+    """نگهداری تاریخچه چت‌ها با بارگذاری تنبل از مخزن و حذف LRU چت‌های بیکار هنگام عبور از سقف کل."""
+
+    def __init__(self, max_chats: int, global_token_budget: int, store: HistoryStore = None):
+        self.max_chats = max_chats
+        self.global_token_budget = global_token_budget
+        self.store = store or HistoryStore()
+        self._chats = OrderedDict()
+
+    async def get(self, chat_id: int) -> ChatHistory:
+        """تاریخچه چت از حافظه؛ در اولین پیام پس از ری‌استارت (یا اگر نمونه دیگری آن را جلو برده) از مخزن خوانده می‌شود."""
+        history = self._chats.get(chat_id)
+        if history is not None:
+            self._chats.move_to_end(chat_id)
+            if not self.store.shared:
+                return history
+            try:
+                if await self.store.latest_seq(chat_id) == history.next_seq:
+                    return history
+            except Exception as e:
+                logger.warning(f"History freshness check failed for chat {chat_id}: {e}")
+                return history
+        
+        history = ChatHistory()
+        try:
+            stored = await self.store.load(chat_id)
+            if stored is not None:
+                summary, first_seq, rows = stored
+                history = ChatHistory(summary, [deserialize_turn(payload) for _, payload in rows], first_seq)
+                history.compact()
+        except Exception as e:
+            logger.warning(f"Failed to load history for chat {chat_id}: {e}")
+        self._chats[chat_id] = history
+        return history
+
+    async def commit_turn(self, chat_id: int, history: ChatHistory) -> None:
+        """ذخیره افزایشی نوبت تمام‌شده، سپس فشرده‌سازی و ذخیره خلاصه در صورت تغییر."""
+        try:
+            await self.store.append_turn(chat_id, history.next_seq - 1, serialize_turn(history.turns[-1]))
+        except Exception as e:
+            logger.warning(f"Failed to persist turn for chat {chat_id}: {e}")
+        history.compact()
+        if history.summary_dirty:
+            try:
+                await self.store.save_summary(chat_id, history.summary, history.first_seq)
+                history.summary_dirty = False
+            except Exception as e:
+                logger.warning(f"Failed to persist history summary for chat {chat_id}: {e}")
+
+    async def reset(self, chat_id: int) -> None:
+        self._chats.pop(chat_id, None)
+        try:
+            await self.store.delete(chat_id)
+        except Exception as e:
+            logger.warning(f"Failed to delete stored history for chat {chat_id}: {e}")
+
+    def total_tokens(self) -> int:
+        return sum(history.tokens for history in self._chats.values())
+
+    def evict_idle(self, active_chat_id: int = None) -> None:
+        """حذف تاریخچه کم‌استفاده‌ترین چت‌ها از حافظه (نسخه ذخیره‌شده باقی می‌ماند)؛ چت‌های در حال اجرا حذف نمی‌شوند."""
+        total = self.total_tokens()
+        evicted = 0
+        for chat_id in list(self._chats):
+            if len(self._chats) <= self.max_chats and total <= self.global_token_budget:
+                break
+            if chat_id == active_chat_id or chat_id in _chat_locks:
+                continue
+            total -= self._chats.pop(chat_id).tokens
+            evicted += 1
+        if evicted:
+            logger.info(f"Evicted {evicted} idle chat histories ({len(self._chats)} chats, ~{total} tokens kept).")
+
+
+history_manager = HistoryManager(HISTORY_MAX_CHATS, HISTORY_GLOBAL_TOKEN_BUDGET, create_history_store())
+
+
+# --- مسیر سریع: پاسخ به درخواست‌های قطعی بدون فراخوانی Gemini ---
+# جستجوی مستقیم نام مشتری برای پیام‌های کوتاه وقتی سؤالی از کاربر در انتظار پاسخ نیست
+# (یک کوئری ایندکس‌دار؛ نتیجه منفی کوتاه‌مدت کش می‌شود)
+FAST_PATH_NAME_LOOKUP = os.environ.get("FAST_PATH_NAME_LOOKUP", "1") == "1"
+FAST_PATH_NAME_MAX_WORDS = 4
+# پیام‌های کوتاه رایجی که نام مشتری نیستند و برایشان کوئری زده نمی‌شود
+FAST_PATH_SMALL_TALK = {"سلام", "درود", "ممنون", "مرسی", "متشکرم", "باشه", "اوکی", "خداحافظ", "بله", "نه", "hi", "hello", "ok", "thanks"}
+QUICK_REPORT_CALLBACK = "qr"
+
+BUTTON_NEW_CUSTOMER = "✍️ ثبت اطلاعات جدید"
+BUTTON_LOG_CALL = "📞 ثبت گزارش تماس"
+BUTTON_REPORT = "📊 درخواست گزارش هوشمند"
+BUTTON_EXPORT = "📥 ارسال فایل کل مشتریان"
+
+FORM_CANCEL_WORDS = {"لغو", "انصراف", "cancel"}
+FORM_SKIP = "-"
+
+# هر فرم: عنوان، مراحل (فیلد، سؤال، اجباری) و تابعی که در پایان با مقادیر و chat_id فراخوانی می‌شود
+GUIDED_FORMS = {
+    "customer": {
+        "title": "ثبت مشتری جدید",
+        "steps": [
+            ("name", "نام مشتری را وارد کنید:", True),
+            ("phone", "شماره تلفن مشتری:", True),
+            ("company", "نام شرکت:", False),
+            ("industry", "حوزه فعالیت:", False),
+            ("services", "خدمات مورد نظر:", False),
+        ],
+        "submit": lambda values, chat_id: manage_customer_data(**values),
+    },
+    "interaction": {
+        "title": "ثبت گزارش تماس",
+        "steps": [
+            ("customer_name", "نام مشتری:", True),
+            ("interaction_report", "خلاصه گزارش تماس:", True),
+            ("follow_up_date", "تاریخ پیگیری بعدی (YYYY-MM-DD):", False),
+        ],
+        "submit": lambda values, chat_id: log_interaction(**values, chat_id=chat_id),
+    },
+}
+
+# تعداد نوبت‌هایی که هر مسیر پاسخ داده است؛ «llm» یعنی Gemini واقعاً فراخوانده شده و
+# «response_cache» یعنی پاسخ از کش پاسخ‌ها آمده است؛ بقیه کلیدها مسیرهای سریع‌اند
+fast_path_stats = Counter()
+# مسیرهایی از fast_path_stats که مسیر سریع حساب نمی‌شوند
+NON_FAST_PATH_ROUTES = ("llm", "response_cache")
+
+_LIST_ALL_RE = re.compile(r"^(list( all)? customers|(لیست|فهرست|نمایش)( همه| کل)? مشتری(ان| ها)|همه مشتری(ان| ها))$")
+_COUNT_BY_INDUSTRY_RE = re.compile(r"^((تعداد|آمار) مشتری(ان| ها)( به تفکیک| بر اساس)? (صنعت|حوزه)|count by industry)$")
+_FOLLOWUPS_RE = re.compile(r"^((آمار|تعداد|لیست|فهرست) )?پیگیری( ها|های) هفتگی$|^followups by week$")
+_INDUSTRY_SEARCH_RE = re.compile(r"^(مشتری(ان| ها)|لیست مشتری(ان| ها)) (حوزه|صنعت) (?P<term>.+)$")
+_EXPORT_RE = re.compile(r"^(export( customers)?|خروجی( فایل)?( مشتری(ان| ها))?)( (?P<format>csv|xlsx|excel|اکسل))?$")
+_CUSTOMER_LOOKUP_RE = re.compile(r"^((اطلاعات|مشخصات|پرونده|جزئیات)( مشتری)?|customer) (?P<name>.+)$")
+
+def fast_path_served() -> int:
+    return sum(count for intent, count in fast_path_stats.items() if intent not in NON_FAST_PATH_ROUTES)
+
+def _record_fast_path(intent: str, chat_id: int) -> None:
+    fast_path_stats[intent] += 1
+    served = fast_path_served()
+    logger.info(
+        f"Fast path '{intent}' served chat {chat_id} without Gemini "
+        f"({served}/{sum(fast_path_stats.values())} turns so far)"
+    )
+
+def _quick_report_keyboard():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("📋 همه مشتریان", callback_data=f"{QUICK_REPORT_CALLBACK}:all")],
+        [InlineKeyboardButton("🏭 تعداد به تفکیک حوزه", callback_data=f"{QUICK_REPORT_CALLBACK}:count_by_industry")],
+        [InlineKeyboardButton("📅 پیگیری‌های هفتگی", callback_data=f"{QUICK_REPORT_CALLBACK}:followups_by_week")],
+    ])
+
+async def send_quick_report(context: ContextTypes.DEFAULT_TYPE, chat_id: int, query_type: str, search_term: str = None) -> None:
+    """اجرای مستقیم get_report (فهرست صفحه‌بندی‌شده یا گزارش تجمیعی) و ارسال نتیجه."""
+    if query_type in LISTING_REPORT_TYPES:
+        result = await send_report_listing(context, chat_id, {"query_type": query_type, "search_term": search_term}, send_empty=True)
+        if result is None:
+            await context.bot.send_message(chat_id=chat_id, text="⚠️ سرویس حافظه دائمی (PostgreSQL) فعال نیست.")
+        elif result.startswith("خطا"):
+            await context.bot.send_message(chat_id=chat_id, text=f"⚠️ {result}")
+        return
+    if await is_heavy_report(query_type):
+        await context.bot.send_message(chat_id=chat_id, text=job_ack_text(submit_report_job(chat_id, query_type, search_term)))
+        return
+    await context.bot.send_message(chat_id=chat_id, text=await get_report(query_type, search_term), parse_mode='Markdown')
+
+async def quick_report_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """پاسخ به دکمه‌های منوی «درخواست گزارش هوشمند»."""
+    query = update.callback_query
+    query_type = query.data.split(":", 1)[1]
+    await query.answer()
+    async with chat_turn_lock(update.effective_chat.id):
+        await send_quick_report(context, update.effective_chat.id, query_type)
+    _record_fast_path(f"report:{query_type}", update.effective_chat.id)
+
+async def start_guided_form(update: Update, context: ContextTypes.DEFAULT_TYPE, form_name: str) -> None:
+    form = GUIDED_FORMS[form_name]
+    context.chat_data['form'] = {"name": form_name, "step": 0, "values": {}}
+    await update.message.reply_text(
+        f"📝 {form['title']}\n(برای انصراف «لغو» و برای رد شدن از موارد اختیاری «{FORM_SKIP}» بفرستید.)\n\n{form['steps'][0][1]}"
+    )
+
+async def continue_guided_form(update: Update, context: ContextTypes.DEFAULT_TYPE, state: dict) -> None:
+    """ذخیره پاسخ مرحله فعلی فرم و پرسیدن مرحله بعد؛ در پایان تابع CRM مستقیماً اجرا می‌شود."""
+    form = GUIDED_FORMS[state["name"]]
+    field, _, required = form["steps"][state["step"]]
+    value = update.message.text.strip()
+    
+    if value == FORM_SKIP:
+        if required:
+            await update.message.reply_text("این مورد اجباری است؛ لطفاً مقدار آن را وارد کنید.")
+            return
+        value = None
+    elif field == "follow_up_date":
+        try:
+            datetime.strptime(value, "%Y-%m-%d")
+        except ValueError:
+            await update.message.reply_text("فرمت تاریخ باید YYYY-MM-DD باشد (مثلاً 2025-01-15).")
+            return
+    
+    state["values"][field] = value
+    state["step"] += 1
+    if state["step"] < len(form["steps"]):
+        await update.message.reply_text(form["steps"][state["step"]][1])
+        return
+    
+    context.chat_data.pop('form', None)
+    await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
+    result = await form["submit"](state["values"], update.effective_chat.id)
+    await update.message.reply_text(f"✅ {result}" if not result.startswith("خطا") else f"⚠️ {result}")
+
+async def _lookup_exact_customer(name: str):
+    """مشتری با نام دقیقاً برابر (پس از نرمال‌سازی) یا None."""
+    key = normalize_lookup_key(name)
+    if customer_miss_cache.get(key):
+        return None
+    customer = await find_customer_data(name)
+    if customer and normalize_lookup_key(customer[1]) == key:
+        return customer
+    customer_miss_cache.set(key, True)
+    return None
+
+def awaiting_reply(history: ChatHistory) -> bool:
+    """True اگر نوبت آخر با پاسخ نهایی مدل تمام نشده یا آن پاسخ از کاربر سؤالی پرسیده باشد."""
+    if not history.turns:
+        return False
+    last = history.turns[-1][-1]
+    if last.role != "model" or any(part.function_call for part in last.parts or []):
+        return True
+    text = "".join(part.text or "" for part in last.parts or []).strip()
+    last_paragraph = text.split("\n\n")[-1]
+    return "?" in last_paragraph or "؟" in last_paragraph
+
+async def route_fast_path(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """مسیریابی محلی پیش از Gemini با تطابق دقیق و قواعد regex؛ True یعنی پیام بدون مدل پاسخ داده شد."""
+    text = update.message.text.strip()
+    chat_id = update.effective_chat.id
+    key = normalize_lookup_key(text).strip(" .!؟?")
+    
+    state = context.chat_data.get('form')
+    if state is not None:
+        if key in FORM_CANCEL_WORDS:
+            context.chat_data.pop('form', None)
+            await update.message.reply_text("فرم لغو شد.")
+            _record_fast_path("form_cancel", chat_id)
+            return True
+        if text not in (BUTTON_NEW_CUSTOMER, BUTTON_LOG_CALL, BUTTON_REPORT, BUTTON_EXPORT):
+            await continue_guided_form(update, context, state)
+            _record_fast_path(f"form:{state['name']}", chat_id)
+            return True
+        # زدن یکی از دکمه‌های صفحه‌کلید فرم نیمه‌کاره را کنار می‌گذارد
+        context.chat_data.pop('form', None)
+    
+    intent = None
+    if text == BUTTON_EXPORT:
+        intent = "export"
+        await export_data_to_file(update, context)
+    elif text == BUTTON_NEW_CUSTOMER:
+        intent = "form:customer"
+        await start_guided_form(update, context, "customer")
+    elif text == BUTTON_LOG_CALL:
+        intent = "form:interaction"
+        await start_guided_form(update, context, "interaction")
+    elif text == BUTTON_REPORT:
+        intent = "report_menu"
+        await update.message.reply_text(
+            "کدام گزارش را می‌خواهید؟ برای گزارش‌های تحلیلی دیگر، سؤال خود را بنویسید.",
+            reply_markup=_quick_report_keyboard()
+        )
+    elif _LIST_ALL_RE.match(key):
+        intent = "report:all"
+        await send_quick_report(context, chat_id, "all")
+    elif _COUNT_BY_INDUSTRY_RE.match(key):
+        intent = "report:count_by_industry"
+        await send_quick_report(context, chat_id, "count_by_industry")
+    elif _FOLLOWUPS_RE.match(key):
+        intent = "report:followups_by_week"
+        await send_quick_report(context, chat_id, "followups_by_week")
+    elif match := _INDUSTRY_SEARCH_RE.match(key):
+        intent = "report:industry_search"
+        await send_quick_report(context, chat_id, "industry_search", match.group("term"))
+    elif match := _EXPORT_RE.match(key):
+        file_format = "xlsx" if match.group("format") in ("xlsx", "excel", "اکسل") and openpyxl is not None else "csv"
+        intent = "export"
+        await export_data_to_file(update, context, file_format=file_format)
     else:
-        logger.error("GEMINI_API_KEY is not set.")
+        match = _CUSTOMER_LOOKUP_RE.match(key)
+        name = match.group("name") if match else None
+        history = None
+        if name is None and FAST_PATH_NAME_LOOKUP and len(key.split()) <= FAST_PATH_NAME_MAX_WORDS \
+                and not any(ch.isdigit() for ch in key) and key not in FAST_PATH_SMALL_TALK:
+            # نام تنها فقط وقتی جستجو می‌شود که مدل منتظر پاسخ کاربر نباشد (مثلاً «کدام مشتری را حذف کنم؟»)
+            history = await history_manager.get(chat_id)
+            if not awaiting_reply(history):
+                name = key
+        customer = await _lookup_exact_customer(name) if name else None
+        if customer is None:
+            return False
+        intent = "customer_lookup"
+        report = await get_report('full_customer', customer[1])
+        await reply_full_text(update.message, report)
+        # نوبت در تاریخچه ثبت می‌شود تا پرسش بعدی کاربر درباره همین مشتری زمینه داشته باشد
+        history = history or await history_manager.get(chat_id)
+        history.start_turn(types.Content(role="user", parts=[types.Part(text=text)]))
+        history.append(types.Content(role="model", parts=[types.Part(text=report)]))
+        await history_manager.commit_turn(chat_id, history)
+    
+    _record_fast_path(intent, chat_id)
+    return True
+
+
+async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not update.message or not update.message.text:
+        return
+
+    start_turn_trace(update.effective_chat.id)
+    async with chat_turn_lock(update.effective_chat.id):
+        started = time.perf_counter()
+        if await route_fast_path(update, context):
+            TURN_SECONDS.observe(time.perf_counter() - started, path="fast_path")
+            return
+        if not ai_client:
+            return
+        await handle_chat_turn(update, context)
+
+
+async def _close_partial_reply(reply: StreamingReply) -> None:
+    """برداشتن نشانگر از پاسخ نیمه‌کاره‌ای که جریانش با خطا قطع شده است."""
+    with contextlib.suppress(Exception):
+        await reply.finish()
+
+
+# توابع فقط‌خواندنی که پاسخ نوبت‌هایشان قابل کش شدن است
+READ_ONLY_TOOLS = {"get_report", "search_interactions"}
+
+def is_cacheable_read(function_calls) -> bool:
+    """True اگر همه فراخوانی‌ها فقط‌خواندنی باشند و هیچ‌کدام فهرست را مستقیماً برای کاربر نفرستد."""
+    return all(
+        call.name in READ_ONLY_TOOLS and (call.args or {}).get("query_type") not in LISTING_REPORT_TYPES
+        for call in function_calls
+    )
+
+
+async def handle_chat_turn(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """پردازش یک پیام متنی کاربر (یک نوبت گفتگو) با Gemini و توابع CRM."""
+    user_text = update.message.text
+    chat_id = update.effective_chat.id
+    
+    history = await history_manager.get(chat_id)
+    user_part = types.Part(text=user_text)
+    history.start_turn(types.Content(role="user", parts=[user_part]))
+    
+    # پرسش تکراری فقط‌خواندنی در همان نسخه داده‌ها: پاسخ قبلی بدون فراخوانی مدل و دیتابیس
+    version = data_version
+    cache_key = response_cache_key(chat_id, user_text, version)
+    cached_reply = response_cache.get(cache_key)
+    if cached_reply is not None:
+        history.append(types.Content(role="model", parts=[types.Part(text=cached_reply)]))
+        cache_started = time.perf_counter()
+        await reply_full_text(update.message, cached_reply)
+        TURN_SECONDS.observe(time.perf_counter() - cache_started, path="response_cache")
+        fast_path_stats["response_cache"] += 1
+        logger.info(f"Chat {chat_id} turn served from response cache (data version {version}).")
+        await history_manager.commit_turn(chat_id, history)
+        return
+    
+    fast_path_stats["llm"] += 1
+    await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+    
+    # دستورالعمل و اعلان توابع ثابت‌اند و در صورت امکان از کش زمینه Gemini خوانده می‌شوند
+    config = await gemini_context_cache.config()
+    
+    # پاسخ نهایی (و هر متنی که مدل همراه فراخوانی توابع بدهد) به‌صورت جریانی نوشته می‌شود
+    reply = StreamingReply(update.message)
+    try:
+        turn_started = time.perf_counter()
+        content = None
+        # فقط نوبت‌هایی که تنها get_report (بدون ارسال مستقیم فهرست) فراخوانده‌اند کش می‌شوند
+        read_only, used_tools = True, False
+        # حلقه عامل: تا وقتی مدل تابع درخواست می‌کند، توابع اجرا و نتایج به او برگردانده می‌شود
+        for step in range(1, AGENT_MAX_STEPS + 1):
+            step_started = time.perf_counter()
+            content, function_calls = await run_model_step(history.contents(), config, reply)
+            model_seconds = time.perf_counter() - step_started
+            
+            GEMINI_SECONDS.observe(model_seconds, call="first" if step == 1 else "followup",
+                                   outcome="tool_calls" if function_calls else "answer")
+            trace_event("model", f"step{step}", model_seconds)
+            if not function_calls:
+                logger.info(f"Chat {chat_id} step {step}: model {model_seconds:.2f}s, final answer")
+                break
+            
+            history.append(content)
+            used_tools = True
+            read_only = read_only and is_cacheable_read(function_calls)
+            tools_started = time.perf_counter()
+            tool_responses = await execute_tool_calls(function_calls, chat_id, context)
+            # پاسخی که فقط «کار در صف است» می‌گوید نباید برای پرسش تکراری بازپخش شود
+            read_only = read_only and not any(is_job_ack(part) for part in tool_responses)
+            history.append(types.Content(role="tool", parts=tool_responses))
+            logger.info(
+                f"Chat {chat_id} step {step}: model {model_seconds:.2f}s, "
+                f"{len(tool_responses)} tool call(s) {time.perf_counter() - tools_started:.2f}s"
+            )
+        else:
+            # سقف گام‌ها پر شد؛ مدل باید بدون فراخوانی تابع دیگر پاسخ متنی بدهد
+            logger.warning(f"Chat {chat_id} reached AGENT_MAX_STEPS={AGENT_MAX_STEPS}; forcing a text answer.")
+            step_started = time.perf_counter()
+            # tool_config را نمی‌توان همراه cached_content فرستاد؛ این گام بدون کش اجرا می‌شود
+            content, _ = await run_model_step(history.contents(), FORCED_ANSWER_CONFIG, reply)
+            model_seconds = time.perf_counter() - step_started
+            GEMINI_SECONDS.observe(model_seconds, call="forced", outcome="answer")
+            trace_event("model", "forced", model_seconds)
+            logger.info(f"Chat {chat_id} forced final step: model {model_seconds:.2f}s")
+        
+        if content is not None:
+            history.append(content)
+        await reply.finish("✅ انجام شد.")
+        turn_seconds = time.perf_counter() - turn_started
+        TURN_SECONDS.observe(turn_seconds, path="llm")
+        first_text = ""
+        if reply.first_text_at:
+            GEMINI_FIRST_TEXT_SECONDS.observe(reply.first_text_at - turn_started)
+            first_text = f", first text after {reply.first_text_at - turn_started:.2f}s"
+        logger.info(f"Chat {chat_id} turn finished in {turn_seconds:.2f}s{first_text}")
+        log_turn_trace(chat_id, "llm", turn_seconds)
+        if read_only and used_tools and reply.text and data_version == version:
+            response_cache.set(cache_key, reply.text)
+        
+        # رعایت بودجه توکن این چت و آزادسازی حافظه چت‌های بیکار
+        await history_manager.commit_turn(chat_id, history)
+        history_manager.evict_idle(active_chat_id=chat_id)
+
+    except APIError as e:
+        logger.error(f"Gemini API Error: {e}")
+        API_ERRORS.inc(kind="gemini")
+        if config.cached_content:
+            # کش ممکن است در سمت سرور منقضی یا حذف شده باشد؛ نوبت بعد دوباره ساخته یا بدون کش اجرا می‌شود
+            gemini_context_cache.invalidate()
+        # نوبت ناقص (مثلاً فراخوانی تابع بدون پاسخ) در تاریخچه باقی نمی‌ماند
+        history.abort_turn()
+        await _close_partial_reply(reply)
+        await update.message.reply_text("⚠️ خطای API رخ داد. لطفاً چند دقیقه دیگر امتحان کنید.")
+    except Exception as e:
+        logger.error(f"An unexpected error occurred: {e}")
+        API_ERRORS.inc(kind="unexpected")
+        history.abort_turn()
+        await _close_partial_reply(reply)
+        await update.message.reply_text(f"❓ یک خطای نامشخص رخ داد. لطفاً لاگ‌های سرور را بررسی کنید. خطا: {e}")
+
+
+async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """پاسخ به دستور /start و راهنمایی اولیه."""
+    
+    # با همان قفل نوبت چت؛ تا نوبت در حال اجرا تاریخچه را پس از ریست دوباره ننویسد
+    async with chat_turn_lock(update.effective_chat.id):
+        await history_manager.reset(update.effective_chat.id)
+        context.chat_data.pop('form', None)
+        
+    ai_status = "✅ متصل و آماده" if ai_client else "❌ غیرفعال (کلید API را بررسی کنید)."
+    
+    # اتصال مشترک بسته نمی‌شود؛ فقط وضعیت استخر بررسی می‌شود
+    pool = await get_db_pool()
+    db_status = "✅ متصل به PostgreSQL" if pool else "❌ مشکل در اتصال به دیتابیس"
+    
+    reply_keyboard = [
+        [BUTTON_NEW_CUSTOMER, BUTTON_LOG_CALL],
+        [BUTTON_REPORT, BUTTON_EXPORT],
+    ]
+    markup = ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=False, resize_keyboard=True)
+    
+    message = (
+        f"🤖 **CRM Bot هوشمند با حافظه دائمی PostgreSQL**\n\n"
+        f"✨ وضعیت AI: {ai_status}\n"
+        f"💾 وضعیت حافظه: {db_status}\n"
+        f"**نحوه استفاده:** هرگونه پیام یا درخواستی که دارید را ارسال کنید، یا از دکمه‌های زیر استفاده کنید. ربات نیت شما را درک و عملیات لازم را انجام می‌دهد و **پیشنهاد هوشمندانه** می‌دهد.\n\n"
+        f"**مثال‌های هوشمند:**\n"
+        f" - **ثبت و تحلیل:** 'با آقای نوری صحبت کردم. گفت قیمت رقبا بالاتره.'\n"
+        f" - **هشدار فعال (اصلاح شده):** 'برای هفته بعد دوشنبه ساعت ۱۰:۰۰ پیگیری با نوری رو برام یادآوری کن.' (فرمت **YYYY-MM-DD HH:MM**)\n"
+        f" - **حذف:** 'آقای الف رو از لیست مشتریان حذف کن.'\n"
+        f" - **ورود دسته‌ای:** فایل CSV یا XLSX مشتریان (ستون‌های name, phone, company, industry, services) را بفرستید؛ برای گزارشات تماس، کپشن فایل را «تعاملات» بگذارید.\n"
+        f" - **پیگیری‌های امروز:** هر روز ساعت {DIGEST_TIME} خلاصه پیگیری‌های سررسید و عقب‌افتاده ارسال می‌شود؛ در هر زمان با /today.\n"
+        f" - **کارهای پس‌زمینه:** خروجی فایل و گزارش‌های سنگین در پس‌زمینه آماده و ارسال می‌شوند؛ وضعیت آن‌ها با /jobs.\n"
+    )
+    
+    await update.message.reply_text(message, reply_markup=markup, parse_mode='Markdown')
 
-    # --- ابتدا اتصال به PostgreSQL را برقرار و جداول را می‌سازیم ---
+
+async def post_init(application: Application) -> None:
+    """آماده‌سازی استخر اتصال و جداول دیتابیس داخل event loop خود ربات."""
     # توجه: اجرای مجدد init_db باعث می شود جدول reminders تغییر کند.
-    if init_db():
+    if await init_db():
         logger.info("PostgreSQL Database is ready for use.")
     else:
         logger.error("FATAL: Could not initialize PostgreSQL. Check DATABASE_URL and Render service.")
+    if openpyxl is None:
+        # بدون این هشدار، نبود کتابخانه فقط در پاسخ به کاربر دیده می‌شود
+        logger.warning("openpyxl is not installed: XLSX export and import are disabled (install requirements.txt).")
+
+
+async def post_shutdown(application: Application) -> None:
+    """توقف وظایف پس‌زمینه و آزاد کردن اتصالات دیتابیس هنگام توقف ربات."""
+    for task in list(_background_tasks):
+        task.cancel()
+    await reminder_status_writer.flush()
+    await gemini_context_cache.close()
+    await close_db_pool()
+
+
+_background_tasks = set()
+
+def start_background_task(coro) -> None:
+    """اجرای یک وظیفه دائمی پس‌زمینه که هنگام خاموشی لغو می‌شود."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+async def start_background_services(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """راه‌اندازی وظایف دائمی پس‌زمینه پس از شروع Application."""
+    outbound_delivery.start()
+    job_runner.start()
+    start_background_task(reminder_status_writer.run())
+    if DATABASE_URL:
+        start_background_task(pg_listener.run())
+        # در چند نمونه/worker فقط رهبر زمان‌بند را اجرا می‌کند
+        start_background_task(run_as_leader(SCHEDULER_LOCK_ID, "reminder scheduler", reminder_scheduler.run))
+    else:
+        start_background_task(reminder_scheduler.run())
+    if METRICS_PORT:
+        # workerها روی پورت‌های بعدی (METRICS_PORT + 1 + شماره worker)
+        port = int(METRICS_PORT) + (0 if worker_index is None else 1 + worker_index)
+        start_background_task(serve_metrics(port))
+
+
+def build_application() -> Application:
+    """ساخت Application تلگرام به همراه هندلرها و وظیفه یادآوری."""
+    application = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        # به‌روزرسانی‌ها موازی پردازش می‌شوند؛ ترتیب هر چت با chat_turn_lock حفظ می‌شود
+        .concurrent_updates(True)
+        .build()
+    )
+    application.add_handler(CommandHandler("start", start_command))
+    application.add_handler(CommandHandler("export", export_command))
+    application.add_handler(CommandHandler("jobs", jobs_command))
+    application.add_handler(CommandHandler("today", today_command))
+    application.add_handler(CallbackQueryHandler(report_page_callback, pattern=f"^{REPORT_PAGE_CALLBACK}:"))
+    application.add_handler(CallbackQueryHandler(quick_report_callback, pattern=f"^{QUICK_REPORT_CALLBACK}:"))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
+    application.add_handler(MessageHandler(
+        filters.Document.FileExtension("csv") | filters.Document.FileExtension("xlsx"), document_handler
+    ))
+    
+    # اجرای زمان‌بند یادآوری (Reminders)، صف ارسال و شنونده NOTIFY
+    global reminder_scheduler, outbound_delivery, job_runner
+    outbound_delivery = OutboundDelivery(application.bot)
+    job_runner = JobRunner(application.bot)
+    reminder_scheduler = ReminderScheduler(application)
+    pg_listener.subscribe(REMINDERS_CHANNEL, reminder_scheduler.on_notify)
+    if CACHE_NOTIFY_INVALIDATION:
+        enable_cache_invalidation_listener()
+    if application.job_queue:
+        application.job_queue.run_once(start_background_services, 0)
+        if DIGEST_ENABLED and DATABASE_URL:
+            schedule_followup_digest(application)
+    return application
+
+
+# =================================================================
+# --- راه‌اندازی سریع webhook: باز کردن فوری پورت و آماده‌سازی هم‌زمان در پس‌زمینه ---
+# =================================================================
+# در حالت webhook پیش‌فرض فعال است؛ FAST_START=0 همان run_webhook کتابخانه را اجرا می‌کند
+FAST_START = os.environ.get("FAST_START", "1") == "1"
+
+async def _timed_startup_step(phase: str, coro):
+    started = time.perf_counter()
+    result = await coro
+    mark_startup_phase(phase, time.perf_counter() - started)
+    return result
+
+async def run_fast_webhook() -> None:
+    """پورت webhook پیش از هر کار دیگری باز می‌شود و به‌روزرسانی‌ها تا آماده شدن ربات در update_queue می‌مانند.
+
+    import و ساخت کلاینت Gemini، استخر و اسکیمای دیتابیس و اتصال به تلگرام هم‌زمان انجام می‌شوند؛
+    /healthz همیشه و /readyz فقط پس از آماده شدن 200 برمی‌گرداند.
+    """
+    application = build_application()
+    url_path = f"/{TELEGRAM_BOT_TOKEN}"
+    ready = asyncio.Event()
+    buffered = 0
+
+    async def webhook_route(method: str, headers: dict, body: bytes):
+        nonlocal buffered
+        if method != "POST" or headers.get("x-telegram-bot-api-secret-token") != WEBHOOK_SECRET:
+            return "403 Forbidden", "text/plain", "forbidden\n"
+        try:
+            update = Update.de_json(json.loads(body), application.bot)
+        except Exception as e:
+            # JSON معتبری که Update نیست هم باید پاسخ بگیرد؛ بدون پاسخ تلگرام مدام دوباره می‌فرستد
+            logger.warning(f"Rejected malformed webhook update: {e}")
+            return "400 Bad Request", "text/plain", "bad request\n"
+        if not ready.is_set():
+            buffered += 1
+        # پیش از application.start() به‌روزرسانی فقط در صف می‌ماند و پس از آماده شدن به ترتیب پردازش می‌شود
+        await application.update_queue.put(update)
+        return "200 OK", "text/plain", "ok\n"
+
+    async def health_route(method: str, headers: dict, body: bytes):
+        return "200 OK", "text/plain", "ok\n"
+
+    async def ready_route(method: str, headers: dict, body: bytes):
+        if ready.is_set():
+            return "200 OK", "text/plain", "ready\n"
+        return "503 Service Unavailable", "text/plain", "starting\n"
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    server = await start_http_server(PORT, {
+        url_path: webhook_route, "/healthz": health_route, "/readyz": ready_route, "/metrics": metrics_route
+    })
+    mark_startup_phase("port_bound")
+    try:
+        await asyncio.gather(
+            # import سنگین SDK در thread تا پورت در همین مدت پاسخ‌گو بماند
+            _timed_startup_step("ai_client", asyncio.to_thread(init_ai_client)),
+            _timed_startup_step("database", post_init(application)),
+            _timed_startup_step("telegram", application.initialize()),
+        )
+        await _timed_startup_step("set_webhook", application.bot.set_webhook(
+            f"{RENDER_EXTERNAL_URL}{url_path}", secret_token=WEBHOOK_SECRET, allowed_updates=Update.ALL_TYPES
+        ))
+        await application.start()
+        ready.set()
+        mark_startup_phase("ready")
+        logger.info(f"Webhook bot ready on port {PORT}; {buffered} update(s) were buffered during startup.")
+        await stop.wait()
+    finally:
+        server.close()
+        if application.running:
+            await application.stop()
+        await post_shutdown(application)
+        await application.shutdown()
+
+
+# =================================================================
+# --- حالت مقیاس‌پذیر: ورودی webhook، صف به‌روزرسانی‌ها در PostgreSQL و workerها ---
+# =================================================================
+# single (پیش‌فرض، یک فرآیند)، ingress، worker یا cluster (ingress و WORKER_COUNT فرآیند worker روی همین ماشین)
+BOT_MODE = os.environ.get("BOT_MODE", "single").lower()
+WORKER_COUNT = max(int(os.environ.get("WORKER_COUNT", "2")), 1)
+WORKER_INDEX = int(os.environ.get("WORKER_INDEX", "0"))
+UPDATE_QUEUE_BATCH = int(os.environ.get("UPDATE_QUEUE_BATCH", "100"))
+# به‌روزرسانی claim شده‌ای که تا این مدت پردازش نشده (مثلاً کرش worker) دوباره برداشته می‌شود
+UPDATE_LEASE_SECONDS = int(os.environ.get("UPDATE_LEASE_SECONDS", "300"))
+# سقف به‌روزرسانی‌های برداشته‌شده و هنوز پردازش‌نشده هر worker؛ بقیه صف در دیتابیس می‌ماند
+UPDATE_MAX_IN_FLIGHT = max(int(os.environ.get("UPDATE_MAX_IN_FLIGHT", "200")), 1)
+# فاصله بررسی صف وقتی NOTIFY نرسیده است
+UPDATE_POLL_INTERVAL = float(os.environ.get("UPDATE_POLL_INTERVAL", "2"))
+UPDATES_CHANNEL = "crm_updates"
+# توکن مخفی webhook؛ تلگرام آن را در سرآیند هر درخواست برمی‌گرداند. مقدار پیش‌فرض از توکن ربات
+# مشتق می‌شود تا پس از راه‌اندازی مجدد با webhook ثبت‌شده قبلی یکسان بماند (به‌روزرسانی‌های لحظه شروع رد نشوند)
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or hashlib.sha256(f"webhook:{TELEGRAM_BOT_TOKEN}".encode()).hexdigest()[:32]
+# قفل advisory رهبری زمان‌بند یادآوری‌ها و فاصله تلاش/بررسی رهبری
+SCHEDULER_LOCK_ID = 48151624
+LEADER_RETRY_SECONDS = 15
+LEADER_CHECK_SECONDS = 10
+
+# در فرآیندهای worker شماره بخش این فرآیند (None در حالت‌های دیگر)
+worker_index = None
+
+_UPDATE_CHAT_KEYS = ("message", "edited_message", "channel_post", "edited_channel_post",
+                     "my_chat_member", "chat_member", "chat_join_request")
+_UPDATE_USER_KEYS = ("callback_query", "inline_query", "chosen_inline_result", "shipping_query", "pre_checkout_query")
+
+def update_chat_id(data: dict) -> int:
+    """chat_id یک به‌روزرسانی خام تلگرام (یا شناسه کاربر برای به‌روزرسانی‌های بدون چت)."""
+    for key in _UPDATE_CHAT_KEYS:
+        chat = (data.get(key) or {}).get("chat")
+        if chat:
+            return chat["id"]
+    chat = ((data.get("callback_query") or {}).get("message") or {}).get("chat")
+    if chat:
+        return chat["id"]
+    for key in _UPDATE_USER_KEYS:
+        user = (data.get(key) or {}).get("from")
+        if user:
+            return user["id"]
+    return 0
+
+def update_partition(chat_id: int) -> int:
+    """همه به‌روزرسانی‌های یک چت به یک worker می‌رسند (ترتیب و chat_data آن چت حفظ می‌شود)."""
+    return abs(chat_id) % WORKER_COUNT
+
+async def enqueue_update(data: dict) -> None:
+    """ذخیره پایدار به‌روزرسانی در صف و بیدار کردن worker آن بخش در یک رفت‌وبرگشت."""
+    pool = await get_db_pool()
+    if pool is None:
+        raise RuntimeError("PostgreSQL is not configured")
+    chat_id = update_chat_id(data)
+    async with pool.connection() as conn:
+        await conn.execute(
+            """
+            WITH queued AS (
+                INSERT INTO update_queue (chat_id, worker_partition, payload) VALUES (%s, %s, %s::jsonb)
+                RETURNING worker_partition
+            )
+            SELECT pg_notify(%s, worker_partition::text) FROM queued
+            """,
+            (chat_id, update_partition(chat_id), json.dumps(data, ensure_ascii=False), UPDATES_CHANNEL)
+        )
+    UPDATES_ENQUEUED.inc()
+
+async def webhook_ingress_route(method: str, headers: dict, body: bytes):
+    """مسیر webhook در حالت ingress: فقط ذخیره در صف و پاسخ فوری به تلگرام."""
+    if method != "POST" or headers.get("x-telegram-bot-api-secret-token") != WEBHOOK_SECRET:
+        return "403 Forbidden", "text/plain", "forbidden\n"
+    try:
+        await enqueue_update(json.loads(body))
+    except Exception as e:
+        logger.error(f"Failed to enqueue update: {e}")
+        # با پاسخ خطا تلگرام همان به‌روزرسانی را دوباره می‌فرستد
+        return "503 Service Unavailable", "text/plain", "retry\n"
+    return "200 OK", "text/plain", "ok\n"
+
+async def poll_ingress(bot) -> None:
+    """ورودی long-polling برای اجرای لوکال؛ offset فقط پس از ذخیره موفق جلو می‌رود."""
+    offset = None
+    while True:
+        try:
+            for update in await bot.get_updates(offset=offset, timeout=30, allowed_updates=Update.ALL_TYPES):
+                await enqueue_update(update.to_dict())
+                offset = update.update_id + 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Polling ingress error: {e}. Retrying in 5s.")
+            await asyncio.sleep(5)
+
+async def run_ingress() -> None:
+    """فرآیند ورودی: به‌روزرسانی‌ها را بدون پردازش در update_queue می‌گذارد."""
+    if not await init_db():
+        logger.error("FATAL: the ingress needs PostgreSQL for the update queue.")
+        return
+    bot = Bot(TELEGRAM_BOT_TOKEN)
+    async with bot:
+        if RENDER_EXTERNAL_URL:
+            url_path = f"/{TELEGRAM_BOT_TOKEN}"
+            await bot.set_webhook(f"{RENDER_EXTERNAL_URL}{url_path}", secret_token=WEBHOOK_SECRET,
+                                  allowed_updates=Update.ALL_TYPES)
+            logger.info(f"Ingress webhook set; enqueuing updates for {WORKER_COUNT} worker partition(s) on port {PORT}.")
+            await serve_http(PORT, {url_path: webhook_ingress_route, "/metrics": metrics_route})
+        else:
+            await bot.delete_webhook()
+            if METRICS_PORT:
+                start_background_task(serve_metrics(int(METRICS_PORT)))
+            logger.info(f"Polling ingress started; enqueuing updates for {WORKER_COUNT} worker partition(s).")
+            await poll_ingress(bot)
+
+
+class UpdateQueueConsumer:
+    """مصرف بخش این worker از update_queue به ترتیب id؛ ترتیب پیام‌های هر چت با chat_turn_lock حفظ می‌شود."""
+
+    def __init__(self, application: Application, partition: int):
+        self.application = application
+        self.partition = partition
+        self._wake = asyncio.Event()
+        # شناسه به‌روزرسانی‌های پردازش‌شده که در دور بعد دسته‌ای حذف می‌شوند
+        self._done = []
+        # به‌روزرسانی‌های برداشته‌شده که هنوز پردازش نشده‌اند؛ lease آن‌ها تا پایان پردازش تمدید می‌شود
+        self.in_flight = set()
+        self._slot = asyncio.Event()
+        self._last_refresh = time.monotonic()
+
+    def on_notify(self, payload: str) -> None:
+        """callback کانال UPDATES_CHANNEL."""
+        if int(payload) == self.partition:
+            self._wake.set()
+
+    async def run(self) -> None:
+        while True:
+            if time.monotonic() - self._last_refresh >= UPDATE_LEASE_SECONDS / 3:
+                await self.refresh_claims()
+            room = UPDATE_MAX_IN_FLIGHT - len(self.in_flight)
+            if room <= 0:
+                # تا آزاد شدن جا چیزی برداشته نمی‌شود؛ بیدار شدن دوره‌ای فقط برای تمدید lease است
+                self._slot.clear()
+                try:
+                    await asyncio.wait_for(self._slot.wait(), timeout=UPDATE_LEASE_SECONDS / 3)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self._wake.clear()
+            limit = min(UPDATE_QUEUE_BATCH, room)
+            try:
+                claimed = await self._claim(limit)
+            except Exception as e:
+                logger.warning(f"Failed to claim queued updates: {e}")
+                claimed = []
+            for queue_id, payload in claimed:
+                # ترتیب ساخت تسک‌ها همان ترتیب ورود است؛ قفل هر چت به ترتیب درخواست واگذار می‌شود
+                self.in_flight.add(queue_id)
+                start_background_task(self._process(queue_id, payload))
+            if len(claimed) < limit:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=UPDATE_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def refresh_claims(self) -> None:
+        """تمدید claimed_at به‌روزرسانی‌هایی که هنوز در حافظه این worker منتظر نوبت‌اند (مثلاً پشت قفل یک چت کند)."""
+        self._last_refresh = time.monotonic()
+        if not self.in_flight:
+            return
+        pool = await get_db_pool()
+        if pool is None:
+            return
+        try:
+            async with pool.connection() as conn:
+                await conn.execute(
+                    "UPDATE update_queue SET claimed_at = now() WHERE id = ANY(%s)",
+                    (list(self.in_flight),)
+                )
+        except Exception as e:
+            logger.error(f"Failed to refresh queued update claims: {e}")
+
+    async def _claim(self, limit: int) -> list:
+        pool = await get_db_pool()
+        if pool is None:
+            return []
+        done, self._done = self._done, []
+        async with pool.connection() as conn:
+            try:
+                if done:
+                    await conn.execute("DELETE FROM update_queue WHERE id = ANY(%s)", (done,))
+            except Exception:
+                self._done.extend(done)
+                raise
+            cursor = await conn.execute(
+                """
+                UPDATE update_queue SET claimed_at = now()
+                WHERE id IN (
+                    SELECT id FROM update_queue
+                    WHERE worker_partition = %s
+                      AND (claimed_at IS NULL OR claimed_at < now() - %s * INTERVAL '1 second')
+                    ORDER BY id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, payload
+                """,
+                (self.partition, UPDATE_LEASE_SECONDS, limit)
+            )
+            return sorted(await cursor.fetchall())
+
+    async def _process(self, queue_id: int, payload: dict) -> None:
+        try:
+            # ردیف خراب فقط همان ردیف را رد می‌کند و مثل پردازش‌شده حذف می‌شود
+            await self.application.process_update(Update.de_json(payload, self.application.bot))
+        except Exception as e:
+            logger.error(f"Error processing queued update {queue_id}: {e}")
+        finally:
+            UPDATES_PROCESSED.inc()
+            self._done.append(queue_id)
+            self.in_flight.discard(queue_id)
+            self._slot.set()
+
+
+async def run_worker(index: int) -> None:
+    """فرآیند worker: همان Application ربات، با ورودی از بخش index صف به‌جای تلگرام."""
+    global worker_index
+    worker_index = index
+    application = build_application()
+    consumer = UpdateQueueConsumer(application, index)
+    pg_listener.subscribe(UPDATES_CHANNEL, consumer.on_notify)
+    # هر worker کش جدای خود را دارد؛ نوشتن‌های workerهای دیگر فقط از این کانال می‌رسند (مستقل از تنظیمات)
+    enable_cache_invalidation_listener()
+    async with application:
+        await post_init(application)
+        await application.start()
+        logger.info(f"Worker {index}/{WORKER_COUNT} consuming update partition {index}.")
+        try:
+            await consumer.run()
+        finally:
+            await application.stop()
+            await post_shutdown(application)
+
+def _worker_process(index: int) -> None:
+    """نقطه شروع فرآیندهای worker در حالت cluster."""
+    init_ai_client()
+    asyncio.run(run_worker(index))
+
+def start_worker_processes() -> list:
+    context = multiprocessing.get_context("spawn")
+    processes = []
+    for index in range(WORKER_COUNT):
+        process = context.Process(target=_worker_process, args=(index,), name=f"crm-worker-{index}", daemon=True)
+        process.start()
+        processes.append(process)
+    return processes
+
 
+async def run_as_leader(lock_id: int, name: str, coro_factory) -> None:
+    """اجرای یک وظیفه فقط در یکی از نمونه‌ها با قفل advisory روی اتصال اختصاصی؛ با قطع اتصال رهبر قفل آزاد و نمونه دیگری رهبر می‌شود."""
+    while True:
+        try:
+            conn = await psycopg.AsyncConnection.connect(DATABASE_URL, sslmode='require', autocommit=True)
+            async with conn:
+                while not (await (await conn.execute("SELECT pg_try_advisory_lock(%s)", (lock_id,))).fetchone())[0]:
+                    await asyncio.sleep(LEADER_RETRY_SECONDS)
+                logger.info(f"This instance is now the leader for the {name}.")
+                task = asyncio.create_task(coro_factory())
+                try:
+                    while not task.done():
+                        await asyncio.wait({task}, timeout=LEADER_CHECK_SECONDS)
+                        # قطع این اتصال یعنی از دست رفتن قفل؛ وظیفه باید متوقف شود
+                        await conn.execute("SELECT 1")
+                    task.result()
+                finally:
+                    task.cancel()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Leadership for the {name} lost or unavailable: {e}. Retrying in {LEADER_RETRY_SECONDS}s.")
+            await asyncio.sleep(LEADER_RETRY_SECONDS)
+
+
+def init_ai_client() -> None:
+    global ai_client
+    load_genai()
+    if GEMINI_API_KEY and GEMINI_API_KEY != "YOUR_API_KEY_HERE":
+        try:
+            ai_client = genai.Client(api_key=GEMINI_API_KEY)
+            logger.info("Gemini Client and Model Initialized Successfully.")
+        except Exception as e:
+            logger.error(f"Error initializing Gemini client: {e}")
+            
+    else:
+        logger.error("GEMINI_API_KEY is not set.")
+
+
+def main() -> None:
+    """شروع به کار ربات (با منطق انتخاب Webhook یا Polling)"""
+    mark_startup_phase("imports")
+    
+    if BOT_MODE in ("ingress", "worker", "cluster"):
+        # --- حالت مقیاس‌پذیر: صف به‌روزرسانی‌ها در PostgreSQL ---
+        if not DATABASE_URL or TELEGRAM_BOT_TOKEN == "YOUR_TELEGRAM_BOT_TOKEN_HERE":
+            logger.error(f"BOT_MODE={BOT_MODE} needs DATABASE_URL and TELEGRAM_BOT_TOKEN.")
+            return
+        if BOT_MODE == "worker":
+            init_ai_client()
+            asyncio.run(run_worker(WORKER_INDEX))
+            return
+        # فرآیند ورودی به Gemini نیازی ندارد
+        if BOT_MODE == "cluster":
+            start_worker_processes()
+        asyncio.run(run_ingress())
+        return
+
+    if FAST_START and RENDER_EXTERNAL_URL and TELEGRAM_BOT_TOKEN != "YOUR_TELEGRAM_BOT_TOKEN_HERE":
+        asyncio.run(run_fast_webhook())
+        return
+
+    init_ai_client()
+
+    # --- اتصال به PostgreSQL و ساخت جداول در post_init (داخل event loop ربات) انجام می‌شود ---
     
     if RENDER_EXTERNAL_URL and TELEGRAM_BOT_TOKEN != "YOUR_TELEGRAM_BOT_TOKEN_HERE":
         # --- اجرای Webhook (برای Render) ---
-        application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
-        application.add_handler(CommandHandler("start", start_command))
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
-        
-        # اجرای وظیفه یادآوری (Reminders)
-        if application.job_queue:
-            application.job_queue.run_once(
-                lambda context: asyncio.create_task(reminder_checker(application)),
-                0
-            )
+        application = build_application()
 
         url_path = TELEGRAM_BOT_TOKEN 
         webhook_url = f"{RENDER_EXTERNAL_URL}/{url_path}"
@@ -594,18 +4582,10 @@ def main() -> None:
         logger.error("TELEGRAM_BOT_TOKEN is a placeholder. Cannot run bot.")
         return
 
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
-    application.add_handler(CommandHandler("start", start_command))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
-    
-    if application.job_queue:
-        application.job_queue.run_once(
-            lambda context: asyncio.create_task(reminder_checker(application)),
-            0
-        )
+    application = build_application()
 
     logger.info("Starting Memory-Enabled Free-Form CRM Bot (Polling Mode)...")
     application.run_polling(poll_interval=3.0)
     
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,61 @@
+"""قاعده awaiting_reply: پیام کوتاه تنها فقط وقتی نام مشتری فرض می‌شود که مدل منتظر پاسخ کاربر نباشد."""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("google.genai")
+
+import crmbotrender
+
+
+@pytest.fixture
+def types():
+    crmbotrender.load_genai()
+    return crmbotrender.types
+
+
+def history_ending_with(types, *contents):
+    history = crmbotrender.ChatHistory()
+    history.start_turn(types.Content(role="user", parts=[types.Part(text="مشتری را حذف کن")]))
+    for content in contents:
+        history.append(content)
+    return history
+
+
+def model_text(types, text):
+    return types.Content(role="model", parts=[types.Part(text=text)])
+
+
+def test_empty_history_is_not_awaiting_reply():
+    assert not crmbotrender.awaiting_reply(crmbotrender.ChatHistory())
+
+
+def test_final_statement_is_not_awaiting_reply(types):
+    history = history_ending_with(types, model_text(types, "مشتری با موفقیت ثبت شد."))
+    assert not crmbotrender.awaiting_reply(history)
+
+
+@pytest.mark.parametrize("text", ["کدام مشتری را حذف کنم؟", "Which customer should I delete?"])
+def test_question_is_awaiting_reply(types, text):
+    assert crmbotrender.awaiting_reply(history_ending_with(types, model_text(types, text)))
+
+
+def test_only_the_last_paragraph_counts(types):
+    answered = model_text(types, "آیا این مشتری است؟ بله، پیدا شد.\n\nاطلاعات او ثبت شد.")
+    asking = model_text(types, "اطلاعات او ثبت شد.\n\nیادآوری هم تنظیم شود؟")
+
+    assert not crmbotrender.awaiting_reply(history_ending_with(types, answered))
+    assert crmbotrender.awaiting_reply(history_ending_with(types, asking))
+
+
+def test_unfinished_turn_is_awaiting_reply(types):
+    function_call = types.Content(role="model", parts=[types.Part(
+        function_call=types.FunctionCall(name="delete_customer", args={"name": "علی"})
+    )])
+
+    assert crmbotrender.awaiting_reply(history_ending_with(types, function_call))
+    # نوبتی که فقط پیام کاربر را دارد (مثلاً پاسخ مدل ثبت نشده) هم تمام‌نشده است
+    assert crmbotrender.awaiting_reply(history_ending_with(types))
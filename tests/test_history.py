@@ -0,0 +1,29 @@
+"""رفت‌وبرگشت سریال‌سازی نوبت‌های تاریخچه (همان payload ذخیره‌شده در chat_history_turns)."""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("google.genai")
+
+import crmbotrender
+
+
+def test_turn_round_trip_keeps_thought_signature():
+    crmbotrender.load_genai()
+    types = crmbotrender.types
+    signature = b"\x00\xff\x10thought-signature"
+    contents = [
+        types.Content(role="user", parts=[types.Part(text="گزارش همه مشتریان")]),
+        types.Content(role="model", parts=[types.Part(
+            function_call=types.FunctionCall(name="get_report", args={"query_type": "all"}),
+            thought_signature=signature,
+        )]),
+    ]
+
+    restored = crmbotrender.deserialize_turn(crmbotrender.serialize_turn(contents))
+
+    assert restored[1].parts[0].thought_signature == signature
+    assert restored == contents
@@ -0,0 +1,48 @@
+"""یکسان‌سازی ورودی‌های کاربر و فایل‌های ورودی پیش از جستجو و ذخیره."""
+import os
+import re
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import crmbotrender
+
+
+@pytest.mark.parametrize("raw, expected", [
+    ("09121234567", "09121234567"),
+    ("+98 912 123 4567", "09121234567"),
+    ("0098-912-123-4567", "09121234567"),
+    ("9121234567", "09121234567"),
+    ("۰۹۱۲۱۲۳۴۵۶۷", "09121234567"),
+    ("٠٩١٢١٢٣٤٥٦٧", "09121234567"),
+    # Excel شماره را عدد ذخیره می‌کند و صفر ابتدایی را حذف می‌کند
+    (9121234567.0, "09121234567"),
+    ("021 8888 1234", "02188881234"),
+])
+def test_normalize_phone(raw, expected):
+    assert crmbotrender.normalize_phone(raw) == expected
+
+
+@pytest.mark.parametrize("raw", [None, "", "123", "تلفن ندارد", "1" * 16])
+def test_normalize_phone_rejects_invalid_numbers(raw):
+    assert crmbotrender.normalize_phone(raw) is None
+
+
+@pytest.mark.parametrize("raw", ["علي كريمي", "علی\u200cکریمی", "  علی   کریمی ", "علی\tکریمی"])
+def test_normalize_lookup_key_unifies_spellings_of_one_name(raw):
+    assert crmbotrender.normalize_lookup_key(raw) == "علی کریمی"
+
+
+def test_normalize_lookup_key_ignores_case_and_accepts_missing_values():
+    assert crmbotrender.normalize_lookup_key(" Sara  AHMADI ") == "sara ahmadi"
+    assert crmbotrender.normalize_lookup_key(None) == ""
+
+
+@pytest.mark.parametrize("raw", ["مصطفى كاظمي", "Ali\u200cReza  K", "  یاسر\u200c\u200cکیانی "])
+def test_normalize_lookup_key_matches_sql_crm_name_key(raw):
+    # همان عبارت تابع crm_name_key در مهاجرت‌ها: btrim(regexp_replace(translate(lower(...)), '\s+', ' '))
+    table = str.maketrans(crmbotrender.NAME_KEY_FROM, crmbotrender.NAME_KEY_TO)
+    sql_key = re.sub(r"\s+", " ", raw.lower().translate(table)).strip(" ")
+    assert crmbotrender.normalize_lookup_key(raw) == sql_key
@@ -0,0 +1,57 @@
+"""تقسیم پاسخ‌های طولانی و پیشوند قابل نمایش Markdown در پاسخ جریانی."""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import crmbotrender
+
+split_message = crmbotrender.split_message
+balance_markdown = crmbotrender.balance_markdown
+
+
+def test_split_message_keeps_short_text_whole():
+    assert split_message("سلام") == ["سلام"]
+
+
+def test_split_message_cuts_at_line_boundaries_within_limit():
+    lines = [f"خط شماره {i}" for i in range(40)]
+    parts = split_message("\n".join(lines), limit=100)
+
+    assert len(parts) > 1
+    assert all(len(part) <= 100 for part in parts)
+    # هیچ خطی بین دو تکه نصف نمی‌شود
+    assert [line for part in parts for line in part.split("\n")] == lines
+
+
+def test_split_message_cuts_a_long_line_without_newlines():
+    parts = split_message("x" * 250, limit=100)
+
+    assert all(len(part) <= 100 for part in parts)
+    assert "".join(parts) == "x" * 250
+
+
+def test_split_message_reopens_a_code_block_cut_at_the_boundary():
+    code = "\n".join(f"row {i}" for i in range(30))
+    parts = split_message(f"گزارش:\n```\n{code}\n```", limit=80)
+
+    assert len(parts) > 1
+    for part in parts:
+        assert len(part) <= 80
+        assert part.count("```") % 2 == 0
+    assert parts[1].startswith("```\n")
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("متن کامل *پررنگ* و _کج_", "متن کامل *پررنگ* و _کج_"),
+    ("hello *bol", "hello "),
+    ("a *b* c _d", "a *b* c "),
+    ("`x` and `y", "`x` and "),
+    ("```py\nprint(1)", "```py\nprint(1)\n```"),
+    # نشانه‌های داخل بلوک کد بسته‌شده شمرده نمی‌شوند
+    ("```\na_b*\n```\nfoo *bar", "```\na_b*\n```\nfoo "),
+])
+def test_balance_markdown(text, expected):
+    assert balance_markdown(text) == expected
@@ -0,0 +1,192 @@
+"""ترتیب مرحله‌ها و اعمال نوشتن‌های دسته‌ای WriteBatch با یک pool ساختگی در حافظه."""
+import asyncio
+import contextlib
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import psycopg
+
+import crmbotrender
+
+
+def call(tool, **args):
+    return SimpleNamespace(name=tool, args=args)
+
+
+class FakeCursor:
+    """فقط دستورهایی که WriteBatch می‌فرستد؛ هر دستور با نوع آن در db.log ثبت می‌شود."""
+
+    def __init__(self, db):
+        self.db = db
+        self.rows = []
+        self.sets = []
+
+    async def execute(self, query, params=None):
+        if "FOR UPDATE" in query:
+            self.db.log.append("lock")
+            names, phones = params
+            self.rows = [row for row in self.db.customers
+                         if crmbotrender.normalize_lookup_key(row[1]) in names or row[2] in phones]
+        elif "DELETE FROM customers" in query:
+            self.db.log.append("delete")
+            ids = params["ids"]
+            self.rows = [(customer_id, 0, 0) for customer_id in ids]
+            self.db.customers = [row for row in self.db.customers if row[0] not in ids]
+        else:
+            self.rows = []
+        return self
+
+    async def executemany(self, query, rows, returning=False):
+        if self.db.fail:
+            raise psycopg.Error("connection lost")
+        table = query.split()[2]
+        self.db.log.append(f"{query.split()[0].lower()} {table}")
+        results = []
+        for row in rows:
+            self.db.next_id += 1
+            if table == "customers" and query.startswith("INSERT"):
+                stored = (self.db.next_id,) + tuple(row)
+                self.db.customers.append(stored)
+                results.append([stored])
+            else:
+                results.append([(self.db.next_id,)])
+        self.sets = results
+        self.rows = self.sets.pop(0) if self.sets else []
+
+    async def fetchone(self):
+        return self.rows[0]
+
+    async def fetchall(self):
+        return self.rows
+
+    def nextset(self):
+        if self.sets:
+            self.rows = self.sets.pop(0)
+            return True
+        return None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakeConnection:
+    def __init__(self, db):
+        self.db = db
+
+    async def execute(self, query, params=None):
+        return await FakeCursor(self.db).execute(query, params)
+
+    def cursor(self):
+        return FakeCursor(self.db)
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        yield
+
+
+class FakePool:
+    def __init__(self, customers):
+        self.customers = list(customers)
+        self.next_id = 100
+        self.log = []
+        self.fail = False
+
+    @contextlib.asynccontextmanager
+    async def connection(self):
+        yield FakeConnection(self)
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    pool = FakePool([(1, "علی کریمی", "09120000000", "A", None, None)])
+
+    async def get_db_pool():
+        return pool
+
+    monkeypatch.setattr(crmbotrender, "get_db_pool", get_db_pool)
+    monkeypatch.setattr(crmbotrender, "CACHE_NOTIFY_INVALIDATION", False)
+    return pool
+
+
+def test_stages_keep_call_order_per_customer():
+    calls = [
+        call("delete_customer", name="Ali"),
+        call("manage_customer_data", name="ali", phone="0912"),
+        call("log_interaction", customer_name="ALI", interaction_report="x"),
+        call("log_interaction", customer_name="Sara", interaction_report="y"),
+        call("manage_customer_data", name="Sara", phone="0935"),
+        call("manage_customer_data", name="Reza", phone="0936"),
+    ]
+    batch = crmbotrender.WriteBatch(calls, chat_id=1)
+    bound = [dict(c.args) for c in calls]
+
+    stages = batch._stages(bound)
+
+    # هر مشتری به ترتیب مدل؛ ثبت Sara پس از تعامل او و هم‌مرحله با ثبت دوباره Ali دسته می‌شود
+    assert stages == [[5], [3], [0], [1, 4], [2]]
+
+
+def test_stages_order_a_phone_released_by_delete_before_its_reuse():
+    calls = [
+        call("delete_customer", name="Ali"),
+        call("manage_customer_data", name="Reza", phone="0912"),
+    ]
+    batch = crmbotrender.WriteBatch(calls, chat_id=1)
+    batch._remember((1, "Ali", "0912", None, None, None))
+
+    stages = batch._stages([dict(c.args) for c in calls])
+
+    assert stages == [[0], [1]]
+
+
+def test_delete_then_reregister_then_log_runs_in_call_order(pool):
+    calls = [
+        call("delete_customer", name="علي كريمي"),
+        call("manage_customer_data", name="علی کریمی", phone="09120000000", company="B"),
+        call("log_interaction", customer_name="علی  کریمی", interaction_report="تماس"),
+    ]
+
+    results = asyncio.run(crmbotrender.WriteBatch(calls, chat_id=7).run())
+
+    assert pool.log == ["lock", "delete", "insert customers", "insert interactions"]
+    assert "حذف شد" in results[0]
+    new_id = pool.customers[-1][0]
+    assert f"(ID: {new_id})" in results[1]
+    assert "با موفقیت در دیتابیس ثبت شد" in results[2]
+    assert [row[3] for row in pool.customers] == ["B"]
+
+
+def test_interaction_before_registration_fails_like_sequential_calls(pool):
+    calls = [
+        call("log_interaction", customer_name="Sara", interaction_report="زود"),
+        call("manage_customer_data", name="Sara", phone="09350000000"),
+    ]
+
+    results = asyncio.run(crmbotrender.WriteBatch(calls, chat_id=7).run())
+
+    assert results[0].startswith("خطا: مشتری با نام 'Sara'")
+    assert "عملیات ثبت مشتری موفق بود" in results[1]
+    assert pool.log == ["lock", "insert customers"]
+
+
+def test_database_error_rolls_back_every_applied_call(pool):
+    pool.fail = True
+    calls = [
+        call("manage_customer_data", name="Sara", phone="09350000000"),
+        call("log_interaction", customer_name="علی کریمی", interaction_report="x"),
+        call("log_interaction", customer_name="علی کریمی", unknown="x"),
+    ]
+
+    results = asyncio.run(crmbotrender.WriteBatch(calls, chat_id=7).run())
+
+    assert all("هیچ‌کدام از تغییرات این نوبت ثبت نشد" in result for result in results[:2])
+    # خطای آرگومان همان فراخوانی پیش از تراکنش تعیین شده و جایگزین نمی‌شود
+    assert results[2].startswith("خطا: آرگومان‌های نامعتبر")